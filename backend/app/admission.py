@@ -0,0 +1,183 @@
+import asyncio
+import math
+import os
+import time
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.database import DB_CONNECTION
+from app.database.pool import pool_stats
+from app.metrics import REJECTED_REQUESTS, sampler
+
+# Admission control
+#
+# Under a spike, accepting every request only queues them all on the database
+# pool, where they time out together. Requests are turned away early instead,
+# with a Retry-After header:
+#
+#   429  a client went over its token bucket: ADMISSION_RATE requests a
+#        second, bursts of up to ADMISSION_BURST. Off by default. Clients are
+#        told apart by address: behind a proxy (Railway's included) uvicorn
+#        only takes the address from X-Forwarded-For when the proxy is in
+#        FORWARDED_ALLOW_IPS, otherwise every user shares the proxy's bucket.
+#   503  the server is saturated: more than ADMISSION_MAX_POOL_WAITING tasks
+#        wait for a connection of the primary pool, or the event loop runs
+#        ADMISSION_MAX_LOOP_LAG seconds late (as last measured by the metrics
+#        sampler). Reads are shed first, writes such as bookings only past
+#        twice the thresholds.
+#   503  a heavy endpoint (long lists, bulk import and export) is at its
+#        concurrency cap and no place freed up within ADMISSION_QUEUE_TIMEOUT
+#        seconds. The caps keep them from taking the whole pool, so the
+#        booking writes keep their latency.
+#
+# Limits are per worker process. 0 turns a limit off. /health and /metrics
+# always go through.
+
+RATE = float(os.getenv("ADMISSION_RATE", 0))
+BURST = float(os.getenv("ADMISSION_BURST", 40))
+MAX_POOL_WAITING = int(os.getenv("ADMISSION_MAX_POOL_WAITING", 20))
+MAX_LOOP_LAG = float(os.getenv("ADMISSION_MAX_LOOP_LAG", 0.25))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 1))
+# Retry-After of a 503, in seconds
+RETRY_AFTER = 1
+
+# concurrent requests per group of heavy endpoints
+CONCURRENCY = {
+    "lists": int(os.getenv("ADMISSION_LIST_CONCURRENCY", 8)),
+    "bulk": int(os.getenv("ADMISSION_BULK_CONCURRENCY", 2)),
+}
+# (method, path) -> group, a path ending with "/" covers the paths below it
+HEAVY = {
+    ("GET", "/receptionist/appointment"): "lists",
+    ("GET", "/doctor/appointments"): "lists",
+    ("GET", "/patient/appointment"): "lists",
+    ("GET", "/patient/record"): "lists",
+    ("GET", "/prescription/all"): "lists",
+    ("GET", "/admin/export/"): "bulk",
+    ("POST", "/admin/import/"): "bulk",
+}
+EXEMPT = {"/health", "/metrics"}
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+# buckets kept before the idle ones are dropped
+MAX_CLIENTS = 100_000
+
+
+class TokenBuckets:
+    """
+    A token bucket per client, refilled at `rate` tokens a second up to
+    `burst`. A request takes a token.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        # client -> (tokens, monotonic time of the last update)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._pruned_at = 0.0
+
+    def take(self, client: str, now: float) -> float:
+        """
+        0 when the client had a token, else the seconds until it has one.
+        """
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self._buckets[client] = (tokens - 1, now)
+            if len(self._buckets) > MAX_CLIENTS:
+                self._prune(now)
+            return 0.0
+        self._buckets[client] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    def _prune(self, now: float) -> None:
+        # a bucket refilled to the burst is the same as no bucket
+        full = self.burst / self.rate
+        if now - self._pruned_at < full:
+            return
+        self._pruned_at = now
+        self._buckets = {
+            client: bucket for client, bucket in self._buckets.items() if now - bucket[1] < full
+        }
+
+
+def saturation(write: bool) -> str | None:
+    """
+    Why the server is too busy to take a request, or None.
+    """
+    # writes are only shed well past the point where reads are
+    factor = 2 if write else 1
+    if MAX_LOOP_LAG and sampler.loop_lag > MAX_LOOP_LAG * factor:
+        return "Server overloaded: event loop lagging"
+    stats = pool_stats(DB_CONNECTION) if MAX_POOL_WAITING else None
+    if stats is not None and stats["waiting"] > MAX_POOL_WAITING * factor:
+        return "Server overloaded: database pool saturated"
+    return None
+
+
+def heavy_group(method: str, path: str) -> str | None:
+    group = HEAVY.get((method, path))
+    if group is None:
+        for (heavy_method, heavy_path), heavy in HEAVY.items():
+            if heavy_method == method and heavy_path.endswith("/") and path.startswith(heavy_path):
+                return heavy
+    return group
+
+
+class AdmissionMiddleware:
+    """
+    Rate limits clients and sheds load early, see above.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.buckets = TokenBuckets(RATE, BURST) if RATE else None
+        self.slots = {group: asyncio.Semaphore(limit) for group, limit in CONCURRENCY.items() if limit}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        path = scope["path"].removeprefix(scope.get("root_path", "")) or "/"
+        if path in EXEMPT:
+            await self.app(scope, receive, send)
+            return
+
+        if self.buckets is not None:
+            client = scope["client"][0] if scope.get("client") else "unknown"
+            wait = self.buckets.take(client, time.monotonic())
+            if wait:
+                await self._reject(scope, receive, send, 429, "rate_limit", "Too many requests", wait)
+                return
+
+        reason = saturation(method not in READ_METHODS)
+        if reason is not None:
+            await self._reject(scope, receive, send, 503, "overload", reason, RETRY_AFTER)
+            return
+
+        group = heavy_group(method, path)
+        slots = self.slots.get(group) if group is not None else None
+        if slots is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            async with asyncio.timeout(QUEUE_TIMEOUT):
+                await slots.acquire()
+        except TimeoutError:
+            await self._reject(scope, receive, send, 503, "concurrency", "Too many requests of this kind", RETRY_AFTER)
+            return
+        try:
+            # held until the whole response, streamed or not, is sent
+            await self.app(scope, receive, send)
+        finally:
+            slots.release()
+
+    async def _reject(
+        self, scope: Scope, receive: Receive, send: Send, status: int, reason: str, detail: str, retry_after: float
+    ) -> None:
+        REJECTED_REQUESTS.labels(reason).inc()
+        response = JSONResponse(
+            {"detail": detail}, status_code=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, NamedTuple
+
+from fastapi import HTTPException, Request, Response
+
+from app.database.projections import doctor_slot_directory
+from app.database.routing import primary
+from app.serialization import dumps
+from app.storage import etag_matches
+
+_MISSING = object()
+
+
+class Snapshot:
+    """
+    A value built by an async loader and kept in process until invalidated.
+
+    Writers call `invalidate()` after changing the underlying rows. `max_age`
+    bounds how stale a snapshot can get when the write happened in another
+    worker process. Concurrent misses share a single load.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[Any]], max_age: float) -> None:
+        self._loader = loader
+        self._max_age = max_age
+        self._value: Any = _MISSING
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return (
+            self._value is not _MISSING
+            and time.monotonic() - self._loaded_at < self._max_age
+        )
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._value = _MISSING
+
+    async def get(self) -> Any:
+        if self._fresh():
+            return self._value
+        async with self._lock:
+            if self._fresh():
+                return self._value
+            generation = self._generation
+            # loaded from the primary, a lagging replica could hand back the
+            # rows from before the write that invalidated the snapshot
+            with primary():
+                value = await self._loader()
+            # a write that landed while loading makes this result stale already
+            if generation == self._generation:
+                self._value = value
+                self._loaded_at = time.monotonic()
+            return value
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    stored_at: float
+
+
+class ResponseCache:
+    """
+    JSON responses kept in process for `ttl` seconds, evicting the least
+    recently used past `max_entries`, and served with an ETag so clients
+    revalidate with a 304.
+
+    Keys are tuples whose first item is the kind of data ("doctor",
+    "doctors", ...). Writers call `invalidate()` with the kinds they changed,
+    `ttl` bounds staleness when the write happened in another worker.
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._generation = 0
+
+    def _get(self, key: tuple) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.stored_at >= self._ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key: tuple, entry: CachedResponse) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *kinds: str) -> None:
+        self._generation += 1
+        for key in [key for key in self._entries if key[0] in kinds]:
+            del self._entries[key]
+
+    async def respond(
+        self,
+        request: Request,
+        key: tuple[Hashable, ...],
+        loader: Callable[[], Awaitable[Any]],
+        cache_control: str = "private, no-cache",
+    ) -> Response:
+        """
+        The cached response for `key`, loading it on a miss. Exceptions from
+        the loader (404s) propagate and are not cached.
+        """
+        entry = self._get(key)
+        if entry is None:
+            generation = self._generation
+            # from the primary, as in Snapshot.get
+            with primary():
+                value = await loader()
+            body = dumps(value)
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            entry = CachedResponse(body, etag, time.monotonic())
+            # a write that landed while loading makes this result stale already
+            if generation == self._generation:
+                self._put(key, entry)
+
+        headers = {"etag": entry.etag, "cache-control": cache_control}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(entry.body, media_type="application/json", headers=headers)
+
+
+def profile_loader(model: Any, pydantic_model: Any, id: int, not_found: str) -> Callable[[], Awaitable[Any]]:
+    """
+    Loader of a single row by id for `ResponseCache.respond`, shaped by its
+    response model. 404 with `not_found` when missing.
+    """
+
+    async def load() -> Any:
+        row = await model.get_or_none(id=id).values()
+        if not row:
+            raise HTTPException(status_code=404, detail=not_found)
+        return pydantic_model.model_validate(row)
+
+    return load
+
+
+# /patient/slots, invalidated by slot writes and doctor CRUD
+slot_directory = Snapshot(
+    doctor_slot_directory,
+    max_age=float(os.getenv("SLOT_DIRECTORY_MAX_AGE", 60)),
+)
+
+# doctor directory and profile reads, invalidated by the admin handlers
+reference_cache = ResponseCache(
+    max_entries=int(os.getenv("REFERENCE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("REFERENCE_CACHE_TTL", 300)),
+)
@@ -1,7 +1,22 @@
 from enum import Enum
 from tortoise import fields, models
+from tortoise.exceptions import IntegrityError
 from tortoise.contrib.pydantic import pydantic_model_creator
 
+# label of the tortoise connection, for raw SQL
+DB_CONNECTION = "postgresrailway"
+# optional read replica, see routing.py
+DB_REPLICA = "postgresreplica"
+
+
+def fk_id(instance: models.Model, field: str) -> int:
+    """
+    The id held by the (non null) foreign key `field` of `instance`, read
+    from its `<field>_id` column attribute without fetching the related row.
+    Tortoise adds those attributes at runtime, type checkers do not see them.
+    """
+    return getattr(instance, f"{field}_id")
+
 
 # Admin Model
 class Admin(models.Model):
@@ -62,9 +77,20 @@ class Records(models.Model):
     )
     reason = fields.TextField()
     record_data = fields.CharField(max_length=255)
+    file_name = fields.CharField(max_length=255, null=True)
+    size = fields.BigIntField(null=True)
+    checksum = fields.CharField(max_length=64, null=True)
+    # filled in after the upload by the record_metadata job, see app/metadata.py
+    mime_type = fields.CharField(max_length=100, null=True)
+    page_count = fields.IntField(null=True)
+    preview = fields.CharField(max_length=255, null=True)
+    # wrapped key of an encrypted file, see app/encryption.py. Never serialized.
+    data_key = fields.CharField(max_length=128, null=True)
 
     class Meta:
         exclude = []
+        # a patient's records, in id order (GET /patient/record)
+        indexes = (("patient_id", "id"),)
 
 
 # Doctor Model
@@ -146,6 +172,33 @@ class Appointment(models.Model):
 
     class Meta:
         exclude = []
+        # a patient's appointments in id order, a doctor's appointments by
+        # date. A doctor's BOOKED/DONE list has a partial index, see
+        # migrations.py
+        indexes = (("patient_id", "id"), ("doctor_id", "appointment_date"))
+
+
+# unique index over (slot, effective date) of PENDING/BOOKED appointments,
+# created in migrations.py
+SLOT_BOOKING_INDEX = "uidx_appointment_slot_day"
+
+
+def is_slot_conflict(error: IntegrityError) -> bool:
+    """
+    True when a write failed because the slot is already booked for that date
+    """
+    return SLOT_BOOKING_INDEX in str(error)
+
+
+# slot days, as stored by the frontend
+class WeekdayEnum(str, Enum):
+    MON = "MON"
+    TUE = "TUE"
+    WED = "WED"
+    THU = "THU"
+    FRI = "FRI"
+    SAT = "SAT"
+    SUN = "SUN"
 
 
 # Slot Model
@@ -162,6 +215,12 @@ class Slot(models.Model):
 
     class Meta:
         exclude = []
+        # a doctor's slots, by day
+        indexes = (("doctor_id", "day"),)
+
+
+# unique index over a doctor's (day, slot_time), created in migrations.py
+SLOT_UNIQUE_INDEX = "uidx_slot_doctor_day_time"
 
 # Prescription Model
 class Prescription(models.Model):
@@ -177,11 +236,72 @@ class Prescription(models.Model):
 
     class Meta:
         exclude = []
+        # the prescription of an appointment
+        indexes = (("appointment_id",),)
+
+
+class JobStatusEnum(str, Enum):
+    PENDING = "PENDING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+# Job Model
+class Job(models.Model):
+    """
+    A unit of background work, see app/jobs.py
+    """
+    id = fields.BigIntField(primary_key=True)
+    kind = fields.CharField(max_length=50)
+    # dedupes enqueues, e.g. one reminder per appointment
+    key = fields.CharField(max_length=255, unique=True, null=True)
+    payload = fields.JSONField(default=dict)
+    status = fields.CharEnumField(JobStatusEnum, default=JobStatusEnum.PENDING)
+    # due time, pushed forward while a worker holds the job
+    run_at = fields.DatetimeField()
+    attempts = fields.IntField(default=0)
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        exclude = []
+        # due PENDING jobs have a partial index, see migrations.py
+
+
+# Reminder Model
+class Reminder(models.Model):
+    """
+    A reminder kept for a patient until dismissed, written by a job (see
+    app/jobs.py) so it outlives the SSE event announcing it
+    """
+    id = fields.IntField(primary_key=True)
+    patient_id = fields.ForeignKeyField(
+        "models.Patient",
+        related_name="reminders",
+        on_delete=fields.CASCADE,
+        on_update=fields.CASCADE,
+    )
+    appointment_id = fields.ForeignKeyField(
+        "models.Appointment",
+        related_name="reminders",
+        on_delete=fields.CASCADE,
+        on_update=fields.CASCADE,
+    )
+    kind = fields.CharField(max_length=50)
+    due = fields.DateField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        exclude = []
+        # one reminder of a kind per appointment, a retried job writes it once
+        unique_together = (("appointment_id", "kind"),)
+        # a patient's reminders in id order
+        indexes = (("patient_id", "id"),)
 
 
 Admin_Pydantic = pydantic_model_creator(Admin)
 Patient_Pydantic = pydantic_model_creator(Patient)
-Records_Pydantic = pydantic_model_creator(Records)
+Records_Pydantic = pydantic_model_creator(Records, exclude=("data_key",))
 Doctor_Pydantic = pydantic_model_creator(Doctor)
 Receptionist_Pydantic = pydantic_model_creator(Receptionist)
 Appointment_Pydantic = pydantic_model_creator(Appointment)
@@ -0,0 +1,461 @@
+import asyncio
+import codecs
+import csv
+import os
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from datetime import date
+from enum import Enum
+
+import orjson
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from tortoise import connections
+
+from app.database import DB_CONNECTION, Doctor, GenderEnum, Patient, Slot, WeekdayEnum
+from app.database.migrations import sync_serial_sql
+from app.database.routing import read_connection
+from app.pagination import NDJSON, iter_values
+from app.serialization import dumps
+
+# Bulk import and export
+#
+# Onboarding a clinic loads thousands of patients, doctors and slots at once.
+# An import reads the CSV (header row first) or NDJSON body as it arrives,
+# validates it BATCH_SIZE rows at a time and loads the valid rows of each
+# batch with COPY, all batches in one transaction. A row is rejected, with its
+# line number, when a value is invalid, when a unique value (email, phone, a
+# doctor's day and slot time) is already stored or earlier in the file, or
+# when a slot's doctor does not exist. on_error=abort rolls everything back
+# if any row is rejected, on_error=skip keeps the other rows. A dry run
+# checks everything and rolls back.
+#
+# Rows may carry their "id" (e.g. an export of another database), the id
+# sequence is then moved past them. An export streams the same columns, CSV
+# straight out of COPY, so it imports back as is.
+#
+# An export holds a connection of the read pool, and its snapshot, until the
+# client has read it all, so a slow or stalled client is cut off: a CSV COPY
+# is cancelled after BULK_EXPORT_TIMEOUT seconds, an NDJSON cursor once it
+# waits BULK_EXPORT_IDLE_TIMEOUT seconds for the client between fetches. The
+# response then ends early, without its last rows. 0 turns a limit off.
+
+BATCH_SIZE = 1000
+# rejected rows listed in the response, all of them are counted
+MAX_REPORTED_ERRORS = 1000
+# exported chunks buffered ahead of a slow client
+EXPORT_BUFFER = 16
+EXPORT_TIMEOUT = float(os.getenv("BULK_EXPORT_TIMEOUT", 600))
+EXPORT_IDLE_TIMEOUT = float(os.getenv("BULK_EXPORT_IDLE_TIMEOUT", 60))
+CSV = "text/csv"
+
+
+class BulkEntity(str, Enum):
+    PATIENTS = "patients"
+    DOCTORS = "doctors"
+    SLOTS = "slots"
+
+
+class BulkOnError(str, Enum):
+    ABORT = "abort"
+    SKIP = "skip"
+
+
+class _Row(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, use_enum_values=True)
+
+    id: int | None = Field(None, ge=1)
+
+
+class PatientRow(_Row):
+    name: str = Field(min_length=1, max_length=255)
+    email: str = Field(min_length=3, max_length=255)
+    phone: str = Field(min_length=1, max_length=50)
+    dob: date
+    gender: GenderEnum
+    address: str = Field(max_length=255)
+    emergency_person: str = Field(max_length=255)
+    emergency_relation: str = Field(max_length=255)
+    emergency_number: str = Field(max_length=255)
+
+
+class DoctorRow(_Row):
+    name: str = Field(min_length=1, max_length=255)
+    email: str = Field(min_length=3, max_length=255)
+    phone: str = Field(min_length=1, max_length=50)
+    specialization: str = Field(max_length=255)
+
+
+class SlotRow(_Row):
+    doctor_id: int = Field(ge=1)
+    day: WeekdayEnum
+    slot_time: str = Field(min_length=1, max_length=255)
+    available: bool = True
+
+
+@dataclass(frozen=True)
+class BulkTable:
+    model: type
+    row: type[_Row]
+    # row field -> (column, postgres type), id left out
+    columns: dict[str, tuple[str, str]]
+    # fields whose values cannot repeat
+    unique: tuple[tuple[str, ...], ...]
+
+    @property
+    def table(self) -> str:
+        return self.model._meta.db_table
+
+    def export_fields(self) -> dict[str, str]:
+        return {"id": "id", **{name: column for name, (column, _) in self.columns.items()}}
+
+
+TABLES = {
+    BulkEntity.PATIENTS: BulkTable(
+        Patient,
+        PatientRow,
+        {
+            "name": ("name", "text"),
+            "email": ("email", "text"),
+            "phone": ("phone", "text"),
+            "dob": ("dob", "date"),
+            "gender": ("gender", "text"),
+            "address": ("address", "text"),
+            "emergency_person": ("emergency_person", "text"),
+            "emergency_relation": ("emergency_relation", "text"),
+            "emergency_number": ("emergency_number", "text"),
+        },
+        (("email",), ("phone",)),
+    ),
+    BulkEntity.DOCTORS: BulkTable(
+        Doctor,
+        DoctorRow,
+        {
+            "name": ("name", "text"),
+            "email": ("email", "text"),
+            "phone": ("phone", "text"),
+            "specialization": ("specialization", "text"),
+        },
+        (("email",), ("phone",)),
+    ),
+    BulkEntity.SLOTS: BulkTable(
+        Slot,
+        SlotRow,
+        {
+            "doctor_id": ("doctor_id_id", "int"),
+            "day": ("day", "text"),
+            "slot_time": ("slot_time", "text"),
+            "available": ("available", "bool"),
+        },
+        (("doctor_id", "day", "slot_time"),),
+    ),
+}
+
+
+@dataclass
+class ImportResult:
+    entity: BulkEntity
+    dry_run: bool
+    imported: int = 0
+    rejected: int = 0
+    committed: bool = False
+    errors: list[dict] = field(default_factory=list)
+    # doctors whose slots were imported
+    doctor_ids: set[int] = field(default_factory=set)
+    # whether rows carry their id, decided by the first valid row
+    with_ids: bool | None = None
+
+    def reject(self, line: int, error: str) -> None:
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+    def report(self) -> dict:
+        return {
+            "entity": self.entity.value,
+            "dry_run": self.dry_run,
+            "committed": self.committed,
+            "imported": self.imported if self.committed else 0,
+            "valid": self.imported,
+            "rejected": self.rejected,
+            "errors": sorted(self.errors, key=lambda error: error["line"]),
+            "errors_truncated": self.rejected > len(self.errors),
+        }
+
+
+# parsing
+
+
+def import_format(content_type: str, format: str | None) -> str:
+    if format in ("csv", "ndjson"):
+        return format
+    if NDJSON in content_type or "application/json" in content_type:
+        return "ndjson"
+    if CSV in content_type or not content_type:
+        return "csv"
+    raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson")
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    try:
+        async for chunk in chunks:
+            pending += decoder.decode(chunk)
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                yield line.removesuffix("\r")
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="The file is not UTF-8 text")
+    if pending:
+        yield pending.removesuffix("\r")
+
+
+async def csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    (line number, row or error) for each record after the header. A quoted
+    value may span lines, the record is numbered by its first line.
+    """
+    header: list[str] | None = None
+    number = first = 0
+    parts: list[str] = []
+    quotes = 0
+    async for line in lines:
+        number += 1
+        if not parts:
+            first = number
+        parts.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            # inside a quoted value
+            continue
+        text = "\n".join(parts)
+        parts, quotes = [], 0
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error as e:
+            yield first, f"Invalid CSV: {e}"
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield first, f"Expected {len(header)} values, got {len(values)}"
+            continue
+        row = dict(zip(header, values))
+        # an empty id is a new row
+        if row.get("id") == "":
+            del row["id"]
+        yield first, row
+    if parts:
+        yield first, "Unterminated quoted value"
+    if header is None:
+        raise HTTPException(status_code=400, detail="The CSV has no header row")
+
+
+async def ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | str]]:
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            yield number, f"Invalid JSON: {e}"
+            continue
+        yield number, row if isinstance(row, dict) else "Expected a JSON object"
+
+
+def validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, detail['loc'])) or 'row'}: {detail['msg']}" for detail in error.errors()
+    )
+
+
+# loading
+
+
+def _existing_sql(table: str, columns: list[tuple[str, str]]) -> str:
+    names = ", ".join(f'"{column}"' for column, _ in columns)
+    arrays = ", ".join(f"${n}::{kind}[]" for n, (_, kind) in enumerate(columns, start=1))
+    return f'SELECT {names} FROM "{table}" WHERE ({names}) IN (SELECT * FROM unnest({arrays}))'
+
+
+class _Import:
+    def __init__(self, connection, spec: BulkTable, result: ImportResult) -> None:
+        self.connection = connection
+        self.spec = spec
+        self.result = result
+        # unique values of the rows loaded so far -> their line
+        self.seen: dict[tuple[str, ...], dict[tuple, int]] = {}
+
+    def _validate(self, batch: list[tuple[int, dict | str]]) -> list[tuple[int, _Row]]:
+        rows = []
+        for line, data in batch:
+            if isinstance(data, str):
+                self.result.reject(line, data)
+                continue
+            try:
+                row = self.spec.row.model_validate(data)
+            except ValidationError as e:
+                self.result.reject(line, validation_error(e))
+                continue
+            if self.result.with_ids is None:
+                self.result.with_ids = row.id is not None
+            if (row.id is not None) != self.result.with_ids:
+                self.result.reject(line, "id: give an id on every row or on none")
+                continue
+            rows.append((line, row))
+        return rows
+
+    async def _unique(self, rows: list[tuple[int, _Row]]) -> list[tuple[int, _Row]]:
+        keys = self.spec.unique + ((("id",),) if self.result.with_ids else ())
+        for fields in keys:
+            seen = self.seen.setdefault(fields, {})
+            label = ", ".join(fields)
+            columns = [("id", "int") if name == "id" else self.spec.columns[name] for name in fields]
+            values = {line: tuple(getattr(row, name) for name in fields) for line, row in rows}
+            stored = await self.connection.fetch(
+                _existing_sql(self.spec.table, columns), *map(list, zip(*values.values()))
+            )
+            stored = {tuple(record) for record in stored}
+            kept = []
+            for line, row in rows:
+                value = values[line]
+                if value in seen:
+                    self.result.reject(line, f"{label}: same as line {seen[value]}")
+                elif value in stored:
+                    self.result.reject(line, f"{label}: already exists")
+                else:
+                    seen[value] = line
+                    kept.append((line, row))
+            rows = kept
+        return rows
+
+    async def _doctors(self, rows: list[tuple[int, _Row]]) -> list[tuple[int, _Row]]:
+        slots = [(line, row) for line, row in rows if isinstance(row, SlotRow)]
+        ids = {row.doctor_id for _, row in slots}
+        known = {
+            record["id"]
+            for record in await self.connection.fetch('SELECT "id" FROM "doctor" WHERE "id" = ANY($1::int[])', list(ids))
+        }
+        kept: list[tuple[int, _Row]] = []
+        for line, row in slots:
+            if row.doctor_id in known:
+                kept.append((line, row))
+            else:
+                self.result.reject(line, f"doctor_id: doctor {row.doctor_id} does not exist")
+        return kept
+
+    async def load(self, batch: list[tuple[int, dict | str]]) -> None:
+        rows = self._validate(batch)
+        if rows:
+            rows = await self._unique(rows)
+        if rows and self.spec.model is Slot:
+            rows = await self._doctors(rows)
+        if not rows:
+            return
+        fields = (["id"] if self.result.with_ids else []) + list(self.spec.columns)
+        await self.connection.copy_records_to_table(
+            self.spec.table,
+            records=[tuple(getattr(row, name) for name in fields) for _, row in rows],
+            columns=[name if name == "id" else self.spec.columns[name][0] for name in fields],
+        )
+        self.result.imported += len(rows)
+        if self.spec.model is Slot:
+            self.result.doctor_ids.update(row.doctor_id for _, row in rows if isinstance(row, SlotRow))
+
+
+async def import_rows(
+    entity: BulkEntity,
+    chunks: AsyncIterator[bytes],
+    format: str,
+    on_error: BulkOnError = BulkOnError.ABORT,
+    dry_run: bool = False,
+) -> ImportResult:
+    """
+    Validate and COPY the rows of a CSV or NDJSON body, see above. Everything
+    is committed, or nothing when it is a dry run or rows were rejected with
+    on_error=abort.
+    """
+    spec = TABLES[entity]
+    result = ImportResult(entity, dry_run)
+    records = (ndjson_records if format == "ndjson" else csv_records)(_lines(chunks))
+    async with connections.get(DB_CONNECTION).acquire_connection() as connection:
+        transaction = connection.transaction()
+        await transaction.start()
+        try:
+            loader = _Import(connection, spec, result)
+            batch: list[tuple[int, dict | str]] = []
+            async for record in records:
+                batch.append(record)
+                if len(batch) >= BATCH_SIZE:
+                    await loader.load(batch)
+                    batch = []
+            if batch:
+                await loader.load(batch)
+            if dry_run or (result.rejected and on_error == BulkOnError.ABORT):
+                await transaction.rollback()
+                return result
+            if result.with_ids:
+                await connection.execute(sync_serial_sql(spec.table))
+        except BaseException:
+            await transaction.rollback()
+            raise
+        await transaction.commit()
+    result.committed = True
+    return result
+
+
+# export
+
+
+def _export_sql(spec: BulkTable) -> str:
+    columns = ", ".join(f'"{column}" AS "{name}"' for name, column in spec.export_fields().items())
+    return f'SELECT {columns} FROM "{spec.table}" ORDER BY "id"'
+
+
+async def export_csv(entity: BulkEntity) -> AsyncIterator[bytes]:
+    """
+    The whole table as CSV with a header row, written by COPY. The copy runs
+    on its own task, a few chunks ahead of the client.
+    """
+    spec = TABLES[entity]
+    chunks: asyncio.Queue[bytes] = asyncio.Queue(EXPORT_BUFFER)
+
+    async def copy() -> None:
+        async with connections.get(read_connection()).acquire_connection() as connection:
+            async with connection.transaction(readonly=True):
+                # the COPY is one statement, stalled on a full buffer it keeps running
+                if EXPORT_TIMEOUT:
+                    await connection.execute(f"SET LOCAL statement_timeout = {int(EXPORT_TIMEOUT * 1000)}")
+                await connection.copy_from_query(_export_sql(spec), output=chunks.put, format="csv", header=True)
+
+    task = asyncio.create_task(copy())
+    try:
+        while True:
+            get = asyncio.ensure_future(chunks.get())
+            await asyncio.wait({get, task}, return_when=asyncio.FIRST_COMPLETED)
+            if get.done():
+                yield get.result()
+                continue
+            get.cancel()
+            # the copy is over, drain what it left
+            while not chunks.empty():
+                yield chunks.get_nowait()
+            break
+        # raises if the copy failed
+        await task
+    finally:
+        task.cancel()
+
+
+async def export_ndjson(entity: BulkEntity) -> AsyncIterator[bytes]:
+    spec = TABLES[entity]
+    query = spec.model.all().order_by("id").values(**spec.export_fields())
+    async for row in iter_values(query, idle_timeout=EXPORT_IDLE_TIMEOUT):
+        yield dumps(row) + b"\n"
@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any
+
+from asyncpg import Connection
+from asyncpg.connection import LoggedQuery
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:
+    # only the N+1 check takes httpx objects, the app never imports it
+    import httpx
+
+# SQL instrumentation
+#
+# Every pooled postgres connection gets a query logger (the pool's init hook,
+# see pool.py), which adds each statement and its duration to the stats of
+# the request it ran for. Responses carry the totals in a Server-Timing
+# header, e.g.
+#
+#   Server-Timing: db;dur=3.2;desc="4 queries", app;dur=9.8
+#
+# A request with a statement slower than SQL_SLOW_QUERY_MS, or more than
+# SQL_MANY_QUERIES statements (usually a query per row, N+1), logs its
+# slowest statements. Statements made while a body streams are in the log,
+# not in the header. Other databases are not instrumented.
+
+ENABLED = os.getenv("SQL_INSTRUMENTATION", "1") == "1"
+SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 100))
+MANY_QUERIES = int(os.getenv("SQL_MANY_QUERIES", 50))
+# statements logged per request
+LOGGED_STATEMENTS = 5
+STATEMENT_LOG_LENGTH = 500
+
+logger = logging.getLogger("careflow.sql")
+
+# True once a connection is instrumented, the db metric is left out before
+_instrumented = False
+
+
+class QueryStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+        # (elapsed, n, query) min-heap of the slowest statements
+        self._slowest: list[tuple[float, int, str]] = []
+
+    def add(self, query: str, elapsed: float) -> None:
+        self.count += 1
+        self.duration += elapsed
+        entry = (elapsed, self.count, query)
+        if len(self._slowest) < LOGGED_STATEMENTS:
+            heapq.heappush(self._slowest, entry)
+        elif elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    @property
+    def slowest(self) -> list[tuple[float, str]]:
+        return [(elapsed, query) for elapsed, _, query in sorted(self._slowest, reverse=True)]
+
+
+current_stats: ContextVar[QueryStats | None] = ContextVar("current_stats", default=None)
+
+
+def _log_query(record: LoggedQuery) -> None:
+    # called soon after the statement, in a copy of its context
+    stats = current_stats.get()
+    if stats is not None:
+        stats.add(record.query, record.elapsed)
+
+
+async def instrument_connection(connection: Connection) -> None:
+    """
+    asyncpg pool init hook.
+    """
+    global _instrumented
+    connection.add_query_logger(_log_query)
+    _instrumented = True
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """
+    Collect the statements run inside this block (and the tasks it starts).
+    """
+    stats = QueryStats()
+    token = current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+
+
+def server_timing(stats: QueryStats, elapsed: float) -> str:
+    metrics = []
+    if _instrumented:
+        metrics.append(f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"')
+    metrics.append(f"app;dur={elapsed * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def _log_slow(scope: Scope, stats: QueryStats, elapsed: float) -> None:
+    slowest = stats.slowest
+    if not (slowest and slowest[0][0] * 1000 >= SLOW_QUERY_MS) and stats.count <= MANY_QUERIES:
+        return
+    lines = [
+        f"  {query_elapsed * 1000:8.1f} ms  {' '.join(query.split())[:STATEMENT_LOG_LENGTH]}"
+        for query_elapsed, query in slowest
+    ]
+    logger.warning(
+        "%s %s: %d queries, %.1f ms in the database, %.1f ms in total, slowest:\n%s",
+        scope["method"], scope["path"], stats.count, stats.duration * 1000, elapsed * 1000, "\n".join(lines),
+    )
+
+
+class QueryTimingMiddleware:
+    """
+    Tracks the SQL of every request, adds the Server-Timing header and logs
+    slow requests.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+
+        async def send_timed(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                # query loggers run through call_soon, let the pending ones in
+                await asyncio.sleep(0)
+                MutableHeaders(scope=message).append(
+                    "server-timing", server_timing(stats, time.perf_counter() - started)
+                )
+            await send(message)
+
+        with track_queries() as stats:
+            try:
+                await self.app(scope, receive, send_timed)
+            finally:
+                await asyncio.sleep(0)
+                _log_slow(scope, stats, time.perf_counter() - started)
+
+
+# N+1 check, for tests and bench/suite.py
+
+SERVER_TIMING_QUERIES = re.compile(r'(?:^|,)\s*db;[^,]*desc="(\d+) queries"')
+
+
+def query_count(response: "httpx.Response") -> int:
+    """
+    Statements a response took, from its Server-Timing header.
+    """
+    match = SERVER_TIMING_QUERIES.search(response.headers.get("server-timing", ""))
+    if match is None:
+        raise AssertionError(f"{response.request.url}: no query count, is the database postgres?")
+    return int(match[1])
+
+
+def _row_count(content: Any) -> int:
+    if isinstance(content, list):
+        return len(content)
+    if isinstance(content, dict):
+        return sum(len(value) for value in content.values() if isinstance(value, list))
+    return 1
+
+
+async def assert_constant_queries(
+    client: "httpx.AsyncClient", url: str, sizes: tuple[int, ...] = (1, 10, 100), **params: Any
+) -> int:
+    """
+    Request the paged list at `url` with each of `sizes` as the page size and
+    fail when the number of statements changes with the number of rows, a
+    query per row (N+1). Returns the statement count.
+    """
+    counts = {}
+    for size in sizes:
+        response = await client.get(url, params={**params, "limit": size})
+        response.raise_for_status()
+        counts[_row_count(response.json())] = query_count(response)
+    if len(counts) < 2:
+        raise AssertionError(f"{url}: every page had the same number of rows, add data to compare")
+    if len(set(counts.values())) > 1:
+        detail = ", ".join(f"{count} queries for {rows} rows" for rows, count in counts.items())
+        raise AssertionError(f"{url}: the query count grows with the rows, {detail}")
+    return next(iter(counts.values()))
@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+
+from asyncpg import Connection
+from asyncpg.exceptions import UndefinedTableError
+from tortoise import Tortoise, connections
+from tortoise.utils import get_schema_sql
+
+from app.database import DB_CONNECTION, SLOT_BOOKING_INDEX, SLOT_UNIQUE_INDEX
+from app.database.pool import database_config
+from app.events import CHANNEL, appointment_event, notify_message
+
+logger = logging.getLogger("careflow.migrations")
+
+# tables whose ids used to be picked by the app as max(id) + 1
+SERIAL_TABLES = [
+    "admin",
+    "patient",
+    "records",
+    "doctor",
+    "receptionist",
+    "appointment",
+    "slot",
+    "prescription",
+]
+
+
+def sync_serial_sql(table: str) -> str:
+    # rows inserted with explicit ids never advanced the SERIAL sequence, move
+    # it past max(id) so database generated ids cannot collide. Only ever
+    # moves forward, so it is safe to run while other workers insert.
+    return f"""
+    SELECT setval(s.seq, m.max_id)
+    FROM (SELECT pg_get_serial_sequence('"{table}"', 'id') AS seq) s,
+         (SELECT MAX("id") AS max_id FROM "{table}") m
+    WHERE m.max_id > COALESCE(pg_sequence_last_value(s.seq::regclass), 0)
+    """
+
+
+class AppointmentChanges(str):
+    """
+    A migration changing appointments (rejecting double bookings, moving them
+    to another slot), RETURNING them with APPOINTMENT_COLUMNS. migrate() logs
+    the changed appointments and publishes their appointment events, so the
+    patients and the desk see the change.
+    """
+
+
+APPOINTMENT_COLUMNS = """
+    "appointment"."id", "appointment"."status", "appointment"."appointment_date",
+    "appointment"."reschedule_date", "appointment"."patient_id_id" AS "patient_id",
+    "appointment"."doctor_id_id" AS "doctor_id", "appointment"."slot_id_id" AS "slot_id"
+"""
+
+
+# generate_schemas only creates missing tables and indexes, it never alters an
+# existing table. Columns added after the first deploy (and anything postgres
+# specific) are declared here as idempotent statements, run right after schema
+# generation whenever the schema version changes (see below). Indexes on those
+# columns live here as well, so they are never created before their column
+# exists.
+MIGRATIONS = [
+    # records: file metadata captured while the upload is streamed to disk
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "file_name" VARCHAR(255)',
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "size" BIGINT',
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "checksum" VARCHAR(64)',
+    """
+    UPDATE "records" SET "file_name" = regexp_replace("record_data", '^.*/', '')
+    WHERE "file_name" IS NULL
+    """,
+    'CREATE UNIQUE INDEX IF NOT EXISTS "uidx_records_file_name" ON "records" ("file_name")',
+    # records: metadata extracted after the upload
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "mime_type" VARCHAR(100)',
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "page_count" INT',
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "preview" VARCHAR(255)',
+    # records: wrapped data key of encrypted files
+    'ALTER TABLE "records" ADD COLUMN IF NOT EXISTS "data_key" VARCHAR(128)',
+    # ids are generated by the database
+    *[sync_serial_sql(table) for table in SERIAL_TABLES],
+    # appointment: a slot can hold one live booking per (effective) date.
+    # Booking inserts race on this index instead of checking first. Double
+    # bookings made before the index existed are cleaned up first: the
+    # earliest appointment keeps the slot, the others are rejected.
+    AppointmentChanges(
+        f"""
+    UPDATE "appointment" SET "status" = 'REJECTED'
+    FROM (
+        SELECT "id", ROW_NUMBER() OVER (
+            PARTITION BY "slot_id_id", COALESCE("reschedule_date", "appointment_date") ORDER BY "id"
+        ) AS "n"
+        FROM "appointment" WHERE "status" IN ('PENDING', 'BOOKED')
+    ) bookings
+    WHERE "appointment"."id" = bookings."id" AND bookings."n" > 1
+    RETURNING {APPOINTMENT_COLUMNS}
+    """
+    ),
+    f"""
+    CREATE UNIQUE INDEX IF NOT EXISTS "{SLOT_BOOKING_INDEX}" ON "appointment"
+    ("slot_id_id", (COALESCE("reschedule_date", "appointment_date")))
+    WHERE "status" IN ('PENDING', 'BOOKED')
+    """,
+    # appointment: a doctor's BOOKED/DONE appointments in id order
+    # (GET /doctor/appointments). PartialIndex in Meta only takes equality
+    # conditions, hence here.
+    """
+    CREATE INDEX IF NOT EXISTS "idx_appointment_doctor_active" ON "appointment"
+    ("doctor_id_id", "id") WHERE "status" IN ('BOOKED', 'DONE')
+    """,
+    # prescription: weighted full-text document, kept up to date by postgres
+    """
+    ALTER TABLE "prescription" ADD COLUMN IF NOT EXISTS "search" tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce("medication", '')), 'A') ||
+        setweight(to_tsvector('english', coalesce("observation", '')), 'B') ||
+        setweight(to_tsvector('english', coalesce("test", '')), 'C') ||
+        setweight(to_tsvector('english', coalesce("advise", '')), 'D')
+    ) STORED
+    """,
+    'CREATE INDEX IF NOT EXISTS "idx_prescription_search" ON "prescription" USING GIN ("search")',
+    # job: what the workers claim, due PENDING jobs by due time
+    """
+    CREATE INDEX IF NOT EXISTS "idx_job_due" ON "job" ("run_at")
+    WHERE "status" = 'PENDING'
+    """,
+    # appointment: DONE appointments by visit date, scanned for follow-ups
+    """
+    CREATE INDEX IF NOT EXISTS "idx_appointment_done_visit" ON "appointment"
+    ((COALESCE("reschedule_date", "appointment_date"))) WHERE "status" = 'DONE'
+    """,
+    # patient: desk search (GET /receptionist/patient/search), see
+    # projections.py. pg_trgm is a trusted extension, the database owner
+    # creates it.
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    ALTER TABLE "patient" ADD COLUMN IF NOT EXISTS "search" TEXT
+    GENERATED ALWAYS AS (
+        lower("name") || ' ' || lower("email") || ' ' || regexp_replace("phone", '[^0-9]', '', 'g')
+    ) STORED
+    """,
+    # a larger signature than the default 12 bytes keeps the index selective
+    # on ~40 trigrams per row
+    """
+    CREATE INDEX IF NOT EXISTS "idx_patient_search_trgm" ON "patient"
+    USING GIST ("search" gist_trgm_ops(siglen=64))
+    """,
+    # queries under 3 characters: name prefix, in name order
+    """
+    CREATE INDEX IF NOT EXISTS "idx_patient_name_prefix" ON "patient"
+    ((lower("name") COLLATE "C"), "id")
+    """,
+    # slot: one slot per doctor, day and time, write_slots upserts on it.
+    # Duplicates inserted before the index existed are merged into the lowest
+    # id first. Their appointments move over, a live one colliding with a
+    # live booking of the kept slot on the same date was a double booking and
+    # is rejected: the kept slot's own booking, then the earliest appointment
+    # keeps the slot. Both changes are logged and published, see
+    # AppointmentChanges.
+    AppointmentChanges(
+        f"""
+    WITH slots AS (
+        SELECT "id", MIN("id") OVER (PARTITION BY "doctor_id_id", "day", "slot_time") AS "keep"
+        FROM "slot"
+    ), bookings AS (
+        SELECT a."id", ROW_NUMBER() OVER (
+            PARTITION BY s."keep", COALESCE(a."reschedule_date", a."appointment_date")
+            ORDER BY a."slot_id_id" = s."keep" DESC, a."id"
+        ) AS "n"
+        FROM "appointment" a JOIN slots s ON s."id" = a."slot_id_id"
+        WHERE a."status" IN ('PENDING', 'BOOKED')
+    )
+    UPDATE "appointment" SET "status" = 'REJECTED'
+    FROM bookings WHERE "appointment"."id" = bookings."id" AND bookings."n" > 1
+    RETURNING {APPOINTMENT_COLUMNS}
+    """
+    ),
+    AppointmentChanges(
+        f"""
+    UPDATE "appointment" SET "slot_id_id" = s."keep"
+    FROM (
+        SELECT "id", MIN("id") OVER (PARTITION BY "doctor_id_id", "day", "slot_time") AS "keep"
+        FROM "slot"
+    ) s
+    WHERE "appointment"."slot_id_id" = s."id" AND s."id" <> s."keep"
+    RETURNING {APPOINTMENT_COLUMNS}
+    """
+    ),
+    """
+    DELETE FROM "slot" s USING "slot" k
+    WHERE k."doctor_id_id" = s."doctor_id_id" AND k."day" = s."day"
+      AND k."slot_time" = s."slot_time" AND k."id" < s."id"
+    """,
+    f"""
+    CREATE UNIQUE INDEX IF NOT EXISTS "{SLOT_UNIQUE_INDEX}" ON "slot"
+    ("doctor_id_id", "day", "slot_time")
+    """,
+]
+
+
+async def apply_migrations(connection_label: str) -> None:
+    connection = connections.get(connection_label)
+    for statement in MIGRATIONS:
+        await connection.execute_script(statement)
+
+
+# Versioned schema state
+#
+# Generating the schema and replaying MIGRATIONS takes a few dozen round trips
+# on every boot. Instead the version of the schema, a hash of the generated
+# SQL and of MIGRATIONS, is stored in schema_version once they ran, and a boot
+# finding the current version reads one row and moves on. Any change to a
+# model or to MIGRATIONS changes the version.
+#
+# DB_SCHEMA_MODE=migrate (default) brings an outdated schema up to date at
+# boot, one worker at a time. DB_SCHEMA_MODE=check only compares and refuses
+# to start on an outdated schema, for deploys that migrate in a release step:
+#
+#   python -m app.database.migrations
+
+SCHEMA_MODE = os.getenv("DB_SCHEMA_MODE", "migrate")
+# pg_advisory_lock key, held while migrating
+MIGRATION_LOCK = 7_340_021
+
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS "schema_version" (
+    "id" SMALLINT PRIMARY KEY DEFAULT 1 CHECK ("id" = 1),
+    "version" VARCHAR(64) NOT NULL,
+    "applied_at" TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def schema_version(connection_label: str) -> str:
+    hasher = hashlib.sha256(get_schema_sql(connections.get(connection_label), safe=True).encode())
+    for statement in MIGRATIONS:
+        hasher.update(statement.encode())
+    return hasher.hexdigest()
+
+
+async def _stored_version(connection: Connection) -> str | None:
+    try:
+        return await connection.fetchval('SELECT "version" FROM "schema_version"')
+    except UndefinedTableError:
+        # a database never migrated
+        return None
+
+
+async def _change_appointments(connection: Connection, statement: AppointmentChanges) -> None:
+    rows = await connection.fetch(statement)
+    if not rows:
+        return
+    logger.warning(
+        "migration changed %d appointments: %s",
+        len(rows),
+        ", ".join(f'{row["id"]} ({row["status"]}, slot {row["slot_id"]})' for row in rows),
+    )
+    for row in rows:
+        # NOTIFY straight away, the broker of this process may not run yet
+        await connection.execute(
+            "SELECT pg_notify($1, $2)", CHANNEL, notify_message(*appointment_event(**dict(row)))
+        )
+
+
+async def migrate(connection_label: str) -> str:
+    """
+    Generate the schema, run MIGRATIONS and store the version, unless another
+    process got there first. Returns the version.
+    """
+    client = connections.get(connection_label)
+    version = schema_version(connection_label)
+    async with client.acquire_connection() as connection:
+        # everything runs on the connection holding the session lock, a pool
+        # of one connection would wait for itself otherwise
+        await connection.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+        try:
+            if await _stored_version(connection) == version:
+                return version
+            await connection.execute(get_schema_sql(client, safe=True))
+            for statement in MIGRATIONS:
+                if isinstance(statement, AppointmentChanges):
+                    await _change_appointments(connection, statement)
+                else:
+                    await connection.execute(statement)
+            await connection.execute(SCHEMA_VERSION_TABLE)
+            await connection.execute(
+                """
+                INSERT INTO "schema_version" ("id", "version") VALUES (1, $1)
+                ON CONFLICT ("id") DO UPDATE SET "version" = EXCLUDED."version", "applied_at" = now()
+                """,
+                version,
+            )
+        finally:
+            await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
+    return version
+
+
+async def ensure_schema(connection_label: str, mode: str = SCHEMA_MODE) -> None:
+    """
+    Boot check: return right away when the stored schema version is current,
+    otherwise migrate (mode "migrate") or fail (mode "check").
+    """
+    if mode not in ("migrate", "check"):
+        raise ValueError(f"DB_SCHEMA_MODE must be migrate or check, not {mode!r}")
+    version = schema_version(connection_label)
+    async with connections.get(connection_label).acquire_connection() as connection:
+        if await _stored_version(connection) == version:
+            return
+    if mode == "check":
+        raise RuntimeError(
+            f"database schema is not at version {version[:12]}, run python -m app.database.migrations"
+        )
+    await migrate(connection_label)
+
+
+async def main() -> None:
+    await Tortoise.init(config=database_config(os.environ["POSTGRES_URL"], DB_CONNECTION))
+    try:
+        version = await migrate(DB_CONNECTION)
+    finally:
+        await Tortoise.close_connections()
+    print(f"schema at version {version[:12]}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+
+from tortoise import connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.config_generator import expand_db_url, generate_config
+
+from app.database import DB_REPLICA
+from app.database import instrumentation
+
+# environment variable -> (asyncpg pool/connection option, type). Unset
+# variables leave the value from the connection string, or the default.
+POOL_SETTINGS = {
+    "DB_POOL_MIN_SIZE": ("min_size", int),
+    "DB_POOL_MAX_SIZE": ("max_size", int),
+    # seconds an idle connection above min_size is kept before closing it
+    "DB_POOL_MAX_IDLE": ("max_inactive_connection_lifetime", float),
+    # queries after which a connection is replaced
+    "DB_POOL_MAX_QUERIES": ("max_queries", int),
+    "DB_CONNECT_TIMEOUT": ("timeout", float),
+    "DB_COMMAND_TIMEOUT": ("command_timeout", float),
+    # prepared statements cached per connection, 0 behind pgbouncer in
+    # transaction mode
+    "DB_STATEMENT_CACHE_SIZE": ("statement_cache_size", int),
+    "DB_STATEMENT_CACHE_LIFETIME": ("max_cached_statement_lifetime", int),
+}
+
+HEALTH_TIMEOUT = float(os.getenv("DB_HEALTH_TIMEOUT", 2))
+
+
+def pool_options() -> dict:
+    return {
+        option: cast(os.environ[variable])
+        for variable, (option, cast) in POOL_SETTINGS.items()
+        if os.getenv(variable)
+    }
+
+
+def database_config(db_url: str, connection_label: str, replica_url: str | None = None) -> dict:
+    """
+    Tortoise config for the app models on `db_url`, with the pool options
+    from the environment and the SQL instrumentation. With `replica_url`,
+    adds the read replica connection and its router, see routing.py.
+    """
+    config = generate_config(
+        db_url=db_url,
+        app_modules={"models": ["app.database"]},
+        connection_label=connection_label,
+    )
+    if replica_url:
+        config["connections"][DB_REPLICA] = expand_db_url(replica_url)
+        config["routers"] = ["app.database.routing.ReplicaRouter"]
+    for connection in config["connections"].values():
+        connection["credentials"].update(pool_options())
+        if connection["engine"] == "tortoise.backends.asyncpg" and instrumentation.ENABLED:
+            # run on every new connection of the pool
+            connection["credentials"]["init"] = instrumentation.instrument_connection
+    return config
+
+
+async def ping(connection_label: str) -> float:
+    """
+    Round trip a `SELECT 1` through the pool, returns the latency in ms.
+    """
+    client = connections.get(connection_label)
+    started = time.perf_counter()
+    async with asyncio.timeout(HEALTH_TIMEOUT):
+        await client.execute_query("SELECT 1")
+    return (time.perf_counter() - started) * 1000
+
+
+async def warm_pool(connection_label: str) -> None:
+    """
+    Open the pool and check every connection it keeps, so the first requests
+    after a deploy do not pay for connecting. Raises when the database is not
+    reachable, failing the startup.
+    """
+    await ping(connection_label)
+    client = connections.get(connection_label)
+    if isinstance(client, AsyncpgDBClient):
+        # the pool opened its min_size connections on the first acquire,
+        # concurrent pings spread over them. min_size from POOL_SETTINGS
+        # overrides the minsize of the connection string.
+        min_size = int(client.extra.get("min_size", client.pool_minsize))
+        await asyncio.gather(*(ping(connection_label) for _ in range(min_size)))
+
+
+def _waiting(pool) -> int:
+    # tasks blocked in acquire(), asyncpg keeps no count of its own
+    queue = getattr(pool, "_queue", None)
+    return sum(not getter.done() for getter in getattr(queue, "_getters", ()))
+
+
+def pool_stats(connection_label: str) -> dict | None:
+    client = connections.get(connection_label)
+    pool = getattr(client, "_pool", None)
+    if not isinstance(client, AsyncpgDBClient) or pool is None:
+        return None
+    size, idle = pool.get_size(), pool.get_idle_size()
+    return {
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+        "waiting": _waiting(pool),
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+    }
@@ -0,0 +1,244 @@
+import re
+
+from tortoise import connections
+from tortoise.queryset import QuerySet, ValuesQuery
+
+from app.database import (
+    Appointment,
+    Appointment_Pydantic,
+    Doctor,
+    Doctor_Pydantic,
+    Patient_Pydantic,
+    Prescription,
+    Slot,
+    Slot_Pydantic,
+)
+from app.database.routing import read_connection
+
+# Composite appointment views
+#
+# The appointment list endpoints return every appointment together with its
+# patient, doctor and/or slot. Instead of loading ORM objects and running each
+# one through from_tortoise_orm, the view is read from a single joined
+# `.values()` query and reshaped in bulk. The fields are those of the
+# corresponding *_Pydantic model, so the response shape does not change.
+
+APPOINTMENT_FIELDS = tuple(Appointment_Pydantic.model_fields)
+
+# view key -> (foreign key on Appointment, exposed fields)
+RELATIONS = {
+    "patient": ("patient_id", tuple(Patient_Pydantic.model_fields)),
+    "doctor": ("doctor_id", tuple(Doctor_Pydantic.model_fields)),
+    "slot": ("slot_id", tuple(Slot_Pydantic.model_fields)),
+}
+
+
+def appointment_query(queryset: QuerySet[Appointment], *relations: str) -> ValuesQuery:
+    columns = list(APPOINTMENT_FIELDS)
+    for relation in relations:
+        fk, fields = RELATIONS[relation]
+        columns.extend(f"{fk}__{field}" for field in fields)
+    return queryset.values(*columns)
+
+
+def appointment_view(row: dict, *relations: str) -> dict:
+    view = {"appointment": {field: row[field] for field in APPOINTMENT_FIELDS}}
+    for relation in relations:
+        fk, fields = RELATIONS[relation]
+        view[relation] = {field: row[f"{fk}__{field}"] for field in fields}
+    return view
+
+
+async def appointment_views(queryset: QuerySet[Appointment], *relations: str) -> list[dict]:
+    """
+    Appointments of `queryset` with the given relations ("patient", "doctor",
+    "slot") in one query. Each item is {"appointment": ..., <relation>: ...},
+    keys in the order the relations are given.
+    """
+    rows = await appointment_query(queryset, *relations)
+    return [appointment_view(row, *relations) for row in rows]
+
+
+# Prescription views
+
+PRESCRIPTION_FIELDS = ("id", "observation", "medication", "advise", "test")
+PATIENT_FIELDS = RELATIONS["patient"][1]
+
+
+def prescription_query(queryset: QuerySet[Prescription]) -> ValuesQuery:
+    return queryset.values(
+        *PRESCRIPTION_FIELDS,
+        "appointment_id_id",
+        *(f"appointment_id__patient_id__{field}" for field in PATIENT_FIELDS),
+    )
+
+
+def prescription_view(row: dict) -> dict:
+    return {
+        "prescription": {
+            "id": row["id"],
+            "appointment_id": row["appointment_id_id"],
+            **{field: row[field] for field in PRESCRIPTION_FIELDS[1:]},
+        },
+        "patient": {
+            field: row[f"appointment_id__patient_id__{field}"] for field in PATIENT_FIELDS
+        },
+    }
+
+
+async def prescription_views(queryset: QuerySet[Prescription]) -> list[dict]:
+    """
+    Prescriptions of `queryset` with the patient of their appointment, in one
+    query. Each item is {"prescription": ..., "patient": ...}.
+    """
+    return [prescription_view(row) for row in await prescription_query(queryset)]
+
+
+# ranked full-text search over the generated "search" tsvector column,
+# see migrations.py. COUNT(*) OVER () returns the total with the page.
+PRESCRIPTION_SEARCH_SQL = """
+SELECT
+    ts_rank_cd(p."search", q) AS "rank",
+    COUNT(*) OVER () AS "total",
+    {prescription_columns},
+    a."id" AS "appointment__id",
+    a."appointment_date" AS "appointment__appointment_date",
+    a."status" AS "appointment__status",
+    {patient_columns}
+FROM "prescription" p
+JOIN "appointment" a ON a."id" = p."appointment_id_id"
+JOIN "patient" pt ON pt."id" = a."patient_id_id"
+CROSS JOIN websearch_to_tsquery('english', $1) q
+WHERE p."search" @@ q AND a."doctor_id_id" = $2
+ORDER BY "rank" DESC, p."id" DESC
+LIMIT $3 OFFSET $4
+""".format(
+    prescription_columns=", ".join(
+        f'p."{field}" AS "prescription__{field}"' for field in PRESCRIPTION_FIELDS
+    ),
+    patient_columns=", ".join(
+        f'pt."{field}" AS "patient__{field}"' for field in PATIENT_FIELDS
+    ),
+)
+
+
+def _prefixed(row: dict, prefix: str) -> dict:
+    return {key[len(prefix):]: value for key, value in row.items() if key.startswith(prefix)}
+
+
+async def search_prescriptions(
+    doctor_id: int, query: str, limit: int, offset: int
+) -> tuple[int, list[dict]]:
+    """
+    Prescriptions of a doctor matching a web-search style query, best match
+    first, with their appointment and patient. Returns (total, page), the
+    total is 0 past the last page.
+    """
+    rows = await connections.get(read_connection()).execute_query_dict(
+        PRESCRIPTION_SEARCH_SQL, [query, doctor_id, limit, offset]
+    )
+    total = rows[0]["total"] if rows else 0
+    return total, [
+        {
+            "rank": row["rank"],
+            "prescription": _prefixed(row, "prescription__"),
+            "appointment": _prefixed(row, "appointment__"),
+            "patient": _prefixed(row, "patient__"),
+        }
+        for row in rows
+    ]
+
+
+# Patient search, as staff type at the desk
+#
+# "search" is a generated column holding the lowercased name and email and
+# the digits of the phone (see migrations.py). A query of 3 characters or
+# more is matched by trigram word similarity, so a partial or misspelled
+# name, email or phone number matches too. It is ranked through the GiST
+# trigram index nearest first, and the scan stops after `limit` rows however
+# many patients match. Shorter queries have too few trigrams, they match the
+# start of the name through a btree in name order.
+
+PATIENT_SEARCH_FIELDS = ("id", "name", "email", "phone", "dob")
+TRIGRAM_MIN_LENGTH = 3
+# only digits and phone punctuation, searched as digits
+PHONE_QUERY = re.compile(r"[\d\s()+.-]*\d[\d\s()+.-]*")
+
+PATIENT_TRIGRAM_SEARCH_SQL = """
+SELECT {columns}, 1 - ($1 <<-> "search") AS "rank"
+FROM "patient"
+WHERE $1 <% "search"
+ORDER BY $1 <<-> "search"
+LIMIT $2
+""".format(columns=", ".join(f'"{field}"' for field in PATIENT_SEARCH_FIELDS))
+
+PATIENT_PREFIX_SEARCH_SQL = """
+SELECT {columns}, 1.0 AS "rank"
+FROM "patient"
+WHERE lower("name") COLLATE "C" LIKE $1
+ORDER BY lower("name") COLLATE "C", "id"
+LIMIT $2
+""".format(columns=", ".join(f'"{field}"' for field in PATIENT_SEARCH_FIELDS))
+
+
+def patient_search_sql(query: str) -> tuple[str, str]:
+    """
+    The statement for a search text, and its normalized text argument.
+    """
+    query = " ".join(query.lower().split())
+    if PHONE_QUERY.fullmatch(query):
+        query = re.sub(r"\D", "", query)
+    if len(query) >= TRIGRAM_MIN_LENGTH:
+        return PATIENT_TRIGRAM_SEARCH_SQL, query
+    return PATIENT_PREFIX_SEARCH_SQL, re.sub(r"([\\%_])", r"\\\1", query) + "%"
+
+
+async def search_patients(query: str, limit: int) -> list[dict]:
+    """
+    Patients matching a partial name, email or phone number, best match
+    first.
+    """
+    sql, argument = patient_search_sql(query)
+    return await connections.get(read_connection()).execute_query_dict(sql, [argument, limit])
+
+
+# Doctor directory
+
+
+async def doctor_directory() -> dict:
+    return {"doctors": await Doctor.all().order_by("id").values("id", "name", "specialization")}
+
+
+# Slot directory
+
+
+async def doctor_slot_directory() -> list[dict]:
+    """
+    Every doctor that has slots, with the slots, from one joined query.
+    """
+    rows = await Slot.all().order_by("doctor_id_id", "id").values(
+        "id",
+        "available",
+        "day",
+        "slot_time",
+        "doctor_id_id",
+        "doctor_id__name",
+        "doctor_id__specialization",
+    )
+
+    directory: list[dict] = []
+    for row in rows:
+        if not directory or directory[-1]["doctor_id"] != row["doctor_id_id"]:
+            directory.append({
+                "doctor_id": row["doctor_id_id"],
+                "doctor_name": row["doctor_id__name"],
+                "specialization": row["doctor_id__specialization"],
+                "slots": [],
+            })
+        directory[-1]["slots"].append({
+            "id": row["id"],
+            "available": row["available"],
+            "day": row["day"],
+            "slot_time": row["slot_time"],
+        })
+    return directory
@@ -0,0 +1,99 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.database import DB_CONNECTION, DB_REPLICA
+
+# Read replica routing
+#
+# With POSTGRES_REPLICA_URL set, the ORM reads of GET/HEAD requests go to the
+# replica connection. Everything else, and every read made while handling a
+# write, stays on the primary. A client that wrote gets a cookie sending its
+# reads to the primary for REPLICA_READ_AFTER_WRITE seconds, covering the
+# replication lag so it reads its own writes.
+
+READ_AFTER_WRITE = float(os.getenv("REPLICA_READ_AFTER_WRITE", 5))
+PRIMARY_COOKIE = "read_primary_until"
+READ_METHODS = {"GET", "HEAD"}
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+read_from_replica: ContextVar[bool] = ContextVar("read_from_replica", default=False)
+
+
+class ReplicaRouter:
+    """
+    Tortoise connection router, see the "routers" key of the config
+    """
+
+    def db_for_read(self, model) -> str | None:
+        return DB_REPLICA if read_from_replica.get() else None
+
+    def db_for_write(self, model) -> str | None:
+        return None
+
+
+def read_connection() -> str:
+    """
+    Connection label for raw SQL reads, following the same routing
+    """
+    return DB_REPLICA if read_from_replica.get() else DB_CONNECTION
+
+
+@contextmanager
+def primary():
+    """
+    Read from the primary inside this block, whatever the request
+    """
+    token = read_from_replica.set(False)
+    try:
+        yield
+    finally:
+        read_from_replica.reset(token)
+
+
+def _reads_primary(scope: Scope) -> bool:
+    until = HTTPConnection(scope).cookies.get(PRIMARY_COOKIE, "")
+    try:
+        return float(until) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaReadMiddleware:
+    """
+    Routes the reads of GET/HEAD requests to the replica, and marks clients
+    whose write succeeded so they read from the primary for a while.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] not in READ_METHODS | WRITE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] in READ_METHODS:
+            token = read_from_replica.set(not _reads_primary(scope))
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                read_from_replica.reset(token)
+            return
+
+        async def send_marked(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = time.time() + READ_AFTER_WRITE
+                MutableHeaders(scope=message).append(
+                    "set-cookie",
+                    f"{PRIMARY_COOKIE}={until:.3f}; Max-Age={int(READ_AFTER_WRITE) + 1}; "
+                    "Path=/; HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_marked)
@@ -0,0 +1,103 @@
+from datetime import date, datetime, time, timedelta
+
+from tortoise.transactions import in_transaction
+
+from app.database import DB_CONNECTION
+
+# Bulk slot writes
+#
+# A doctor's week is dozens of slots. Instead of a query per slot, every
+# write below is a single statement over unnest()ed arrays, and a batch of
+# them runs in one transaction.
+
+# Updates moving slots (new slot_time or day) run in two phases, so slots
+# swapping or chaining their day and time never meet on SLOT_UNIQUE_INDEX
+# midway: the moved slots are first parked on a slot_time no real slot has,
+# returning the values they had, then updated with every value spelled out.
+PARK_SLOTS_SQL = """
+UPDATE "slot" s SET "slot_time" = '#' || s."id"
+FROM "slot" o, unnest($2::int[]) AS v("id")
+WHERE s."id" = v."id" AND o."id" = s."id" AND s."doctor_id_id" = $1
+RETURNING s."id", o."slot_time", o."day"
+"""
+
+# partial updates by id, NULL keeps the current value
+UPDATE_SLOTS_SQL = """
+UPDATE "slot" s SET
+    "available" = COALESCE(v."available", s."available"),
+    "slot_time" = COALESCE(v."slot_time", s."slot_time"),
+    "day" = COALESCE(v."day", s."day")
+FROM unnest($2::int[], $3::bool[], $4::text[], $5::text[]) AS v("id", "available", "slot_time", "day")
+WHERE s."id" = v."id" AND s."doctor_id_id" = $1
+RETURNING s."id", s."available", s."slot_time", s."day"
+"""
+
+# upsert keyed on (doctor, day, slot_time), see SLOT_UNIQUE_INDEX: an
+# existing slot only has its availability updated, the others are inserted.
+# A statement can only update a row once, the input holds each key once.
+UPSERT_SLOTS_SQL = """
+INSERT INTO "slot" ("doctor_id_id", "available", "slot_time", "day")
+SELECT $1, v."available", v."slot_time", v."day"
+FROM unnest($2::bool[], $3::text[], $4::text[]) WITH ORDINALITY AS v("available", "slot_time", "day", "n")
+ORDER BY v."n"
+ON CONFLICT ("doctor_id_id", "day", "slot_time") DO UPDATE SET "available" = EXCLUDED."available"
+RETURNING "id", "available", "slot_time", "day"
+"""
+
+
+async def write_slots(
+    doctor_id: int,
+    updates: list[tuple[int, bool | None, str | None, str | None]],
+    slots: list[tuple[bool, str, str]],
+) -> list[dict]:
+    """
+    Apply `updates` (id, available, slot_time, day) to existing slots of the
+    doctor and upsert `slots` (available, slot_time, day), in one transaction.
+    Returns the written slots, updates first. Unknown ids are skipped, the
+    last of repeated ids or (slot_time, day) wins. Raises IntegrityError on
+    SLOT_UNIQUE_INDEX when an update moves a slot onto one that stays.
+    """
+    updates = list({update[0]: update for update in updates}.values())
+    slots = list({(slot_time, day): (available, slot_time, day) for available, slot_time, day in slots}.values())
+    written: list[dict] = []
+    async with in_transaction(DB_CONNECTION) as connection:
+        moved = [update[0] for update in updates if update[2] is not None or update[3] is not None]
+        if moved:
+            parked = {
+                row["id"]: row for row in await connection.execute_query_dict(PARK_SLOTS_SQL, [doctor_id, moved])
+            }
+            updates = [
+                (
+                    id,
+                    available,
+                    parked[id]["slot_time"] if slot_time is None else slot_time,
+                    parked[id]["day"] if day is None else day,
+                )
+                if id in parked
+                else (id, available, slot_time, day)
+                for id, available, slot_time, day in updates
+            ]
+        if updates:
+            written += await connection.execute_query_dict(
+                UPDATE_SLOTS_SQL, [doctor_id, *map(list, zip(*updates))]
+            )
+        if slots:
+            written += await connection.execute_query_dict(
+                UPSERT_SLOTS_SQL, [doctor_id, *map(list, zip(*slots))]
+            )
+    return written
+
+
+def slot_times(start: time, end: time, every: int) -> list[str]:
+    """
+    Consecutive `every` minute slots from `start` up to `end`, formatted the
+    way the frontend stores them ("09:00:00-09:15:00").
+    """
+    step = timedelta(minutes=every)
+    current = datetime.combine(date.min, start)
+    last = datetime.combine(date.min, end)
+    times = []
+    while current + step <= last:
+        times.append(f"{current:%H:%M:%S}-{current + step:%H:%M:%S}")
+        current += step
+    return times
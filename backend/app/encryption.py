@@ -0,0 +1,243 @@
+import base64
+import io
+import os
+import struct
+from collections.abc import Iterator
+from typing import IO, Any, Protocol
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Record files at rest
+#
+# Every record gets its own random data key. The data key is stored on the
+# Records row wrapped (AES-GCM) with the master key from RECORD_ENCRYPTION_KEY,
+# which never touches the database. Without RECORD_ENCRYPTION_KEY files are
+# stored in plaintext, rows without a data key are plaintext files.
+#
+# A file is a header followed by the plaintext sealed in SEGMENT_SIZE segments
+# with AES-256-GCM (the STREAM construction): the nonce of a segment is the
+# random prefix from the header, the segment index and a flag set on the last
+# segment only, and the header is authenticated with every segment. Segments
+# cannot be reordered, dropped or truncated without failing authentication.
+# A nonce prefix seals each segment index once: an upload rewriting a segment
+# torn by a crash reseals the file under a new prefix first (reseal()).
+# Writing and reading hold one batch of segments at a time whatever the file
+# size, and a byte range is read by decrypting only the segments it covers.
+#
+#   header:  MAGIC | nonce prefix (7 bytes)
+#   segment: ciphertext of SEGMENT_SIZE plaintext bytes (less for the last) | tag
+
+MAGIC = b"CFR1"
+NONCE_PREFIX_SIZE = 7
+HEADER_SIZE = len(MAGIC) + NONCE_PREFIX_SIZE
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+SEALED_SEGMENT_SIZE = SEGMENT_SIZE + TAG_SIZE
+
+WRAPPED_KEY_VERSION = b"\x01"
+WRAPPED_KEY_AAD = b"careflow record data key"
+
+
+def _load_master_key() -> AESGCM | None:
+    value = os.getenv("RECORD_ENCRYPTION_KEY")
+    if not value:
+        return None
+    key = base64.urlsafe_b64decode(value)
+    if len(key) != 32:
+        raise ValueError("RECORD_ENCRYPTION_KEY must be 32 bytes, base64url encoded")
+    return AESGCM(key)
+
+
+_master_key = _load_master_key()
+
+
+def enabled() -> bool:
+    return _master_key is not None
+
+
+def new_data_key() -> tuple[bytes, str]:
+    """
+    A fresh data key, and its wrapped form to store.
+    """
+    if _master_key is None:
+        raise RuntimeError("RECORD_ENCRYPTION_KEY is needed to encrypt records")
+    key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    wrapped = WRAPPED_KEY_VERSION + nonce + _master_key.encrypt(nonce, key, WRAPPED_KEY_AAD)
+    return key, base64.urlsafe_b64encode(wrapped).decode()
+
+
+def unwrap_data_key(wrapped: str) -> bytes:
+    if _master_key is None:
+        raise RuntimeError("RECORD_ENCRYPTION_KEY is needed to read encrypted records")
+    data = base64.urlsafe_b64decode(wrapped)
+    if data[:1] != WRAPPED_KEY_VERSION:
+        raise ValueError("unknown data key version")
+    return _master_key.decrypt(data[1:13], data[13:], WRAPPED_KEY_AAD)
+
+
+def new_header() -> bytes:
+    return MAGIC + os.urandom(NONCE_PREFIX_SIZE)
+
+
+def segment_count(sealed_size: int) -> int:
+    # an empty file still has its (empty) last segment
+    return max(1, -(-(sealed_size - HEADER_SIZE) // SEALED_SEGMENT_SIZE))
+
+
+def plaintext_size(sealed_size: int) -> int:
+    """
+    Plaintext bytes in a complete sealed file of `sealed_size` bytes.
+    """
+    return sealed_size - HEADER_SIZE - segment_count(sealed_size) * TAG_SIZE
+
+
+def segment_offset(index: int) -> int:
+    return HEADER_SIZE + index * SEALED_SEGMENT_SIZE
+
+
+class SegmentCipher:
+    def __init__(self, key: bytes, header: bytes) -> None:
+        if len(header) != HEADER_SIZE or not header.startswith(MAGIC):
+            raise ValueError("not an encrypted record file")
+        self._aead = AESGCM(key)
+        self._header = header
+        self._prefix = header[len(MAGIC):]
+
+    def _nonce(self, index: int, last: bool) -> bytes:
+        return self._prefix + struct.pack(">IB", index, last)
+
+    def seal(self, index: int, plaintext: bytes | memoryview, last: bool) -> bytes:
+        return self._aead.encrypt(self._nonce(index, last), plaintext, self._header)
+
+    def open(self, index: int, sealed: bytes, last: bool) -> bytes:
+        # raises cryptography.exceptions.InvalidTag on tampering
+        return self._aead.decrypt(self._nonce(index, last), sealed, self._header)
+
+    @classmethod
+    def from_file(cls, f: IO[bytes], key: bytes) -> "SegmentCipher":
+        f.seek(0)
+        return cls(key, f.read(HEADER_SIZE))
+
+
+class RecordWriter:
+    """
+    Writes the plaintext of a record to `f` from segment `index` on, sealed
+    when a cipher is given, and hashes it. Blocking, called off the event
+    loop. Unless `last` is set, writes must be whole segments (`align`).
+    """
+
+    def __init__(self, f: IO[bytes], hasher: Any = None, cipher: SegmentCipher | None = None, index: int = 0) -> None:
+        self._f = f
+        self._hasher = hasher
+        self._cipher = cipher
+        self._index = index
+
+    @property
+    def align(self) -> int:
+        return 1 if self._cipher is None else SEGMENT_SIZE
+
+    def write(self, data: bytes, last: bool) -> None:
+        if self._hasher is not None:
+            self._hasher.update(data)
+        if self._cipher is None:
+            self._f.write(data)
+            return
+        if not last and len(data) % SEGMENT_SIZE:
+            raise ValueError("only the last write may end inside a segment")
+        view = memoryview(data)
+        sealed = bytearray()
+        # the last write always ends with a last segment, even an empty one
+        starts = range(0, len(data), SEGMENT_SIZE) if data or not last else [0]
+        for start in starts:
+            segment = view[start:start + SEGMENT_SIZE]
+            is_last = last and start + SEGMENT_SIZE >= len(data)
+            sealed += self._cipher.seal(self._index, segment, is_last)
+            self._index += 1
+        self._f.write(sealed)
+
+
+def read_plaintext(
+    f: IO[bytes], cipher: SegmentCipher, start: int, end: int, segments: int | None, batch: int
+) -> Iterator[bytes]:
+    """
+    Yield the plaintext bytes [start, end) of the sealed file `f` made of
+    `segments` segments (None while it is still being written), in pieces of
+    about `batch` bytes.
+    """
+    if end <= start:
+        return
+    first, last = start // SEGMENT_SIZE, (end - 1) // SEGMENT_SIZE
+    last_segment = segments - 1 if segments is not None else -1
+    f.seek(segment_offset(first))
+    pending = bytearray()
+    for index in range(first, last + 1):
+        plaintext = cipher.open(index, f.read(SEALED_SEGMENT_SIZE), index == last_segment)
+        base = index * SEGMENT_SIZE
+        pending += plaintext[max(start - base, 0):end - base]
+        if len(pending) >= batch:
+            yield bytes(pending)
+            pending.clear()
+    if pending:
+        yield bytes(pending)
+
+
+class Writable(Protocol):
+    def write(self, data: bytes, /) -> Any: ...
+
+
+def decrypt_file(source: str, target: Writable, key: bytes, hasher: Any = None) -> int:
+    """
+    Decrypt the complete sealed file at `source` into `target`, return the
+    plaintext size.
+    """
+    with open(source, "rb") as f:
+        cipher = SegmentCipher.from_file(f, key)
+        size = os.fstat(f.fileno()).st_size
+        written = 0
+        for piece in read_plaintext(f, cipher, 0, plaintext_size(size), segment_count(size), 1024 * 1024):
+            if hasher is not None:
+                hasher.update(piece)
+            target.write(piece)
+            written += len(piece)
+    return written
+
+
+def reseal(source: IO[bytes], target: IO[bytes], key: bytes, segments: int) -> SegmentCipher:
+    """
+    Copy the first `segments` segments (whole, none of them last) of the
+    sealed file `source` to `target` under a new header, and return the
+    cipher of the copy. Segments after them can then be sealed again without
+    reusing a nonce of `source`.
+    """
+    sealed = SegmentCipher.from_file(source, key)
+    header = new_header()
+    cipher = SegmentCipher(key, header)
+    target.write(header)
+    for index in range(segments):
+        plaintext = sealed.open(index, source.read(SEALED_SEGMENT_SIZE), False)
+        target.write(cipher.seal(index, plaintext, False))
+    return cipher
+
+
+def seal_bytes(data: bytes, key: bytes) -> bytes:
+    """
+    A small plaintext (a preview) as a complete sealed file, in memory.
+    """
+    header = new_header()
+    out = io.BytesIO(header)
+    out.seek(0, os.SEEK_END)
+    RecordWriter(out, cipher=SegmentCipher(key, header)).write(data, True)
+    return out.getvalue()
+
+
+def open_bytes(data: bytes, key: bytes) -> bytes:
+    f = io.BytesIO(data)
+    cipher = SegmentCipher.from_file(f, key)
+    size = len(data)
+    return b"".join(read_plaintext(f, cipher, 0, plaintext_size(size), segment_count(size), size))
+
+
+if __name__ == "__main__":
+    # python -m app.encryption prints a new RECORD_ENCRYPTION_KEY
+    print(base64.urlsafe_b64encode(AESGCM.generate_key(bit_length=256)).decode())
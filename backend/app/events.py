@@ -0,0 +1,253 @@
+import asyncio
+import inspect
+import logging
+import os
+from collections import defaultdict
+from collections.abc import AsyncIterator, Callable, Iterable
+from datetime import date
+
+import asyncpg
+import orjson
+from fastapi.responses import StreamingResponse
+from tortoise import connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+
+from app.database import Appointment, fk_id
+from app.serialization import dumps
+
+# Server-Sent Events
+#
+# Handlers publish an event after changing an appointment. With postgres the
+# event goes through NOTIFY, and every worker LISTENs on one dedicated
+# connection and fans the events out to its own SSE subscribers, so a write
+# handled by one worker reaches the clients connected to all of them.
+# Without postgres (local runs) events stay in the process.
+#
+# A subscriber is a bounded queue registered under its topics. The frame of
+# an event is encoded once and shared by every subscriber. An idle stream
+# costs its queue and a heartbeat every EVENTS_HEARTBEAT seconds. Events are
+# not replayed, clients reload their list when they (re)connect.
+#
+# In-process state derived from the events (the occupancy calendar of
+# app/occupancy.py) registers a handler, called with every event of every
+# worker.
+
+CHANNEL = "careflow_events"
+HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", 20))
+# events buffered per subscriber, a client that falls further behind is
+# disconnected and reconnects
+QUEUE_SIZE = 64
+RECONNECT_MAX_DELAY = 30
+
+logger = logging.getLogger("careflow.events")
+
+
+class Subscriber:
+    def __init__(self, topics: Iterable[str]) -> None:
+        self.topics = tuple(topics)
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(QUEUE_SIZE)
+        self.dropped = False
+
+
+class Broker:
+    def __init__(self) -> None:
+        self._subscribers: defaultdict[str, set[Subscriber]] = defaultdict(set)
+        self._connection_label: str | None = None
+        self._listener: asyncio.Task | None = None
+        self._handlers: list[Callable[[dict], None]] = []
+
+    # subscribers
+
+    def subscribe(self, topics: Iterable[str]) -> Subscriber:
+        subscriber = Subscriber(topics)
+        for topic in subscriber.topics:
+            self._subscribers[topic].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        for topic in subscriber.topics:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    @property
+    def subscriber_count(self) -> int:
+        return len({s for subscribers in self._subscribers.values() for s in subscribers})
+
+    def on_event(self, handler: Callable[[dict], None]) -> None:
+        self._handlers.append(handler)
+
+    def _dispatch(self, message: str | bytes) -> None:
+        envelope = orjson.loads(message)
+        event = envelope["event"]
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("%s event handler failed", event["type"])
+        frame = b"event: " + event["type"].encode() + b"\ndata: " + dumps(event) + b"\n\n"
+        receivers: set[Subscriber] = set()
+        for topic in envelope["topics"]:
+            receivers.update(self._subscribers.get(topic, ()))
+        for subscriber in receivers:
+            try:
+                subscriber.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    # publishing
+
+    async def publish(self, topics: list[str], event: dict) -> None:
+        """
+        Send `event` to the subscribers of any of `topics`, in every worker.
+        Never raises, the change it reports is already committed.
+        """
+        message = notify_message(topics, event)
+        label = self._connection_label
+        if self._listener is None or label is None:
+            self._dispatch(message)
+            return
+        try:
+            await connections.get(label).execute_query(
+                "SELECT pg_notify($1, $2)", [CHANNEL, message]
+            )
+        except Exception:
+            logger.exception("could not publish %s event", event["type"])
+
+    # cross worker fan-out
+
+    async def start(self, connection_label: str) -> None:
+        client = connections.get(connection_label)
+        if not isinstance(client, AsyncpgDBClient):
+            return
+        self._connection_label = connection_label
+        self._listener = asyncio.create_task(self._listen(client))
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._dispatch(payload)
+
+    async def _listen(self, client: AsyncpgDBClient) -> None:
+        # a connection of its own, outside the pool, with the pool's settings
+        accepted = inspect.signature(asyncpg.connect).parameters
+        params = {
+            "host": client.host,
+            "port": client.port,
+            "user": client.user,
+            "password": client.password,
+            "database": client.database,
+            "connection_class": client.connection_class,
+            **{key: value for key, value in client.extra.items() if key in accepted},
+            # filled in (search_path, application_name) once the pool is created
+            "server_settings": client.server_settings,
+        }
+        delay = 1
+        while True:
+            try:
+                connection = await asyncpg.connect(**params)
+                try:
+                    lost = asyncio.Event()
+                    connection.add_termination_listener(lambda _: lost.set())
+                    await connection.add_listener(CHANNEL, self._on_notify)
+                    delay = 1
+                    await lost.wait()
+                finally:
+                    if not connection.is_closed():
+                        await connection.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("event listener connection failed")
+            # events published meanwhile are missed, clients catch up on reconnect
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    # SSE
+
+    def stream(self, topics: list[str]) -> StreamingResponse:
+        """
+        An SSE response carrying the events of `topics` until the client
+        goes away.
+        """
+
+        async def frames() -> AsyncIterator[bytes]:
+            subscriber = self.subscribe(topics)
+            try:
+                yield b"retry: 3000\n\n"
+                while not subscriber.dropped:
+                    try:
+                        yield await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT)
+                    except TimeoutError:
+                        yield b": ping\n\n"
+            finally:
+                self.unsubscribe(subscriber)
+
+        return StreamingResponse(
+            frames(),
+            media_type="text/event-stream",
+            headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+        )
+
+
+broker = Broker()
+
+
+def notify_message(topics: list[str], event: dict) -> str:
+    """
+    The NOTIFY payload carrying `event` to the subscribers of `topics`.
+    """
+    return dumps({"topics": topics, "event": event}).decode()
+
+
+def appointment_event(
+    id: int,
+    status: str,
+    appointment_date: date,
+    reschedule_date: date | None,
+    patient_id: int,
+    doctor_id: int,
+    slot_id: int,
+) -> tuple[list[str], dict]:
+    """
+    Topics and event telling the patient, the doctor and the receptionists
+    that an appointment was created or changed. Carries the fields needed to
+    update a list in place, NOTIFY payloads are limited to 8000 bytes.
+    """
+    return (
+        ["appointments", f"patient:{patient_id}", f"doctor:{doctor_id}"],
+        {
+            "type": "appointment",
+            "id": id,
+            "status": status,
+            "appointment_date": appointment_date,
+            "reschedule_date": reschedule_date,
+            "patient_id": patient_id,
+            "doctor_id": doctor_id,
+            "slot_id": slot_id,
+        },
+    )
+
+
+async def publish_appointment(appointment: Appointment) -> None:
+    """
+    Publish the appointment event of a created or changed appointment.
+    """
+    await broker.publish(
+        *appointment_event(
+            appointment.id,
+            appointment.status,
+            appointment.appointment_date,
+            appointment.reschedule_date,
+            fk_id(appointment, "patient_id"),
+            fk_id(appointment, "doctor_id"),
+            fk_id(appointment, "slot_id"),
+        )
+    )
@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import os
+import random
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+import orjson
+from tortoise import connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import IntegrityError
+
+from app.database import DB_CONNECTION, Appointment, AppointmentStatusEnum, Job, Records, Reminder
+from app.events import broker
+from app.encryption import unwrap_data_key
+from app.metadata import describe_file
+from app.storage import PREVIEW_DIR, UPLOAD_DIR
+
+# Background jobs
+#
+# Work that must not run inside a request is stored as rows of the job table
+# and run by a worker task in every app process (JOBS_ENABLED=0 turns it off,
+# e.g. to run jobs on dedicated processes only). Workers claim due jobs in
+# batches with FOR UPDATE SKIP LOCKED, so any number of processes share the
+# queue without handing out a job twice. Claiming pushes run_at forward by
+# JOB_LEASE seconds: a job whose worker died becomes due again once the lease
+# runs out. A failed job is retried with exponential backoff until it has
+# been attempted JOB_MAX_ATTEMPTS times, then it is marked FAILED.
+#
+# Needs postgres, the worker is not started on other databases.
+
+ENABLED = os.getenv("JOBS_ENABLED", "1") == "1"
+BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", 20))
+POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", 5))
+LEASE = int(os.getenv("JOB_LEASE", 300))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 8))
+BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", 30))
+BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", 6 * 3600))
+
+# follow-up reminders
+FOLLOWUP_AFTER_DAYS = int(os.getenv("FOLLOWUP_AFTER_DAYS", 30))
+FOLLOWUP_SCAN_INTERVAL = int(os.getenv("FOLLOWUP_SCAN_INTERVAL", 3600))
+
+logger = logging.getLogger("careflow.jobs")
+
+CLAIM_SQL = """
+UPDATE "job" SET "run_at" = now() + make_interval(secs => $2), "attempts" = "attempts" + 1
+WHERE "id" IN (
+    SELECT "id" FROM "job"
+    WHERE "status" = 'PENDING' AND "run_at" <= now()
+    ORDER BY "run_at"
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING "id", "kind", "payload", "attempts"
+"""
+
+COMPLETE_SQL = """UPDATE "job" SET "status" = 'DONE', "last_error" = NULL WHERE "id" = ANY($1::bigint[])"""
+
+RESCHEDULE_SQL = """
+UPDATE "job" SET "run_at" = now() + make_interval(secs => $2), "attempts" = 0, "last_error" = NULL
+WHERE "id" = $1
+"""
+
+RETRY_SQL = """
+UPDATE "job" SET "run_at" = now() + make_interval(secs => $2), "last_error" = $3
+WHERE "id" = $1
+"""
+
+FAIL_SQL = """UPDATE "job" SET "status" = 'FAILED', "last_error" = $2 WHERE "id" = $1"""
+
+# one reminder per DONE appointment with a prescription, due FOLLOWUP_AFTER_DAYS
+# after the visit. Only visits whose reminder is not overdue yet are looked at.
+SCAN_FOLLOWUPS_SQL = """
+INSERT INTO "job" ("kind", "key", "payload", "status", "run_at", "attempts", "created_at")
+SELECT 'followup_reminder', 'followup_reminder:' || a."id",
+       jsonb_build_object('appointment_id', a."id"), 'PENDING',
+       COALESCE(a."reschedule_date", a."appointment_date") + make_interval(days => $1), 0, now()
+FROM "appointment" a
+WHERE a."status" = 'DONE'
+  AND COALESCE(a."reschedule_date", a."appointment_date") >= current_date - $1::int
+  AND EXISTS (SELECT 1 FROM "prescription" p WHERE p."appointment_id_id" = a."id")
+ON CONFLICT ("key") DO NOTHING
+"""
+
+Handler = Callable[[dict], Awaitable[None]]
+
+HANDLERS: dict[str, Handler] = {}
+# kind -> seconds between runs, rescheduled instead of completed
+RECURRING: dict[str, int] = {}
+
+
+def job(kind: str, every: int | None = None) -> Callable[[Handler], Handler]:
+    """
+    Register the handler of a job kind. With `every` the job recurs: one row
+    keyed by its kind, run every `every` seconds.
+    """
+
+    def register(handler: Handler) -> Handler:
+        HANDLERS[kind] = handler
+        if every is not None:
+            RECURRING[kind] = every
+        return handler
+
+    return register
+
+
+async def enqueue(kind: str, payload: dict, run_at: datetime | None = None, key: str | None = None) -> None:
+    """
+    Store a job, due at `run_at` (now by default). A job with the same `key`
+    already stored makes this a no-op. A single INSERT, cheap enough for
+    request handlers.
+    """
+    try:
+        await Job.create(kind=kind, key=key, payload=payload, run_at=run_at or datetime.now(timezone.utc))
+    except IntegrityError:
+        if key is None:
+            raise
+
+
+def backoff(attempts: int) -> float:
+    # exponential, with jitter so failures of one batch do not retry together
+    delay = min(BACKOFF_BASE * 2 ** min(attempts - 1, 20), BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+class Worker:
+    def __init__(self) -> None:
+        self._connection_label: str | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, connection_label: str) -> None:
+        if not ENABLED:
+            return
+        if not isinstance(connections.get(connection_label), AsyncpgDBClient):
+            logger.info("job worker not started, it needs postgres")
+            return
+        self._connection_label = connection_label
+        for kind in RECURRING:
+            await enqueue(kind, {}, key=kind)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("job worker failed to claim jobs")
+                claimed = 0
+            # a full batch means more jobs are probably due
+            if claimed < BATCH_SIZE:
+                await asyncio.sleep(random.uniform(POLL_INTERVAL / 2, POLL_INTERVAL))
+
+    def _connection(self) -> BaseDBAsyncClient:
+        if self._connection_label is None:
+            raise RuntimeError("job worker is not started")
+        return connections.get(self._connection_label)
+
+    async def run_once(self) -> int:
+        """
+        Claim a batch of due jobs and run them. Returns the number claimed.
+        """
+        connection = self._connection()
+        rows = await connection.execute_query_dict(CLAIM_SQL, [BATCH_SIZE, float(LEASE)])
+        if not rows:
+            return 0
+        outcomes = await asyncio.gather(*(self._execute(row) for row in rows))
+        done = [row["id"] for row, ok in zip(rows, outcomes) if ok and row["kind"] not in RECURRING]
+        if done:
+            await connection.execute_query(COMPLETE_SQL, [done])
+        return len(rows)
+
+    async def _execute(self, row: dict) -> bool:
+        connection = self._connection()
+        kind = row["kind"]
+        handler = HANDLERS.get(kind)
+        # recurring jobs keep retrying, capped by BACKOFF_MAX
+        exhausted = row["attempts"] >= MAX_ATTEMPTS and kind not in RECURRING
+        error = None
+        if handler is None:
+            error = f"no handler for job kind {kind!r}"
+        elif exhausted and row["attempts"] > MAX_ATTEMPTS:
+            # only reached when the workers running it kept dying
+            error = "lease expired too many times"
+        else:
+            payload = row["payload"]
+            if isinstance(payload, str):
+                payload = orjson.loads(payload)
+            try:
+                # finish well within the lease, or another worker picks it up
+                async with asyncio.timeout(LEASE / 2):
+                    await handler(payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("job %s (%s) failed", row["id"], kind)
+                error = f"{type(e).__name__}: {e}"
+
+        if error is None:
+            if kind in RECURRING:
+                await connection.execute_query(RESCHEDULE_SQL, [row["id"], float(RECURRING[kind])])
+            return True
+        if handler is None or exhausted:
+            await connection.execute_query(FAIL_SQL, [row["id"], error])
+        else:
+            await connection.execute_query(RETRY_SQL, [row["id"], backoff(row["attempts"]), error])
+        return False
+
+
+worker = Worker()
+
+
+# follow-up checkup reminders
+
+
+@job("scan_followups", every=FOLLOWUP_SCAN_INTERVAL)
+async def scan_followups(payload: dict) -> None:
+    await connections.get(DB_CONNECTION).execute_query(SCAN_FOLLOWUPS_SQL, [FOLLOWUP_AFTER_DAYS])
+
+
+@job("followup_reminder")
+async def followup_reminder(payload: dict) -> None:
+    appointment = await Appointment.get_or_none(id=payload["appointment_id"]).values(
+        "id", "patient_id_id", "doctor_id_id", "appointment_date", "reschedule_date", "doctor_id__name"
+    )
+    if not appointment:
+        return
+    # a later appointment with the same doctor is the follow-up already
+    if await Appointment.filter(
+        patient_id=appointment["patient_id_id"],
+        doctor_id=appointment["doctor_id_id"],
+        id__gt=appointment["id"],
+        status__in=[AppointmentStatusEnum.PENDING, AppointmentStatusEnum.BOOKED, AppointmentStatusEnum.DONE],
+    ).exists():
+        return
+    await send_followup_reminder(appointment)
+
+
+async def send_followup_reminder(appointment: dict[str, Any]) -> None:
+    visit_date = appointment["reschedule_date"] or appointment["appointment_date"]
+    due = visit_date + timedelta(days=FOLLOWUP_AFTER_DAYS)
+    logger.info(
+        "follow-up reminder for patient %s, visit %s on %s",
+        appointment["patient_id_id"], appointment["id"], visit_date,
+    )
+    # stored first, the patient reads it from GET /patient/reminders whether
+    # or not an event stream was open. A retry finds the row written.
+    try:
+        reminder = await Reminder.create(
+            patient_id_id=appointment["patient_id_id"],
+            appointment_id_id=appointment["id"],
+            kind="followup",
+            due=due,
+        )
+    except IntegrityError:
+        return
+    await broker.publish(
+        [f"patient:{appointment['patient_id_id']}"],
+        {
+            "type": "reminder",
+            "id": reminder.id,
+            "kind": "followup",
+            "appointment_id": appointment["id"],
+            "doctor_id": appointment["doctor_id_id"],
+            "doctor_name": appointment["doctor_id__name"],
+            "visit_date": visit_date,
+            "due": due,
+        },
+    )
+
+
+# record metadata
+
+
+@job("record_metadata")
+async def record_metadata(payload: dict) -> None:
+    record = await Records.get_or_none(id=payload["record_id"]).values("id", "file_name", "checksum", "data_key")
+    if not record or not record["file_name"]:
+        return
+    metadata = await describe_file(
+        os.path.join(UPLOAD_DIR, record["file_name"]),
+        os.path.join(PREVIEW_DIR, f"{record['id']}.webp"),
+        # uploads hash while streaming, older rows have no checksum yet
+        with_checksum=record["checksum"] is None,
+        key=unwrap_data_key(record["data_key"]) if record["data_key"] else None,
+    )
+    await Records.filter(id=record["id"]).update(**metadata)
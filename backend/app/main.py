@@ -4,38 +4,67 @@ import os
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, status
-from fastapi.responses import PlainTextResponse
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from tortoise import Tortoise
-from tortoise.backends.base.config_generator import generate_config
 from tortoise.contrib.fastapi import RegisterTortoise, tortoise_exception_handlers
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.database import DB_CONNECTION, DB_REPLICA
+from app.database.instrumentation import QueryTimingMiddleware
+from app.database.migrations import ensure_schema
+from app.database.pool import database_config, ping, pool_stats, warm_pool
+from app.database.routing import ReplicaReadMiddleware
+from app.events import broker
+from app.jobs import worker
+from app.metrics import MetricsMiddleware, exposition, sampler
+from app.occupancy import calendar
+from app import metadata
+from app.admission import AdmissionMiddleware
 from app.routers import admin, patient, record, doctor ,receptionist,prescription
 
+# optional read replica for the GET endpoints
+REPLICA_URL = os.getenv("POSTGRES_REPLICA_URL")
+
 # logging.basicConfig(level=logging.INFO)
 # logger = logging.getLogger("tortoise")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
-    config = generate_config(
+    config = database_config(
         db_url=os.getenv(
             "POSTGRES_URL",
             "This string should not be accessed!",
         ),
-        app_modules={"models": ["app.database"]},
-        testing=True,
-        connection_label="postgresrailway",
+        connection_label=DB_CONNECTION,
+        replica_url=REPLICA_URL,
     )
     async with RegisterTortoise(
         app=app,
         config=config,
-        generate_schemas=True,
         # _create_db=True,
     ):
-        # db connected
+        # db connected, schema checked against its stored version
+        await ensure_schema(DB_CONNECTION)
+        await warm_pool(DB_CONNECTION)
+        if REPLICA_URL:
+            await warm_pool(DB_REPLICA)
+        await broker.start(DB_CONNECTION)
+        # after the broker, no slot or appointment event is missed
+        await calendar.load()
+        await worker.start(DB_CONNECTION)
+        await sampler.start([DB_CONNECTION, DB_REPLICA] if REPLICA_URL else [DB_CONNECTION])
+        # start the thread pool of sync endpoints and dependencies, or the
+        # first request waits for it
+        await anyio.to_thread.run_sync(lambda: None)
         yield
+        await sampler.stop()
+        await calendar.stop()
+        await worker.stop()
+        metadata.shutdown()
+        await broker.stop()
         # app teardown
     # db connections closed
     await Tortoise.close_connections()
@@ -55,6 +84,9 @@ origins = [
     "http://localhost:5173",
 ]
 
+# rate limits and load shedding, inside CORS so browsers can read the 429/503
+app.add_middleware(AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -63,16 +95,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if REPLICA_URL:
+    app.add_middleware(ReplicaReadMiddleware)
+
+app.add_middleware(MetricsMiddleware)
+
+# added last, so outermost: the Server-Timing total covers the other
+# middleware, request metrics included
+app.add_middleware(QueryTimingMiddleware)
+
 
 @app.get("/")
 def read_root() -> PlainTextResponse:
     return PlainTextResponse("careflow backend api v1.0", status.HTTP_200_OK)
 
-app.mount("/uploaded_records", StaticFiles(directory="uploaded_records"), name="uploaded_records")
+
+@app.get("/health")
+async def health():
+    """
+    Database round trip and pool usage, 503 when the database is unreachable
+    """
+    labels = [DB_CONNECTION, DB_REPLICA] if REPLICA_URL else [DB_CONNECTION]
+    databases = {}
+    for label in labels:
+        try:
+            latency = await ping(label)
+        except Exception:
+            raise HTTPException(status_code=503, detail=f"Database {label} unavailable")
+        databases[label] = {"latency_ms": round(latency, 2), "pool": pool_stats(label)}
+    return {"status": "ok", "databases": databases}
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics() -> Response:
+    """
+    Prometheus metrics, see app/metrics.py
+    """
+    content, content_type = exposition()
+    return Response(content, media_type=content_type)
+
 # add routes here
 app.include_router(admin.router)
 app.include_router(patient.router)
 app.include_router(record.router)
+app.include_router(record.files_router)
 app.include_router(doctor.router)
 app.include_router(receptionist.router)
 app.include_router(prescription.router)
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import io
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any
+
+from app import encryption
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Record metadata
+#
+# After an upload is saved a record_metadata job (app/jobs.py) sniffs the MIME
+# type, counts pages and renders a preview of the first page, and stores them
+# on the Records row, so list views never open the file. Decoding PDFs and
+# images is CPU bound, it runs in a process pool of RECORD_PROCESSES workers
+# instead of the event loop. Only PIL, pypdfium2, app.encryption and the
+# standard library are imported here, pool workers import this module on their
+# own. PIL and pypdfium2 are imported by the first decode, the web process
+# never loads them.
+#
+# Plaintext of an encrypted record never touches the disk: it is decrypted
+# into memory and decoded from there, up to RECORD_DECODE_MAX_SIZE bytes
+# (larger ones only get their MIME type, size and checksum). Previews are
+# rendered in memory, sealed with the record's data key and then written
+# under a temporary name renamed into place, so a killed worker leaves no
+# half written or plaintext preview behind.
+
+PROCESSES = int(os.getenv("RECORD_PROCESSES", 1))
+# longest side of a preview, in pixels
+PREVIEW_SIZE = int(os.getenv("RECORD_PREVIEW_SIZE", 320))
+PREVIEW_FORMAT = "WEBP"
+# largest encrypted record decrypted in memory to be decoded
+MAX_DECODE_SIZE = int(os.getenv("RECORD_DECODE_MAX_SIZE", 64 * 1024 * 1024))
+# bytes the MIME type is sniffed from
+HEADER_SIZE = 2048
+
+# (offset, magic bytes, MIME type)
+SIGNATURES = [
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"BM", "image/bmp"),
+    (4, b"ftypheic", "image/heic"),
+    (128, b"DICM", "application/dicom"),
+    (0, b"PK\x03\x04", "application/zip"),
+]
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def _is_text(header: bytes) -> bool:
+    if b"\x00" in header:
+        return False
+    try:
+        header.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # only a multibyte character cut off by the end of the header
+        return e.reason == "unexpected end of data"
+    return True
+
+
+def sniff_mime_type(header: bytes, file_name: str) -> str:
+    """
+    MIME type of a file from its first bytes, the name only breaks ties.
+    """
+    # the PDF header may come after some junk bytes
+    if b"%PDF-" in header[:1024]:
+        return "application/pdf"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    guessed, _ = mimetypes.guess_type(file_name)
+    for offset, magic, mime_type in SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            # docx, xlsx, ... are zip files as well
+            if mime_type == "application/zip" and guessed:
+                return guessed
+            return mime_type
+    if _is_text(header):
+        return guessed if guessed and guessed.startswith("text/") else "text/plain"
+    return guessed or "application/octet-stream"
+
+
+def _render_preview(image: "Image.Image") -> bytes:
+    image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    out = io.BytesIO()
+    image.save(out, PREVIEW_FORMAT, quality=75)
+    return out.getvalue()
+
+
+def _pdf_metadata(source: str | bytes) -> tuple[int, bytes | None]:
+    import pypdfium2
+
+    pdf = pypdfium2.PdfDocument(source)
+    try:
+        page_count = len(pdf)
+        if not page_count:
+            return 0, None
+        page = pdf[0]
+        width, height = page.get_size()
+        # render straight at preview size, 1.0 is 72 dpi
+        scale = PREVIEW_SIZE / max(width, height, 1)
+        return page_count, _render_preview(page.render(scale=scale).to_pil())
+    finally:
+        pdf.close()
+
+
+def _image_metadata(source: str | bytes) -> tuple[int, bytes | None]:
+    from PIL import Image, ImageOps
+
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        page_count = getattr(image, "n_frames", 1)
+        # JPEGs decode at a reduced scale, much faster than full size
+        image.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+        return page_count, _render_preview(ImageOps.exif_transpose(image))
+
+
+def _sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class _Plaintext:
+    """
+    decrypt_file() target keeping the plaintext in memory, dropped past
+    `limit` bytes. The header is kept whatever the size.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.header = bytearray()
+        self.data: bytearray | None = bytearray()
+
+    def write(self, piece: bytes) -> None:
+        if len(self.header) < HEADER_SIZE:
+            self.header += piece[:HEADER_SIZE - len(self.header)]
+        if self.data is not None:
+            if len(self.data) + len(piece) > self.limit:
+                self.data = None
+            else:
+                self.data += piece
+
+
+def _describe(
+    source: str | bytes | None, header: bytes, size: int, file_name: str
+) -> tuple[dict[str, Any], bytes | None]:
+    """
+    Metadata of a file and its preview image. `source` is its path, its
+    content, or None when it is not to be decoded.
+    """
+    metadata: dict[str, Any] = {
+        "size": size,
+        "mime_type": sniff_mime_type(header, file_name),
+        "page_count": None,
+        "preview": None,
+    }
+    if metadata["mime_type"] == "application/pdf":
+        describe = _pdf_metadata
+    elif metadata["mime_type"].startswith("image/"):
+        describe = _image_metadata
+    else:
+        return metadata, None
+    if source is None:
+        return metadata, None
+    try:
+        page_count, preview = describe(source)
+    except ImportError:
+        raise
+    except Exception:
+        # corrupt or unsupported (encrypted PDF, HEIC without a plugin, ...)
+        return metadata, None
+    metadata["page_count"] = page_count
+    return metadata, preview
+
+
+def _write_preview(preview_path: str, data: bytes) -> None:
+    # readers see the previous file or the complete new one, never a part
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(preview_path) or ".", suffix=".partial")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(partial, preview_path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+def extract_metadata(path: str, preview_path: str, with_checksum: bool, key: bytes | None = None) -> dict[str, Any]:
+    """
+    Metadata of the record file at `path`, writing its preview to
+    `preview_path`. Runs in a pool worker. A file that cannot be decoded
+    still gets its MIME type and size. `key` is the data key of an
+    encrypted record, whose preview is sealed with it.
+    """
+    file_name = os.path.basename(path)
+    if key is None:
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        metadata, preview = _describe(path, header, os.stat(path).st_size, file_name)
+        if with_checksum:
+            metadata["checksum"] = _sha256(path)
+    else:
+        hasher = hashlib.sha256() if with_checksum else None
+        plaintext = _Plaintext(MAX_DECODE_SIZE)
+        size = encryption.decrypt_file(path, plaintext, key, hasher)
+        source = None if plaintext.data is None else bytes(plaintext.data)
+        plaintext.data = None
+        metadata, preview = _describe(source, bytes(plaintext.header), size, file_name)
+        if hasher is not None:
+            metadata["checksum"] = hasher.hexdigest()
+        if preview is not None:
+            preview = encryption.seal_bytes(preview, key)
+
+    if preview is not None:
+        _write_preview(preview_path, preview)
+        metadata["preview"] = os.path.basename(preview_path)
+    return metadata
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # forkserver: never fork the running event loop and its threads
+        _executor = ProcessPoolExecutor(
+            max_workers=PROCESSES,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    return _executor
+
+
+async def describe_file(
+    path: str, preview_path: str, with_checksum: bool, key: bytes | None = None
+) -> dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), extract_metadata, path, preview_path, with_checksum, key)
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.database.pool import pool_stats
+
+# Prometheus metrics, served at /metrics
+#
+# Requests are timed by route template (/patient/record/{id}, not the path),
+# so the number of series stays fixed. A sampler task wakes up every
+# METRICS_SAMPLE_INTERVAL seconds: how late it wakes up is the event loop
+# lag, high when something blocks the loop, and it reads the pool usage.
+# Waiting tasks with no idle connection means the pool is starved.
+#
+# With several worker processes, set PROMETHEUS_MULTIPROC_DIR to an empty
+# directory shared by them (wiped on every deploy) and any worker answers
+# for all of them.
+
+SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", 1))
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+REQUEST_DURATION = Histogram(
+    "careflow_http_request_duration_seconds",
+    "Time from the request to the end of its response",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "careflow_http_requests_in_progress",
+    "Requests being handled",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+POOL_CONNECTIONS = Gauge(
+    "careflow_db_pool_connections",
+    "Open connections of the pool, by state (idle, in_use)",
+    ["connection", "state"],
+    multiprocess_mode="livesum",
+)
+POOL_MAX_SIZE = Gauge(
+    "careflow_db_pool_max_size",
+    "Most connections the pool opens",
+    ["connection"],
+    multiprocess_mode="livesum",
+)
+POOL_WAITING = Gauge(
+    "careflow_db_pool_waiting",
+    "Tasks waiting for a connection of the pool",
+    ["connection"],
+    multiprocess_mode="livesum",
+)
+EVENT_LOOP_LAG = Histogram(
+    "careflow_event_loop_lag_seconds",
+    "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+REJECTED_REQUESTS = Counter(
+    "careflow_http_requests_rejected",
+    "Requests turned away by admission control (app/admission.py), by reason",
+    ["reason"],
+)
+UPLOAD_BYTES = Counter(
+    "careflow_record_upload_bytes",
+    "Bytes of record files uploaded",
+)
+UPLOAD_SIZE = Histogram(
+    "careflow_record_upload_size_bytes",
+    "Size of uploaded record files",
+    buckets=(1e4, 1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8),
+)
+UPLOAD_DURATION = Histogram(
+    "careflow_record_upload_duration_seconds",
+    "Time from the upload request to the stored file, receiving the body included",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+def exposition() -> tuple[bytes, str]:
+    """
+    The metrics in the text format, and its content type.
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def observe_upload(request: Request, size: int) -> None:
+    UPLOAD_BYTES.inc(size)
+    UPLOAD_SIZE.observe(size)
+    started = getattr(request.state, "started", None)
+    if started is not None:
+        UPLOAD_DURATION.observe(time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """
+    Times every request by route and counts the ones in flight.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        # request.state.started, for metrics measured in handlers
+        scope.setdefault("state", {})["started"] = started
+        status = 500
+
+        async def send_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(scope["method"])
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            in_progress.dec()
+            # set by the router once a route matched, static files have none
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                scope["method"], getattr(route, "path", "other"), str(status)
+            ).observe(time.perf_counter() - started)
+
+
+class Sampler:
+    def __init__(self) -> None:
+        self._connection_labels: list[str] = []
+        self._task: asyncio.Task | None = None
+        # seconds the last sample woke up late
+        self.loop_lag = 0.0
+
+    async def start(self, connection_labels: list[str]) -> None:
+        self._connection_labels = connection_labels
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if MULTIPROCESS:
+            # drop the live gauges of this process
+            multiprocess.mark_process_dead(os.getpid())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + SAMPLE_INTERVAL
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - expected)
+            EVENT_LOOP_LAG.observe(self.loop_lag)
+            self.sample_pools()
+
+    def sample_pools(self) -> None:
+        for label in self._connection_labels:
+            stats = pool_stats(label)
+            if stats is None:
+                continue
+            POOL_CONNECTIONS.labels(label, "idle").set(stats["idle"])
+            POOL_CONNECTIONS.labels(label, "in_use").set(stats["in_use"])
+            POOL_MAX_SIZE.labels(label).set(stats["max_size"])
+            POOL_WAITING.labels(label).set(stats["waiting"])
+
+
+sampler = Sampler()
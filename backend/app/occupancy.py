@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Any
+
+from tortoise.expressions import Q
+
+from app.database import Appointment, AppointmentStatusEnum, Slot, WeekdayEnum
+from app.database.routing import primary
+from app.events import broker
+
+# Slot occupancy calendar
+#
+# Which slots of a doctor are free on which date, answered from memory
+# instead of scanning appointments. A doctor's slots are numbered (bit n is
+# the n-th slot), every weekday has a bitmask of the slots open that day, and
+# every date with live (PENDING or BOOKED) appointments has a bitmask of the
+# slots they hold. The free slots of a date are
+#
+#   open[weekday] & ~held[date]
+#
+# Everything is loaded once, then kept up to date by the appointment and slot
+# events of app/events.py, which reach every worker. Events published while a
+# worker's listener reconnects are missed, so the calendar is reloaded every
+# OCCUPANCY_MAX_AGE seconds, which also drops past dates. Only the first load
+# runs inline, later ones run in the background while queries keep reading
+# the current state. The slot booking
+# index stays the authority on conflicts, the calendar can lag a write made
+# by another worker by the time its NOTIFY takes, or longer when a NOTIFY was
+# missed. Bookings only trust it to turn away slots that are unknown or closed
+# that weekday, a slot it holds still goes to the index.
+
+MAX_AGE = float(os.getenv("OCCUPANCY_MAX_AGE", 600))
+# longest range of dates a query covers
+MAX_DAYS = 90
+
+LIVE = (AppointmentStatusEnum.PENDING, AppointmentStatusEnum.BOOKED)
+# appointment ids per "released" event, under the 8000 bytes of a NOTIFY
+RELEASE_BATCH = 500
+DAYS = [day.value for day in WeekdayEnum]
+
+logger = logging.getLogger("careflow.occupancy")
+
+
+def _bits(mask: int) -> list[int]:
+    positions = []
+    while mask:
+        low = mask & -mask
+        positions.append(low.bit_length() - 1)
+        mask ^= low
+    return positions
+
+
+@dataclass
+class DoctorSlots:
+    slot_ids: list[int] = field(default_factory=list)
+    slot_times: list[str] = field(default_factory=list)
+    # slot id -> bit
+    positions: dict[int, int] = field(default_factory=dict)
+    # weekday (0 is Monday) -> open slots
+    open: list[int] = field(default_factory=lambda: [0] * 7)
+    # date -> slots held by live appointments
+    held: dict[date, int] = field(default_factory=dict)
+
+
+class OccupancyCalendar:
+    def __init__(self) -> None:
+        self._doctors: dict[int, DoctorSlots] = {}
+        self._slot_doctor: dict[int, int] = {}
+        # slot id -> {date: appointment id}, the live appointment holding it
+        self._holders: dict[int, dict[date, int]] = {}
+        # appointment id -> (slot id, date)
+        self._bookings: dict[int, tuple[int, date]] = {}
+        # doctors whose slots changed, reloaded on their next query
+        self._stale: set[int] = set()
+        self._loaded_at: float | None = None
+        # events received while loading, applied on top of the loaded state
+        self._pending: list[dict] | None = None
+        self._lock = asyncio.Lock()
+        self._reload: asyncio.Task | None = None
+
+    # loading
+
+    def _expired(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= MAX_AGE
+
+    async def load(self) -> None:
+        async with self._lock:
+            # concurrent queries wait for a single load
+            if not self._expired():
+                return
+            self._pending = []
+            try:
+                with primary():
+                    slots = await Slot.all().order_by("id").values(
+                        "id", "doctor_id_id", "day", "slot_time", "available"
+                    )
+                    # past dates are never queried: COALESCE(reschedule_date,
+                    # appointment_date) >= today, left to the database
+                    today = date.today()
+                    bookings = await Appointment.filter(
+                        Q(reschedule_date__gte=today)
+                        | Q(reschedule_date__isnull=True, appointment_date__gte=today),
+                        status__in=LIVE,
+                    ).values_list("id", "slot_id_id", "appointment_date", "reschedule_date")
+                self._doctors, self._slot_doctor, self._holders, self._bookings = {}, {}, {}, {}
+                self._stale.clear()
+                for appointment_id, slot_id, appointment_date, reschedule_date in bookings:
+                    self._hold(appointment_id, slot_id, reschedule_date or appointment_date)
+                by_doctor: dict[int, list[dict]] = {}
+                for slot in slots:
+                    by_doctor.setdefault(slot["doctor_id_id"], []).append(slot)
+                for doctor_id, doctor_slots in by_doctor.items():
+                    self._set_layout(doctor_id, doctor_slots)
+                self._loaded_at = time.monotonic()
+                for event in self._pending:
+                    self._apply(event)
+            finally:
+                self._pending = None
+
+    async def _load_in_background(self) -> None:
+        try:
+            await self.load()
+        except Exception:
+            # the next query tries again
+            logger.exception("occupancy calendar reload failed")
+        finally:
+            self._reload = None
+
+    async def stop(self) -> None:
+        if self._reload is not None:
+            self._reload.cancel()
+            await asyncio.gather(self._reload, return_exceptions=True)
+
+    async def _reload_doctor(self, doctor_id: int) -> None:
+        async with self._lock:
+            self._stale.discard(doctor_id)
+            with primary():
+                slots = await Slot.filter(doctor_id=doctor_id).order_by("id").values(
+                    "id", "day", "slot_time", "available"
+                )
+            if slots:
+                self._set_layout(doctor_id, slots)
+            else:
+                # a deleted doctor, or one without slots left
+                self._doctors.pop(doctor_id, None)
+
+    def _set_layout(self, doctor_id: int, slots: list[dict]) -> None:
+        doctor = DoctorSlots()
+        for position, slot in enumerate(slots):
+            doctor.slot_ids.append(slot["id"])
+            doctor.slot_times.append(slot["slot_time"])
+            doctor.positions[slot["id"]] = position
+            self._slot_doctor[slot["id"]] = doctor_id
+            day = slot["day"].upper()
+            if slot["available"] and day in DAYS:
+                doctor.open[DAYS.index(day)] |= 1 << position
+            for day in self._holders.get(slot["id"], {}):
+                doctor.held[day] = doctor.held.get(day, 0) | 1 << position
+        self._doctors[doctor_id] = doctor
+
+    async def _doctor(self, doctor_id: int, slot_id: int | None = None) -> DoctorSlots | None:
+        if self._loaded_at is None:
+            await self.load()
+        elif self._expired() and self._reload is None:
+            self._reload = asyncio.create_task(self._load_in_background())
+        doctor = self._doctors.get(doctor_id)
+        # a slot this worker has not heard of yet may have just been created
+        if doctor_id in self._stale or (
+            slot_id is not None and (doctor is None or slot_id not in doctor.positions)
+        ):
+            await self._reload_doctor(doctor_id)
+            doctor = self._doctors.get(doctor_id)
+        return doctor
+
+    # holds
+
+    def _mark(self, slot_id: int, day: date, held: bool) -> None:
+        doctor_id = self._slot_doctor.get(slot_id)
+        doctor = None if doctor_id is None else self._doctors.get(doctor_id)
+        if doctor is None or slot_id not in doctor.positions:
+            # picked up from _holders when the doctor's slots are loaded
+            return
+        bit = 1 << doctor.positions[slot_id]
+        mask = doctor.held.get(day, 0)
+        mask = mask | bit if held else mask & ~bit
+        if mask:
+            doctor.held[day] = mask
+        else:
+            doctor.held.pop(day, None)
+
+    def _hold(self, appointment_id: int, slot_id: int, day: date) -> None:
+        self._bookings[appointment_id] = (slot_id, day)
+        self._holders.setdefault(slot_id, {})[day] = appointment_id
+        self._mark(slot_id, day, True)
+
+    def _release(self, appointment_id: int) -> None:
+        booking = self._bookings.pop(appointment_id, None)
+        if booking is None:
+            return
+        slot_id, day = booking
+        holders = self._holders.get(slot_id, {})
+        # events can arrive out of order, never release another appointment's hold
+        if holders.get(day) != appointment_id:
+            return
+        del holders[day]
+        if not holders:
+            del self._holders[slot_id]
+        self._mark(slot_id, day, False)
+
+    # events
+
+    def apply(self, event: dict) -> None:
+        """
+        Broker event handler, see app/events.py.
+        """
+        if self._pending is not None:
+            self._pending.append(event)
+        elif self._loaded_at is not None:
+            # before the first load there is nothing to update, it reads the
+            # current state
+            self._apply(event)
+
+    def _apply(self, event: dict) -> None:
+        if event["type"] == "slots":
+            self._stale.add(event["doctor_id"])
+        elif event["type"] == "released":
+            for appointment_id in event["appointment_ids"]:
+                self._release(appointment_id)
+        elif event["type"] == "appointment":
+            self._release(event["id"])
+            if event["status"] in LIVE:
+                day = date.fromisoformat(event["reschedule_date"] or event["appointment_date"])
+                self._hold(event["id"], event["slot_id"], day)
+
+    # queries
+
+    async def is_open(self, doctor_id: int, slot_id: int, day: date) -> bool | None:
+        """
+        Whether the doctor's slot is open on the weekday of `day`, whoever
+        holds it. None when the slot is not one of the doctor's.
+        """
+        doctor = await self._doctor(doctor_id, slot_id)
+        if doctor is None or slot_id not in doctor.positions:
+            return None
+        return bool(doctor.open[day.weekday()] & 1 << doctor.positions[slot_id])
+
+    async def free_slots(self, doctor_id: int, start: date, days: int) -> list[dict] | None:
+        """
+        The free slots of the doctor on each of `days` dates from `start`,
+        dates without any left out. None when the doctor has no slots.
+        """
+        doctor = await self._doctor(doctor_id)
+        if doctor is None:
+            return None
+        free = []
+        for offset in range(min(days, MAX_DAYS)):
+            day = start + timedelta(days=offset)
+            mask = doctor.open[day.weekday()] & ~doctor.held.get(day, 0)
+            if mask:
+                free.append({
+                    "date": day,
+                    "slots": [
+                        {"id": doctor.slot_ids[position], "slot_time": doctor.slot_times[position]}
+                        for position in _bits(mask)
+                    ],
+                })
+        return free
+
+
+calendar = OccupancyCalendar()
+broker.on_event(calendar.apply)
+
+
+async def publish_slots(doctor_id: int) -> None:
+    """
+    Tell every worker that the doctor's slots changed.
+    """
+    await broker.publish([], {"type": "slots", "doctor_id": doctor_id})
+
+
+async def live_appointment_ids(**filters: Any) -> list[int]:
+    """
+    Ids of the live appointments matching `filters`, to pass to
+    publish_released() once they are deleted.
+    """
+    rows = await Appointment.filter(status__in=LIVE, **filters).values_list("id")
+    return [appointment_id for appointment_id, in rows]
+
+
+async def publish_released(appointment_ids: list[int]) -> None:
+    """
+    Tell every worker that these appointments are gone, deleted along with
+    their patient or doctor.
+    """
+    for start in range(0, len(appointment_ids), RELEASE_BATCH):
+        await broker.publish(
+            [], {"type": "released", "appointment_ids": appointment_ids[start:start + RELEASE_BATCH]}
+        )
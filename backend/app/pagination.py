@@ -0,0 +1,158 @@
+import base64
+import binascii
+from collections.abc import AsyncIterator, Callable
+from typing import Any
+
+from fastapi import Query, Request, Response
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from tortoise import connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.exceptions import FieldError
+from tortoise.queryset import QuerySet, ValuesQuery
+
+from app.database.routing import read_connection
+from app.serialization import FastJSONResponse, dumps
+
+MAX_PAGE_SIZE = 1000
+# rows fetched per round trip by the server-side cursor while streaming
+STREAM_PREFETCH = 500
+NDJSON = "application/x-ndjson"
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def iter_values(
+    query: ValuesQuery, prefetch: int = STREAM_PREFETCH, idle_timeout: float = 0
+) -> AsyncIterator[dict]:
+    """
+    Iterate the rows of a `.values()` query through a server-side cursor, so
+    memory stays constant whatever the size of the result. Holds one pooled
+    connection (in a read-only transaction) until the iteration ends. With an
+    `idle_timeout`, postgres ends the transaction, and the iteration fails,
+    once the caller takes longer than that many seconds between fetches.
+
+    Values are converted like awaiting the query would, by the field each key
+    names, as `.values(*fields)` returns them. A keyword alias naming no field
+    is passed through as read.
+    """
+    sql = query.sql()
+    _, params = query.query.get_parameterized_sql()
+    client = connections.get(read_connection())
+    converters: list[tuple[str, Callable]] | None = None
+
+    def convert(row: dict) -> dict:
+        nonlocal converters
+        if converters is None:
+            converters = []
+            for key in row:
+                try:
+                    func = query.resolve_to_python_value(query.model, key)
+                except FieldError:
+                    continue
+                # Tortoise returns lambdas for the values taken as read
+                if getattr(func, "__name__", None) != "<lambda>":
+                    converters.append((key, func))
+        for key, func in converters:
+            row[key] = func(row[key])
+        return row
+
+    if isinstance(client, AsyncpgDBClient):
+        async with client.acquire_connection() as connection:
+            async with connection.transaction(readonly=True):
+                if idle_timeout:
+                    await connection.execute(
+                        f"SET LOCAL idle_in_transaction_session_timeout = {int(idle_timeout * 1000)}"
+                    )
+                async for record in connection.cursor(sql, *params, prefetch=prefetch):
+                    yield convert(dict(record))
+        return
+
+    # no server-side cursors outside postgres, load the rows instead
+    for row in await client.execute_query_dict(sql, params):
+        yield convert(row)
+
+
+class Page:
+    """
+    Keyset pagination for list endpoints, used as a dependency.
+
+    Rows are ordered by primary key and a page starts after the id carried by
+    the opaque `cursor`, so pages stay stable while rows are inserted. Without
+    `limit` the whole list is returned as before. The next cursor, if any, is
+    sent in the `X-Next-Cursor` and `Link` headers, leaving the body as it was.
+
+    `stream=true` (or `Accept: application/x-ndjson`) streams every remaining
+    row as NDJSON from a server-side cursor instead.
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        response: Response,
+        limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size"),
+        cursor: str | None = Query(None, description="X-Next-Cursor of the previous page"),
+        stream: bool = Query(False, description="Stream the rows as NDJSON"),
+    ) -> None:
+        self.request = request
+        self.response = response
+        self.limit = limit
+        self.after = decode_cursor(cursor) if cursor else None
+        self.stream = stream or NDJSON in request.headers.get("accept", "")
+
+    @property
+    def first(self) -> bool:
+        return self.after is None
+
+    @property
+    def unpaged(self) -> bool:
+        # the whole list in one response, as before pagination
+        return self.first and self.limit is None and not self.stream
+
+    def apply(self, queryset: QuerySet) -> QuerySet:
+        queryset = queryset.order_by("id")
+        if self.after is not None:
+            queryset = queryset.filter(id__gt=self.after)
+        if self.limit is not None and not self.stream:
+            # one extra row tells whether there is a next page
+            queryset = queryset.limit(self.limit + 1)
+        return queryset
+
+    async def fetch(self, query: ValuesQuery, view: Callable[[dict], Any]) -> list | StreamingResponse:
+        """
+        Run a `.values()` query built on `apply()` and map each row through
+        `view`, returning the page or the NDJSON stream.
+        """
+        if self.stream:
+            return StreamingResponse(self._ndjson(query, view), media_type=NDJSON)
+
+        rows = await query
+        if self.limit is not None and len(rows) > self.limit:
+            rows = rows[: self.limit]
+            next_cursor = encode_cursor(rows[-1]["id"])
+            next_url = self.request.url.include_query_params(cursor=next_cursor, limit=self.limit)
+            self.response.headers["X-Next-Cursor"] = next_cursor
+            self.response.headers["Link"] = f'<{next_url}>; rel="next"'
+        return [view(row) for row in rows]
+
+    def respond(self, content: Any) -> Response:
+        """
+        `content` built from fetched rows as a FastJSONResponse carrying the
+        pagination headers. The NDJSON stream is returned as is.
+        """
+        if isinstance(content, Response):
+            return content
+        return FastJSONResponse(content, headers=self.response.headers)
+
+    async def _ndjson(self, query: ValuesQuery, view: Callable[[dict], Any]) -> AsyncIterator[bytes]:
+        async for row in iter_values(query):
+            yield dumps(view(row)) + b"\n"
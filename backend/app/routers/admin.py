@@ -1,8 +1,15 @@
-from typing import Optional
-from fastapi import APIRouter
+from typing import Literal, Optional
+from fastapi import APIRouter, Query, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from app.cache import profile_loader, reference_cache, slot_directory
+from app.database.bulk import BulkEntity, BulkOnError, export_csv, export_ndjson, import_format, import_rows
+from app.database.projections import search_patients
+from app.occupancy import live_appointment_ids, publish_released, publish_slots
+from app.pagination import NDJSON
+from app.serialization import FastJSONResponse
 from app.database import (
     Admin,
     Admin_Pydantic,
@@ -31,20 +38,32 @@ async def read_profile_data(id):
 # /admin/patient
 
 
+# before /patient/{id}, which would take "search" for an id
+@router.get("/patient/search", summary="Find patients by partial name, email or phone")
+async def search_patient(
+    q: str = Query(..., min_length=1, description="Part of the name, email or phone number"),
+    limit: int = Query(10, ge=1, le=50),
+):
+    return FastJSONResponse({"results": await search_patients(q, limit)})
+
+
 @router.get("/patient/{id}", response_model=Patient_Pydantic)
-async def read_patient_data(id):
-    patient_data = await Patient.get_or_none(id=id).values()
-    if not patient_data:
-        raise HTTPException(status_code=404, detail="Patient not found")
-    return patient_data
+async def read_patient_data(id: int, request: Request):
+    return await reference_cache.respond(
+        request, ("patient", id), profile_loader(Patient, Patient_Pydantic, id, "Patient not found")
+    )
 
 
 @router.delete("/patient/{id}")
-async def delete_patient(id):
+async def delete_patient(id: int):
     patient = await Patient.get_or_none(id=id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
+    # deleted with the patient, their slots are free again
+    live = await live_appointment_ids(patient_id=patient.id)
     await patient.delete()
+    await publish_released(live)
+    reference_cache.invalidate("patient")
 
     return {"msg": "Patient deleted successfully", "patient_id": id}
 
@@ -53,11 +72,10 @@ async def delete_patient(id):
 
 
 @router.get("/doctor/{id}", response_model=Doctor_Pydantic)
-async def read_doctor_data(id):
-    doctor_data = await Doctor.get_or_none(id=id).values()
-    if not doctor_data:
-        raise HTTPException(status_code=404, detail="Doctor not found")
-    return doctor_data
+async def read_doctor_data(id: int, request: Request):
+    return await reference_cache.respond(
+        request, ("doctor", id), profile_loader(Doctor, Doctor_Pydantic, id, "Doctor not found")
+    )
 
 
 class DoctorCreateData(BaseModel):
@@ -76,6 +94,8 @@ async def add_doctor(doctor_data: DoctorCreateData):
             phone=doctor_data.phone,
             specialization=doctor_data.specialization,
         )
+        slot_directory.invalidate()
+        reference_cache.invalidate("doctor", "doctors")
 
         return {"msg": "doctor created"}
 
@@ -91,7 +111,7 @@ class DoctorUpdateData(BaseModel):
 
 
 @router.post("/update/doctor/{id}")
-async def update_doctor(id, updated_data: DoctorUpdateData):
+async def update_doctor(id: int, updated_data: DoctorUpdateData):
     existing_data = await Doctor.get_or_none(id=id).values()
     if not existing_data:
         raise HTTPException(status_code=404, detail="Doctor not found")
@@ -99,15 +119,23 @@ async def update_doctor(id, updated_data: DoctorUpdateData):
     if not any(value is not None for value in updated_data.model_dump(exclude_unset=True).values()):
         raise HTTPException(status_code=400, detail="No valid fields provided for update")
     await Doctor.filter(id=id).update(**updated_data.model_dump(exclude_unset=True))
+    slot_directory.invalidate()
+    reference_cache.invalidate("doctor", "doctors")
     print(id, type(updated_data))
     return {"msg":"doctor updated succssfully", "doctor_id": id}
 
 @router.delete("/doctor/{id}")
-async def delete_doctor(id):
+async def delete_doctor(id: int):
     doctor = await Doctor.get_or_none(id=id)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
+    # slots and appointments are deleted with the doctor
+    live = await live_appointment_ids(doctor_id=doctor.id)
     await doctor.delete()
+    slot_directory.invalidate()
+    reference_cache.invalidate("doctor", "doctors")
+    await publish_slots(doctor.id)
+    await publish_released(live)
 
     return {"msg": "doctor deleted successfully", "doctor_id": id}
 
@@ -115,11 +143,12 @@ async def delete_doctor(id):
 # /admin/receptionist 
 
 @router.get("/receptionist/{id}", response_model=Receptionist_Pydantic)
-async def read_receptionist_data(id):
-    receptionist_data = await Receptionist.get_or_none(id=id).values()
-    if not receptionist_data:
-        raise HTTPException(status_code=404, detail="Receptionist not found")
-    return receptionist_data
+async def read_receptionist_data(id: int, request: Request):
+    return await reference_cache.respond(
+        request,
+        ("receptionist", id),
+        profile_loader(Receptionist, Receptionist_Pydantic, id, "Receptionist not found"),
+    )
 
 
 
@@ -138,6 +167,7 @@ async def add_receptionist(receptionist_data: ReceptionistCreateData):
             email=receptionist_data.email,
             phone=receptionist_data.phone
         )
+        reference_cache.invalidate("receptionist")
 
         return {"msg": "receptionist created"}
 
@@ -152,7 +182,7 @@ class ReceptionistUpdateData(BaseModel):
 
 
 @router.post("/update/receptionist/{id}")
-async def update_receptionist(id, updated_data: ReceptionistUpdateData):
+async def update_receptionist(id: int, updated_data: ReceptionistUpdateData):
     existing_data = await Receptionist.get_or_none(id=id).values()
     if not existing_data:
         raise HTTPException(status_code=404, detail="Receptionist not found")
@@ -161,15 +191,58 @@ async def update_receptionist(id, updated_data: ReceptionistUpdateData):
         raise HTTPException(status_code=400, detail="No valid fields provided for update")
 
     await Receptionist.filter(id=id).update(**updated_data.model_dump(exclude_unset=True))
+    reference_cache.invalidate("receptionist")
     print(id, type(updated_data))
     return {"msg":"receptionist updated succssfully", "receptionist_id": id}
 
 
 @router.delete("/receptionist/{id}")
-async def delete_receptionist(id):
+async def delete_receptionist(id: int):
     receptionist = await Receptionist.get_or_none(id=id)
     if not receptionist:
         raise HTTPException(status_code=404, detail="Doctor not found")
     await receptionist.delete()
-
-    return {"msg": "receptionist deleted successfully", "receptionist_id": id}
\ No newline at end of file
+    reference_cache.invalidate("receptionist")
+
+    return {"msg": "receptionist deleted successfully", "receptionist_id": id}
+
+# /admin/import, /admin/export: clinic onboarding, see app/database/bulk.py
+
+
+@router.post("/import/{entity}", summary="Bulk import patients, doctors or slots from CSV or NDJSON")
+async def bulk_import(
+    entity: BulkEntity,
+    request: Request,
+    format: Optional[Literal["csv", "ndjson"]] = Query(None, description="Defaults to the Content-Type"),
+    on_error: BulkOnError = Query(BulkOnError.ABORT, description="abort: import nothing if a row is rejected"),
+    dry_run: bool = Query(False, description="Check the rows, import nothing"),
+):
+    result = await import_rows(
+        entity,
+        request.stream(),
+        import_format(request.headers.get("content-type", ""), format),
+        on_error,
+        dry_run,
+    )
+    if result.committed and result.imported:
+        if entity == BulkEntity.PATIENTS:
+            reference_cache.invalidate("patient")
+        elif entity == BulkEntity.DOCTORS:
+            slot_directory.invalidate()
+            reference_cache.invalidate("doctor", "doctors")
+        else:
+            slot_directory.invalidate()
+            for doctor_id in sorted(result.doctor_ids):
+                await publish_slots(doctor_id)
+
+    status_code = 422 if result.rejected and on_error == BulkOnError.ABORT else 200
+    return FastJSONResponse(result.report(), status_code=status_code)
+
+
+@router.get("/export/{entity}", summary="Stream all patients, doctors or slots as CSV or NDJSON")
+async def bulk_export(entity: BulkEntity, format: Literal["csv", "ndjson"] = "csv"):
+    filename = f"{entity.value}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if format == "ndjson":
+        return StreamingResponse(export_ndjson(entity), media_type=NDJSON, headers=headers)
+    return StreamingResponse(export_csv(entity), media_type="text/csv; charset=utf-8", headers=headers)
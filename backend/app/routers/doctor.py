@@ -1,9 +1,13 @@
-from fastapi import APIRouter, Path
+from fastapi import APIRouter, Depends, Path, Request
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel
 
 # import the Model
-from app.database import Appointment, Appointment_Pydantic, AppointmentStatusEnum, Doctor, Doctor_Pydantic, Patient_Pydantic, Records, Slot_Pydantic
+from app.database import Appointment, AppointmentStatusEnum, Doctor, Doctor_Pydantic, Records, Records_Pydantic
+from app.database.projections import appointment_query, appointment_view
+from app.events import broker, publish_appointment
+from app.pagination import Page
+from app.cache import profile_loader, reference_cache
 
 # router
 router = APIRouter(prefix="/doctor", tags=["doctor"])
@@ -13,13 +17,12 @@ router = APIRouter(prefix="/doctor", tags=["doctor"])
 # route /me(GET)
 @router.get(
     path = "/me",response_model=Doctor_Pydantic)
-async def get_doctor_data():
+async def get_doctor_data(request: Request):
     try:
-        # fetch the doctor
-        doctor = await Doctor.get_or_none(id=1).values()
-        if not doctor:
-            raise HTTPException(status_code=404, detail="Doctor not found")
-        return doctor
+        # fetch the doctor, cached until an admin changes doctors
+        return await reference_cache.respond(
+            request, ("doctor", 1), profile_loader(Doctor, Doctor_Pydantic, 1, "Doctor not found")
+        )
     except Exception as e:
         raise HTTPException(status_code=422, detail=str(e))
 
@@ -41,6 +44,7 @@ async def add_doctor(doctor_data:DoctorCreateData):
             phone=doctor_data.phone,
             specialization=doctor_data.specialization,
         )
+        reference_cache.invalidate("doctors")
         return {"msg": "doctor created"}
     except Exception as e:
         raise HTTPException(status_code=422, detail=str(e))
@@ -73,7 +77,7 @@ async def get_patient_records(
     records = await Records.filter(
         id__in=record_ids,
         patient_id=patient_id
-    ).all().values()
+    ).all().values(*Records_Pydantic.model_fields)
 
     if not records:
         raise HTTPException(status_code=404, detail="No records found")
@@ -82,31 +86,32 @@ async def get_patient_records(
 
 
 @router.get("/appointments", summary="Get all appointments for the current doctor")
-async def get_doctor_appointments():
+async def get_doctor_appointments(page: Page = Depends()):
     doctor_id = 3  # Replace this with real authenticated doctor ID
     
     # Filter by doctor_id and status in ("BOOKED", "DONE")
-    appointments = await Appointment.filter(
-        doctor_id=doctor_id,
-        status__in=["BOOKED", "DONE"]
-    ).prefetch_related("slot_id", "patient_id")
+    relations = ("slot", "patient")
+    results = await page.fetch(
+        appointment_query(
+            page.apply(Appointment.filter(
+                doctor_id=doctor_id,
+                status__in=["BOOKED", "DONE"]
+            )),
+            *relations,
+        ),
+        lambda row: appointment_view(row, *relations),
+    )
     
-    if not appointments:
+    if not results and page.first:
         raise HTTPException(status_code=404, detail="No appointments found for this doctor")
-    
-    results = []
-    for appt in appointments:
-        slot = await Slot_Pydantic.from_tortoise_orm(appt.slot_id)
-        patient = await Patient_Pydantic.from_tortoise_orm(appt.patient_id)
-        appt_data = await Appointment_Pydantic.from_tortoise_orm(appt)
 
-        results.append({
-            "appointment": appt_data,
-            "slot": slot,
-            "patient": patient
-        })
+    return page.respond(results)
 
-    return results
+# appointment changes pushed as Server-Sent Events
+@router.get("/appointments/events", summary="Stream changes to the current doctor's appointments")
+async def doctor_appointment_events():
+    doctor_id = 3  # Replace this with real authenticated doctor ID
+    return broker.stream([f"doctor:{doctor_id}"])
 
 @router.patch("/appointment/{appointment_id}", summary="Mark appointment as DONE if it's currently BOOKED")
 async def mark_appointment_completed(
@@ -125,5 +130,6 @@ async def mark_appointment_completed(
 
     appointment.status = AppointmentStatusEnum.DONE
     await appointment.save()
+    await publish_appointment(appointment)
 
     return {"msg": "Appointment marked as DONE"}
\ No newline at end of file
@@ -1,12 +1,30 @@
+from datetime import date
 from typing import List
-from fastapi import APIRouter, Form, Request, UploadFile
+from fastapi import APIRouter, Depends, Form, Header, Query, Request, UploadFile
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel 
-import os
-import uuid
-
-
-from app.database import Appointment, Appointment_Pydantic, AppointmentStatusEnum, Doctor, Doctor_Pydantic, GenderEnum, Patient, Patient_Pydantic, Records, Records_Pydantic, Slot, Slot_Pydantic
+from tortoise.exceptions import IntegrityError
+
+
+from app.cache import reference_cache, slot_directory
+from app.storage import (
+    CHUNK_SIZE,
+    StoredFile,
+    append_upload_chunk,
+    create_upload_session,
+    discard_upload_session,
+    finalize_upload_session,
+    get_upload_session,
+    store_upload,
+)
+from app.database import Appointment, Appointment_Pydantic, AppointmentStatusEnum, Doctor, GenderEnum, Patient, Patient_Pydantic, Records, Records_Pydantic, Reminder, Slot, is_slot_conflict
+from app.database.projections import appointment_query, appointment_view, doctor_directory
+from app.events import broker, publish_appointment
+from app.jobs import enqueue
+from app.metrics import observe_upload
+from app.occupancy import MAX_DAYS, calendar
+from app.pagination import Page
+from app.serialization import FastJSONResponse
 
 router = APIRouter(prefix="/patient", tags=["patient"]) 
 
@@ -27,24 +45,42 @@ async def update_profile_data(patient_data: Patient_Pydantic):
 
 # GET /patient/record - Get all records for patient with id=1
 @router.get("/record", response_model=list[Records_Pydantic])
-async def get_patient_records():
+async def get_patient_records(page: Page = Depends()):
     patient_id = 1  # hardcoded for now
 
-    records = await Records_Pydantic.from_queryset(
-        Records.filter(patient_id=patient_id)
+    records = await page.fetch(
+        page.apply(Records.filter(patient_id=patient_id)).values(*Records_Pydantic.model_fields),
+        dict,
     )
 
-    if not records:
+    if not records and page.first:
         raise HTTPException(status_code=404, detail="No records found for this patient.")
 
-    return records
+    return page.respond(records)
+
+# record file URL, served from the uploaded_records path
+def record_file_url(request: Request, file_name: str) -> str:
+    return f"{request.base_url}uploaded_records/{file_name}"
+
+
+async def save_record(request: Request, patient_id: int, reason: str, stored: StoredFile) -> Records:
+    record = await Records.create(
+            reason=reason,
+            record_data=record_file_url(request, stored.file_name),
+            file_name=stored.file_name,
+            size=stored.size,
+            checksum=stored.checksum,
+            data_key=stored.data_key,
+            patient_id_id=patient_id,  # correct way to manually assign FK by ID
+            doctor_id=None             # optional for now
+        )
+    # MIME type, pages and preview are extracted in the background
+    await enqueue("record_metadata", {"record_id": record.id}, key=f"record_metadata:{record.id}")
+    return record
 
-# For storing the PDF file
-UPLOAD_DIR = "uploaded_records"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # POST /record - Upload record
-@router.post("/record", summary="Upload a patient record with manual ID")
+@router.post("/record", summary="Upload a patient record")
 async def create_patient_record(
     request: Request,
     reason: str = Form(...),
@@ -58,31 +94,93 @@ async def create_patient_record(
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
-    # Save file locally
-    filename = f"{uuid.uuid4()}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+    # Stream the file to disk in bounded chunks
+    stored = await store_upload(file)
+    observe_upload(request, stored.size)
 
-    # Generate public file URL
-    file_url = f"{request.base_url}uploaded_records/{filename}"
+    record = await save_record(request, patient_id, reason, stored)
 
-    # Get next ID manually
-    last_record = await Records.all().order_by("-id").first()
-    next_id = (last_record.id + 1) if last_record else 1
+    return await Records_Pydantic.from_tortoise_orm(record)
 
-    record = await Records.create(
-            id=next_id,
-            reason=reason,
-            record_data=file_url,
-            patient_id_id=patient_id,  # correct way to manually assign FK by ID
-            doctor_id=None             # optional for now
+
+# Resumable upload: initiate, PUT chunks with Content-Range, then finalize
+class RecordUploadCreateData(BaseModel):
+    reason: str
+    filename: str
+    size: int
+
+
+def upload_status(session: dict, offset: int) -> dict:
+    return {
+        "upload_id": session["upload_id"],
+        "offset": offset,
+        "size": session["size"],
+        "chunk_size": CHUNK_SIZE,
+    }
+
+
+def parse_content_range(content_range: str | None, size: int) -> int:
+    # "bytes <start>-<end>/<total>", only the start offset is trusted
+    try:
+        unit, _, spec = (content_range or "").partition(" ")
+        start, _, rest = spec.partition("-")
+        _, _, total = rest.partition("/")
+        if unit != "bytes" or (total not in ("*", "") and int(total) != size):
+            raise ValueError
+        return int(start)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="Content-Range header must be 'bytes <start>-<end>/<size>'",
         )
-    
+
+
+@router.post("/record/upload", status_code=201, summary="Start a resumable record upload")
+async def create_record_upload(data: RecordUploadCreateData):
+    patient_id = 1  # hardcoded
+
+    patient = await Patient.get_or_none(id=patient_id)
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    session = await create_upload_session(patient_id, data.reason, data.filename, data.size)
+    return upload_status(session, 0)
+
+
+@router.get("/record/upload/{upload_id}", summary="Get the resume offset of an upload")
+async def get_record_upload(upload_id: str):
+    session, offset = await get_upload_session(upload_id)
+    return upload_status(session, offset)
+
+
+@router.put("/record/upload/{upload_id}", summary="Upload the next chunk of a record")
+async def put_record_upload_chunk(
+    request: Request,
+    upload_id: str,
+    content_range: str | None = Header(None),
+):
+    session, _ = await get_upload_session(upload_id)
+    offset = parse_content_range(content_range, session["size"])
+
+    session, offset = await append_upload_chunk(upload_id, offset, request.stream())
+    return upload_status(session, offset)
+
+
+@router.post("/record/upload/{upload_id}/finalize", summary="Complete a resumable upload")
+async def finalize_record_upload(request: Request, upload_id: str):
+    session, stored = await finalize_upload_session(upload_id)
+
+    record = await save_record(request, session["patient_id"], session["reason"], stored)
 
     return await Records_Pydantic.from_tortoise_orm(record)
 
 
+@router.delete("/record/upload/{upload_id}", summary="Abort a resumable upload")
+async def delete_record_upload(upload_id: str):
+    await discard_upload_session(upload_id)
+    return {"msg": "Upload discarded", "upload_id": upload_id}
+
+
 # DELETE /record - Remove records
 @router.delete("/record/{id}")
 async def remove_record(id: int):
@@ -95,87 +193,142 @@ async def remove_record(id: int):
 
 # route /doctor(GET)
 @router.get("/doctors", summary="Get all doctor IDs with names")
-async def get_all_doctors():
-    doctors = await Doctor.all().values("id", "name", "specialization")
-    return {"doctors": doctors}
+async def get_all_doctors(request: Request, page: Page = Depends()):
+    if page.unpaged:
+        return await reference_cache.respond(
+            request, ("doctors",), doctor_directory, cache_control="public, no-cache"
+        )
+    doctors = await page.fetch(
+        page.apply(Doctor.all()).values("id", "name", "specialization"), dict
+    )
+    return page.respond(doctors if page.stream else {"doctors": doctors})
 
 
 class AppointmentCreateData(BaseModel):
     doctor_id: int
     receptionist_id: int | None = None
     slot_id: int
-    appointment_date: str 
+    appointment_date: date
     reason: str
     record_ids: List[int]
 
 
 @router.post("/appointment", response_model=Appointment_Pydantic)
 async def create_appointment(data: AppointmentCreateData):
-    # Get the last ID
-    last = await Appointment.all().order_by("-id").first()
-    next_id = (last.id + 1) if last else 1
-
     patient_id = 1  # hardcoded
 
-
-    appointment = await Appointment.create(
-            id=next_id,
-            patient_id_id=patient_id,
-            doctor_id_id=data.doctor_id,
-            receptionist_id_id=data.receptionist_id,
-            slot_id_id=data.slot_id,
-            appointment_date=data.appointment_date,
-            reason=data.reason,
-            record_ids=data.record_ids,
-            status=AppointmentStatusEnum.PENDING,
-        )
+    # answered from memory, see app/occupancy.py. Whether someone holds the
+    # slot is left to the INSERT, the calendar can lag behind.
+    is_open = await calendar.is_open(data.doctor_id, data.slot_id, data.appointment_date)
+    if is_open is None:
+        raise HTTPException(status_code=404, detail="Slot not found for this doctor")
+    if not is_open:
+        raise HTTPException(status_code=409, detail="Slot is not available on this date")
+
+    # single INSERT, the slot booking index settles concurrent bookings
+    try:
+        appointment = await Appointment.create(
+                patient_id_id=patient_id,
+                doctor_id_id=data.doctor_id,
+                receptionist_id_id=data.receptionist_id,
+                slot_id_id=data.slot_id,
+                appointment_date=data.appointment_date,
+                reason=data.reason,
+                record_ids=data.record_ids,
+                status=AppointmentStatusEnum.PENDING,
+            )
+    except IntegrityError as e:
+        if is_slot_conflict(e):
+            raise HTTPException(status_code=409, detail="Slot is already booked for this date")
+        raise
+    await publish_appointment(appointment)
 
     return await Appointment_Pydantic.from_tortoise_orm(appointment)
 
 
 @router.get("/appointment", summary="Get all appointments for the current patient")
-async def get_patient_appointments():
+async def get_patient_appointments(page: Page = Depends()):
     patient_id = 1  # Replace with authenticated patient ID
 
-    appointments = await Appointment.filter(
-        patient_id=patient_id,
-    ).prefetch_related("slot_id", "doctor_id")
+    relations = ("slot", "doctor")
+    results = await page.fetch(
+        appointment_query(
+            page.apply(Appointment.filter(
+                patient_id=patient_id,
+            )),
+            *relations,
+        ),
+        lambda row: appointment_view(row, *relations),
+    )
 
-    if not appointments:
+    if not results and page.first:
         raise HTTPException(status_code=404, detail="No appointments found for this patient")
 
-    results = []
-    for appt in appointments:
-        slot = await Slot_Pydantic.from_tortoise_orm(appt.slot_id)
-        doctor = await Doctor_Pydantic.from_tortoise_orm(appt.doctor_id)
-        appt_data = await Appointment_Pydantic.from_tortoise_orm(appt)
+    return page.respond(results)
 
-        results.append({
-            "appointment": appt_data,
-            "slot": slot,
-            "doctor": doctor
-        })
+# appointment changes pushed as Server-Sent Events
+@router.get("/appointment/events", summary="Stream changes to the current patient's appointments")
+async def patient_appointment_events():
+    patient_id = 1  # Replace with authenticated patient ID
+    return broker.stream([f"patient:{patient_id}"])
 
-    return results
+# reminders written by background jobs (follow-up checkups), kept until
+# dismissed
+@router.get("/reminders", summary="Get the current patient's reminders")
+async def get_patient_reminders():
+    patient_id = 1  # Replace with authenticated patient ID
+    rows = await Reminder.filter(patient_id=patient_id).order_by("id").values(
+        "id",
+        "kind",
+        "due",
+        "appointment_id_id",
+        "appointment_id__appointment_date",
+        "appointment_id__reschedule_date",
+        "appointment_id__doctor_id_id",
+        "appointment_id__doctor_id__name",
+    )
+    return {
+        "reminders": [
+            {
+                "id": row["id"],
+                "kind": row["kind"],
+                "appointment_id": row["appointment_id_id"],
+                "doctor_id": row["appointment_id__doctor_id_id"],
+                "doctor_name": row["appointment_id__doctor_id__name"],
+                "visit_date": row["appointment_id__reschedule_date"] or row["appointment_id__appointment_date"],
+                "due": row["due"],
+            }
+            for row in rows
+        ]
+    }
+
+
+@router.delete("/reminders/{id}", summary="Dismiss a reminder")
+async def dismiss_reminder(id: int):
+    patient_id = 1  # Replace with authenticated patient ID
+    if not await Reminder.filter(id=id, patient_id=patient_id).delete():
+        raise HTTPException(status_code=404, detail="Reminder not found")
+    return {"msg": "Reminder dismissed", "reminder_id": id}
 
 @router.get("/slots", summary="Get all slots grouped by doctor for patients")
 async def get_all_slots_for_patients():
-    doctors = await Doctor.all().values("id", "name", "specialization")
-    if not doctors:
-        raise HTTPException(status_code=404, detail="No doctors found")
-
-    response = []
-    for doctor in doctors:
-        slots = await Slot.filter(doctor_id=doctor["id"]).values("id", "available", "day", "slot_time")
-        if slots:
-            response.append({
-                "doctor_id": doctor["id"],
-                "doctor_name": doctor["name"],
-                "specialization": doctor["specialization"],
-                "slots": slots
-            })
+    # served from the in-process snapshot, see app/cache.py
+    response = await slot_directory.get()
 
     if not response:
         raise HTTPException(status_code=404, detail="No available slots found for any doctor")
 
-    return {"data": response}
+    return FastJSONResponse({"data": response})
+
+@router.get("/slots/{doctor_id}/free", summary="Get the free slots of a doctor, date by date")
+async def get_free_slots(
+    doctor_id: int,
+    start: date | None = None,
+    days: int = Query(30, ge=1, le=MAX_DAYS),
+):
+    # from the occupancy calendar, no appointment is read
+    free = await calendar.free_slots(doctor_id, start or date.today(), days)
+    if free is None:
+        raise HTTPException(status_code=404, detail="No slots found for this doctor")
+
+    return FastJSONResponse({"doctor_id": doctor_id, "dates": free})
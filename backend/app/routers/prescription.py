@@ -1,56 +1,51 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Query
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel
 
 # import the Model
 from app.database import Appointment, Doctor, Patient_Pydantic, Prescription
+from app.database.projections import prescription_query, prescription_view, search_prescriptions
+from app.pagination import Page
+from app.serialization import FastJSONResponse
 
 # router
 router = APIRouter(prefix="/prescription", tags=["prescription"])
 
 # route for get all prescription for the doctor
 @router.get("/all", summary="Get all prescriptions for a specific doctor")
-async def get_prescriptions_by_doctor_id():
+async def get_prescriptions_by_doctor_id(page: Page = Depends()):
     doctor_id = 3  # replace later with real doctor_id from token
     # Check if doctor exists
     doctor = await Doctor.get_or_none(id=doctor_id)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
 
-    # Get all appointments by doctor
-    appointments = await Appointment.filter(doctor_id=doctor_id).prefetch_related(
-        "patient_id"
+    # Get all prescriptions of the doctor's appointments with their patient
+    results = await page.fetch(
+        prescription_query(
+            page.apply(Prescription.filter(appointment_id__doctor_id=doctor_id))
+        ),
+        prescription_view,
     )
-    if not appointments:
-        raise HTTPException(
-            status_code=404, detail="No appointments found for this doctor"
-        )
-
-    results = []
-    for appt in appointments:
-        prescription = await Prescription.get_or_none(appointment_id=appt.id)
-        if prescription:
-            patient = await Patient_Pydantic.from_tortoise_orm(appt.patient_id)
-            results.append(
-                {
-                    "prescription": {
-                        "id": prescription.id,
-                        "appointment_id": appt.id,
-                        "observation": prescription.observation,
-                        "medication": prescription.medication,
-                        "advise": prescription.advise,
-                        "test": prescription.test,
-                    },
-                    "patient": patient,
-                }
-            )
-
-    if not results:
+    if not results and page.first:
         raise HTTPException(
             status_code=404, detail="No prescriptions found for this doctor"
         )
 
-    return results
+    return page.respond(results)
+
+# route for full-text search over the doctor's prescriptions
+@router.get("/search", summary="Search prescriptions of a doctor by text")
+async def search_prescriptions_by_text(
+    q: str = Query(..., min_length=1, description="Words, \"phrases\", or -excluded"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    doctor_id = 3  # replace later with real doctor_id from token
+
+    total, results = await search_prescriptions(doctor_id, q, limit, offset)
+
+    return FastJSONResponse({"total": total, "limit": limit, "offset": offset, "results": results})
 
 # model for create prescription
 class PrescriptionCreateData(BaseModel):
@@ -65,7 +60,6 @@ class PrescriptionCreateData(BaseModel):
 async def create_prescription(prescription_data: PrescriptionCreateData):
     print(prescription_data)
     await Prescription.create(
-        id = 31,
         appointment_id_id=prescription_data.appointment_id,
         observation=prescription_data.observation,
         medication=prescription_data.medication,
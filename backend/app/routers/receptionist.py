@@ -1,25 +1,51 @@
 from typing import List, Optional
-from fastapi import APIRouter, Body, HTTPException
-from pydantic import BaseModel
-from datetime import date
-
-from app.database import Appointment, Appointment_Pydantic, AppointmentStatusEnum, Doctor, Doctor_Pydantic, Patient_Pydantic, Receptionist, Receptionist_Pydantic, Slot, Slot_Pydantic
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
+from pydantic import BaseModel, Field
+from datetime import date, time
+from tortoise.exceptions import IntegrityError
+
+from app.database import Appointment, AppointmentStatusEnum, Doctor, Receptionist, Receptionist_Pydantic, SLOT_UNIQUE_INDEX, Slot, WeekdayEnum, fk_id, is_slot_conflict
+from app.database.slots import slot_times, write_slots
+from app.database.projections import appointment_query, appointment_view, appointment_views, doctor_directory, search_patients
+from app.pagination import Page
+from app.cache import profile_loader, reference_cache, slot_directory
+from app.events import broker, publish_appointment
+from app.serialization import FastJSONResponse
+from app.occupancy import calendar, publish_slots
 
 router = APIRouter(prefix="/receptionist", tags=["receptionist"])
 
 
 # route /me(GET)
 @router.get(path="/me", response_model=Receptionist_Pydantic)
-async def get_receptionist_data():
-    receptionist = await Receptionist.get_or_none(id=1).values()
-    return receptionist
+async def get_receptionist_data(request: Request):
+    return await reference_cache.respond(
+        request,
+        ("receptionist", 1),
+        profile_loader(Receptionist, Receptionist_Pydantic, 1, "Receptionist not found"),
+    )
 
 
 # route /doctor(GET)
 @router.get("/doctors", summary="Get all doctor IDs with names")
-async def get_all_doctors():
-    doctors = await Doctor.all().values("id", "name", "specialization")
-    return {"doctors": doctors}
+async def get_all_doctors(request: Request, page: Page = Depends()):
+    if page.unpaged:
+        return await reference_cache.respond(
+            request, ("doctors",), doctor_directory, cache_control="public, no-cache"
+        )
+    doctors = await page.fetch(
+        page.apply(Doctor.all()).values("id", "name", "specialization"), dict
+    )
+    return page.respond(doctors if page.stream else {"doctors": doctors})
+
+
+# search-as-you-type over patients, for the desk
+@router.get("/patient/search", summary="Find patients by partial name, email or phone")
+async def search_patient(
+    q: str = Query(..., min_length=1, description="Part of the name, email or phone number"),
+    limit: int = Query(10, ge=1, le=50),
+):
+    return FastJSONResponse({"results": await search_patients(q, limit)})
 
 
 # model for create receptionist
@@ -58,66 +84,79 @@ class SlotUpdateModel(BaseModel):
 
 @router.patch("/doctor/slots/{doctor_id}", summary="Update or create slots for a doctor")
 async def update_or_create_slots(doctor_id: int, updates: List[SlotUpdateModel]):
-    updated_slots = []
-
-    # Get the current max ID in Slot table
-    max_id_record = await Slot.all().order_by("-id").first()
-    current_max_id = max_id_record.id if max_id_record else 0
-
+    changes = []
+    new_slots = []
     for update in updates:
         if update.id is not None:
-            # Update existing slot
-            slot = await Slot.get_or_none(id=update.id, doctor_id=doctor_id)
-            if not slot:
-                continue
-
-            if update.available is not None:
-                slot.available = update.available
-            if update.slot_time is not None:
-                slot.slot_time = update.slot_time
-            if update.day is not None:
-                slot.day = update.day
-
-            await slot.save()
-            updated_slots.append(await Slot_Pydantic.from_tortoise_orm(slot))
+            changes.append((update.id, update.available, update.slot_time, update.day))
+        elif update.slot_time is None or update.day is None or update.available is None:
+            raise HTTPException(status_code=422, detail="New slots need slot_time, day and available")
         else:
-            # Create new slot with manual ID
-            current_max_id += 1
-            new_slot = await Slot.create(
-                id=current_max_id,
-                doctor_id_id=doctor_id,
-                slot_time=update.slot_time,
-                day=update.day,
-                available=update.available,
-            )
-            updated_slots.append(await Slot_Pydantic.from_tortoise_orm(new_slot))
+            new_slots.append((update.available, update.slot_time, update.day))
+
+    # one transaction, a statement for the updates and one for the new slots
+    try:
+        updated_slots = await write_slots(doctor_id, changes, new_slots)
+    except IntegrityError as e:
+        if SLOT_UNIQUE_INDEX in str(e):
+            raise HTTPException(status_code=409, detail="The doctor already has a slot at this day and time")
+        raise
 
     if not updated_slots:
         raise HTTPException(status_code=400, detail="No slots were updated or created")
 
+    slot_directory.invalidate()
+    await publish_slots(doctor_id)
+
     return {"msg": "Slots updated/created successfully", "slots": updated_slots}
 
+
+# weekly schedule template, e.g. MON-FRI 09:00-13:00 every 15 minutes
+class SlotScheduleModel(BaseModel):
+    days: List[WeekdayEnum] = Field(..., min_length=1)
+    start: time
+    end: time
+    every: int = Field(15, ge=5, le=240, description="Slot length in minutes")
+    available: bool = True
+
+
+@router.post("/doctor/slots/{doctor_id}/schedule", summary="Create a doctor's weekly slots from a template")
+async def create_slot_schedule(doctor_id: int, schedule: SlotScheduleModel):
+    if not await Doctor.exists(id=doctor_id):
+        raise HTTPException(status_code=404, detail="Doctor not found")
+
+    times = slot_times(schedule.start, schedule.end, schedule.every)
+    if not times:
+        raise HTTPException(status_code=400, detail="No slot fits between start and end")
+
+    # slots already in the schedule keep their id, only availability changes
+    slots = await write_slots(
+        doctor_id,
+        [],
+        [(schedule.available, slot_time, day.value) for day in dict.fromkeys(schedule.days) for slot_time in times],
+    )
+    slot_directory.invalidate()
+    await publish_slots(doctor_id)
+
+    return {"msg": "Schedule applied successfully", "doctor_id": doctor_id, "slots": slots}
+
 # route for get all apppointment
 @router.get("/appointment", summary="Get all appointments with full details")
-async def get_all_appointments():
-    appointments = await Appointment.all().prefetch_related("patient_id", "doctor_id", "slot_id")
-    if not appointments:
+async def get_all_appointments(page: Page = Depends()):
+    relations = ("patient", "doctor", "slot")
+    results = await page.fetch(
+        appointment_query(page.apply(Appointment.all()), *relations),
+        lambda row: appointment_view(row, *relations),
+    )
+    if not results and page.first:
         raise HTTPException(status_code=404, detail="No appointments found")
 
-    results = []
-    for appt in appointments:
-        appt_data = await Appointment_Pydantic.from_tortoise_orm(appt)
-        patient = await Patient_Pydantic.from_tortoise_orm(appt.patient_id)
-        doctor = await Doctor_Pydantic.from_tortoise_orm(appt.doctor_id)
-        slot = await Slot_Pydantic.from_tortoise_orm(appt.slot_id)
-
-        results.append({
-            "appointment": appt_data,
-            "patient": patient,
-            "doctor": doctor,
-            "slot": slot
-        })
-    return results
+    return page.respond(results)
+
+# appointment changes pushed as Server-Sent Events
+@router.get("/appointment/events", summary="Stream appointment changes")
+async def appointment_events():
+    return broker.stream(["appointments"])
 
 @router.patch("/appointment/status", summary="Update appointment status (approve, decline, or re-approve)")
 async def update_appointment_status(
@@ -147,7 +186,14 @@ async def update_appointment_status(
     # Assign receptionist
     appointment.receptionist_id_id = receptionist_id 
 
-    await appointment.save()
+    # re-approving can collide with a booking made since the decline
+    try:
+        await appointment.save()
+    except IntegrityError as e:
+        if is_slot_conflict(e):
+            raise HTTPException(status_code=409, detail="Slot is already booked for this date")
+        raise
+    await publish_appointment(appointment)
     return {"msg": "Appointment status updated successfully"}
 
 # reschedule the appointment
@@ -161,9 +207,20 @@ async def reschedule_appointment(
     if not appointment:
         raise HTTPException(status_code=404, detail="Appointment not found")
 
+    # the slot must be open that day, the slot booking index settles whether
+    # another appointment holds it
+    if not await calendar.is_open(fk_id(appointment, "doctor_id"), fk_id(appointment, "slot_id"), date):
+        raise HTTPException(status_code=409, detail="Slot is not available on this date")
+
     # Update the reschedule date
     appointment.reschedule_date = date
-    await appointment.save()
+    try:
+        await appointment.save()
+    except IntegrityError as e:
+        if is_slot_conflict(e):
+            raise HTTPException(status_code=409, detail="Slot is already booked for this date")
+        raise
+    await publish_appointment(appointment)
 
     return {"msg": "Appointment rescheduled successfully"}
 
@@ -171,19 +228,9 @@ async def reschedule_appointment(
 # get a single appointment by id
 @router.get("/appointment/{id}", summary="Get single appointment with full details")
 async def get_appointment_by_id(id: int):
-    appointment = await Appointment.get_or_none(id=id).prefetch_related("patient_id", "doctor_id", "slot_id")
-    if not appointment:
+    results = await appointment_views(Appointment.filter(id=id), "patient", "doctor", "slot")
+    if not results:
         raise HTTPException(status_code=404, detail="Appointment not found")
 
-    appt_data = await Appointment_Pydantic.from_tortoise_orm(appointment)
-    patient = await Patient_Pydantic.from_tortoise_orm(appointment.patient_id)
-    doctor = await Doctor_Pydantic.from_tortoise_orm(appointment.doctor_id)
-    slot = await Slot_Pydantic.from_tortoise_orm(appointment.slot_id)
-
-    return {
-        "appointment": appt_data,
-        "patient": patient,
-        "doctor": doctor,
-        "slot": slot
-    }
+    return results[0]
 
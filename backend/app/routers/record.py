@@ -1,8 +1,10 @@
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Request, status
+from fastapi.exceptions import HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
 from app.database import Records, Records_Pydantic
+from app.storage import record_file_response, record_preview_response
 
 router = APIRouter(prefix="/records", tags=["records"])
 
@@ -14,4 +16,34 @@ async def read_profile_data() -> RecordsCreatedResponse:
     # data = await Records.create(username="demouser", name="Demo User", password_hash="securepasshash")
     # print(data)
     # return await Records_Pydantic.from_tortoise_orm(data)
-    return JSONResponse({ "msg": "records created" }, status.HTTP_200_OK) 
+    return JSONResponse({ "msg": "records created" }, status.HTTP_200_OK)
+
+
+# route /records/{id}/file(GET) - download with Range, ETag and 304 support
+@router.api_route("/{id}/file", methods=["GET", "HEAD"], summary="Download the file of a record")
+async def download_record(request: Request, id: int):
+    record = await Records.get_or_none(id=id).only("id", "file_name", "checksum", "data_key")
+    if not record or not record.file_name:
+        raise HTTPException(status_code=404, detail="Record not found")
+    return await record_file_response(request, record)
+
+
+# route /records/{id}/preview(GET) - first page preview, once the record_metadata job ran
+@router.get("/{id}/preview", summary="Get the preview image of a record")
+async def download_record_preview(request: Request, id: int):
+    record = await Records.get_or_none(id=id).only("id", "preview", "data_key")
+    if not record or not record.preview:
+        raise HTTPException(status_code=404, detail="Record preview not found")
+    return await record_preview_response(request, record)
+
+
+# stored record URLs point at /uploaded_records/<file name>, serve them the same way
+files_router = APIRouter(prefix="/uploaded_records", tags=["records"])
+
+
+@files_router.api_route("/{file_name}", methods=["GET", "HEAD"], summary="Download a record file by name")
+async def download_record_file(request: Request, file_name: str):
+    record = await Records.get_or_none(file_name=file_name).only("id", "file_name", "checksum", "data_key")
+    if not record:
+        raise HTTPException(status_code=404, detail="Record not found")
+    return await record_file_response(request, record)
@@ -0,0 +1,38 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+# Fast JSON path
+#
+# Returning a plain value from a route makes FastAPI validate it against the
+# response_model and walk it with jsonable_encoder before encoding it, row by
+# row. The list endpoints return rows of `.values()` queries, already typed
+# by the ORM, so they are encoded straight to bytes with orjson instead.
+# orjson handles dates, datetimes, UUIDs and enums natively.
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+
+def dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=_default)
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response encoded with orjson, without response model validation.
+    Only for trusted data, e.g. ORM rows.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,596 @@
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import uuid
+from collections import defaultdict
+from collections.abc import AsyncIterable, Callable
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, BinaryIO, NamedTuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import Request, Response, UploadFile
+from fastapi.exceptions import HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from app import encryption
+from app.encryption import SEGMENT_SIZE, RecordWriter, SegmentCipher
+
+# For storing the uploaded record files
+UPLOAD_DIR = "uploaded_records"
+# in-progress chunked uploads, kept outside UPLOAD_DIR so they are never served
+PARTIAL_DIR = "uploaded_records.partial"
+# first page previews of records, see app/metadata.py
+PREVIEW_DIR = "uploaded_records.previews"
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(PARTIAL_DIR, exist_ok=True)
+os.makedirs(PREVIEW_DIR, exist_ok=True)
+
+# bytes buffered before each disk write, bounds the memory held by one upload.
+# Whole encryption segments.
+CHUNK_SIZE = max(int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024)) // SEGMENT_SIZE, 1) * SEGMENT_SIZE
+# hard cap on the size of a single record file
+MAX_RECORD_SIZE = int(os.getenv("MAX_RECORD_SIZE", 256 * 1024 * 1024))
+
+
+class StoredFile(NamedTuple):
+    file_name: str
+    size: int
+    checksum: str
+    # wrapped data key of an encrypted file
+    data_key: str | None = None
+
+
+def new_file_name(original: str | None) -> str:
+    # the client controls the original name, keep only its last path segment
+    base = os.path.basename((original or "").replace("\\", "/")) or "record"
+    return f"{uuid.uuid4()}_{base}"
+
+
+def _hash_file(path: str, key: bytes | None, size: int) -> Any:
+    # sha256 of the first `size` plaintext bytes of a (part) file
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        if key is None:
+            while chunk := f.read(CHUNK_SIZE):
+                hasher.update(chunk)
+        else:
+            cipher = SegmentCipher.from_file(f, key)
+            sealed = os.fstat(f.fileno()).st_size
+            # the last segment is only there once the upload is complete
+            complete = encryption.plaintext_size(sealed) == size
+            segments = encryption.segment_count(sealed) if complete else None
+            for piece in encryption.read_plaintext(f, cipher, 0, size, segments, CHUNK_SIZE):
+                hasher.update(piece)
+    return hasher
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _stream_to(
+    writer: RecordWriter,
+    chunks: AsyncIterable[bytes],
+    limit: int,
+    is_complete: Callable[[int], bool],
+) -> int:
+    """
+    Write `chunks` through `writer` off the event loop and return the bytes
+    written.
+
+    Incoming pieces are coalesced into CHUNK_SIZE writes and the size limit is
+    checked before anything past it touches the disk. `is_complete(received)`
+    tells whether the stream ends the file. If it does not, a tail shorter
+    than `writer.align` is dropped, the caller resumes from the returned count.
+    """
+    written = 0
+    pending = bytearray()
+    async for chunk in chunks:
+        if written + len(pending) + len(chunk) > limit:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Record is larger than the allowed {limit} bytes",
+            )
+        pending += chunk
+        # hold the end back, only the end of the stream tells whether it is
+        # the last segment of the file
+        while len(pending) > CHUNK_SIZE:
+            await anyio.to_thread.run_sync(writer.write, bytes(pending[:CHUNK_SIZE]), False)
+            written += CHUNK_SIZE
+            del pending[:CHUNK_SIZE]
+
+    if is_complete(written + len(pending)):
+        await anyio.to_thread.run_sync(writer.write, bytes(pending), True)
+        return written + len(pending)
+    aligned = len(pending) - len(pending) % writer.align
+    if aligned:
+        await anyio.to_thread.run_sync(writer.write, bytes(pending[:aligned]), False)
+    return written + aligned
+
+
+def _open_record_file(path: str, header: bytes | None) -> BinaryIO:
+    f = open(path, "wb")
+    if header is not None:
+        f.write(header)
+    return f
+
+
+async def _read_upload(file: UploadFile) -> AsyncIterable[bytes]:
+    while chunk := await file.read(CHUNK_SIZE):
+        yield chunk
+
+
+async def store_upload(file: UploadFile) -> StoredFile:
+    """
+    Stream a multipart upload into UPLOAD_DIR, hashing it on the way, and
+    encrypting it when RECORD_ENCRYPTION_KEY is set.
+    """
+    file_name = new_file_name(file.filename)
+    path = os.path.join(UPLOAD_DIR, file_name)
+    hasher = hashlib.sha256()
+    header, cipher, data_key = None, None, None
+    if encryption.enabled():
+        key, data_key = encryption.new_data_key()
+        header = encryption.new_header()
+        cipher = SegmentCipher(key, header)
+    f = await anyio.to_thread.run_sync(_open_record_file, path, header)
+    try:
+        try:
+            size = await _stream_to(
+                RecordWriter(f, hasher, cipher), _read_upload(file), MAX_RECORD_SIZE, lambda _: True
+            )
+        finally:
+            await anyio.to_thread.run_sync(f.close)
+    except BaseException:
+        await anyio.to_thread.run_sync(_remove, path)
+        raise
+    return StoredFile(file_name, size, hasher.hexdigest(), data_key)
+
+
+# Resumable chunked uploads
+#
+# A session is a `<upload_id>.json` descriptor plus the `<upload_id>.part` file
+# in PARTIAL_DIR. The size of the part file is the authoritative offset, so an
+# interrupted upload resumes from whatever made it to disk, even across
+# restarts. The running sha256 is cached per process and rebuilt from the part
+# file when missing.
+#
+# Encrypted part files only ever hold whole segments until the last chunk: a
+# PUT ending inside a segment keeps what fits in whole segments and reports
+# that offset, the client sends the rest with its next chunk. A segment torn
+# by a crash is dropped before the next append, and the whole segments are
+# resealed under a fresh nonce prefix first, see encryption.reseal().
+
+_session_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+_session_hashers: dict[str, tuple[int, Any]] = {}
+
+
+def _session_paths(upload_id: str) -> tuple[str, str]:
+    base = os.path.join(PARTIAL_DIR, upload_id)
+    return f"{base}.json", f"{base}.part"
+
+
+def _read_json(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_session(meta_path: str, part_path: str, session: dict, header: bytes | None) -> None:
+    _open_record_file(part_path, header).close()
+    with open(meta_path, "w") as f:
+        json.dump(session, f)
+
+
+def _part_offset(part_path: str, session: dict) -> int:
+    # plaintext bytes safely on disk
+    size = os.stat(part_path).st_size
+    if not session.get("data_key"):
+        return size
+    complete = encryption.plaintext_size(size)
+    if complete == session["size"]:
+        return complete
+    return (size - encryption.HEADER_SIZE) // encryption.SEALED_SEGMENT_SIZE * SEGMENT_SIZE
+
+
+def _open_part(part_path: str, offset: int, key: bytes | None) -> tuple[BinaryIO, SegmentCipher | None]:
+    f = open(part_path, "r+b")
+    if key is None:
+        f.seek(0, os.SEEK_END)
+        return f, None
+    whole = offset // SEGMENT_SIZE
+    if os.fstat(f.fileno()).st_size == encryption.segment_offset(whole):
+        cipher = SegmentCipher.from_file(f, key)
+        f.seek(0, os.SEEK_END)
+        return f, cipher
+    # a segment torn by a crash (see _part_offset) was sealed already, sealing
+    # its index again under the same nonce would reuse it
+    with f, open(f"{part_path}.reseal", "wb") as resealed:
+        cipher = encryption.reseal(f, resealed, key, whole)
+    os.replace(f"{part_path}.reseal", part_path)
+    f = open(part_path, "r+b")
+    f.seek(0, os.SEEK_END)
+    return f, cipher
+
+
+async def create_upload_session(
+    patient_id: int, reason: str, filename: str, size: int
+) -> dict:
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+    if size > MAX_RECORD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Record is larger than the allowed {MAX_RECORD_SIZE} bytes",
+        )
+
+    session = {
+        "upload_id": uuid.uuid4().hex,
+        "patient_id": patient_id,
+        "reason": reason,
+        "filename": filename,
+        "size": size,
+    }
+    header = None
+    if encryption.enabled():
+        _, session["data_key"] = encryption.new_data_key()
+        header = encryption.new_header()
+    await anyio.to_thread.run_sync(
+        _write_session, *_session_paths(session["upload_id"]), session, header
+    )
+    return session
+
+
+def _checked_upload_id(upload_id: str) -> str:
+    # the id becomes part of a path, only accept what we hand out
+    try:
+        return uuid.UUID(hex=upload_id).hex
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+
+async def get_upload_session(upload_id: str) -> tuple[dict, int]:
+    """
+    Return the session descriptor and the number of bytes received so far.
+    """
+    upload_id = _checked_upload_id(upload_id)
+    meta_path, part_path = _session_paths(upload_id)
+    try:
+        session = await anyio.to_thread.run_sync(_read_json, meta_path)
+        offset = await anyio.to_thread.run_sync(_part_offset, part_path, session)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session, offset
+
+
+def _session_key(session: dict) -> bytes | None:
+    if not session.get("data_key"):
+        return None
+    return encryption.unwrap_data_key(session["data_key"])
+
+
+async def _session_hasher(upload_id: str, session: dict, offset: int) -> Any:
+    cached = _session_hashers.get(upload_id)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    _, part_path = _session_paths(upload_id)
+    return await anyio.to_thread.run_sync(_hash_file, part_path, _session_key(session), offset)
+
+
+async def append_upload_chunk(
+    upload_id: str, offset: int, chunks: AsyncIterable[bytes]
+) -> tuple[dict, int]:
+    """
+    Append a chunk that starts at `offset` and return the new offset.
+
+    The offset must match what is already on disk, which makes retried PUTs of
+    the same chunk safe to detect.
+    """
+    upload_id = _checked_upload_id(upload_id)
+    async with _session_locks[upload_id]:
+        session, current = await get_upload_session(upload_id)
+        if offset != current:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Chunk starts at {offset} but the upload is at {current}",
+            )
+
+        if current == session["size"]:
+            # complete, the last segment must not be written twice
+            return session, current
+
+        hasher = await _session_hasher(upload_id, session, current)
+        _, part_path = _session_paths(upload_id)
+        f, cipher = await anyio.to_thread.run_sync(_open_part, part_path, current, _session_key(session))
+        try:
+            try:
+                written = await _stream_to(
+                    RecordWriter(f, hasher, cipher, current // SEGMENT_SIZE),
+                    chunks,
+                    session["size"] - current,
+                    lambda received: current + received == session["size"],
+                )
+            finally:
+                await anyio.to_thread.run_sync(f.close)
+        except BaseException:
+            # whatever reached the disk stays, the next chunk rehashes the file
+            _session_hashers.pop(upload_id, None)
+            raise
+        _session_hashers[upload_id] = (current + written, hasher)
+        return session, current + written
+
+
+async def finalize_upload_session(upload_id: str) -> tuple[dict, StoredFile]:
+    """
+    Move a complete upload into UPLOAD_DIR and close its session.
+    """
+    upload_id = _checked_upload_id(upload_id)
+    async with _session_locks[upload_id]:
+        session, offset = await get_upload_session(upload_id)
+        if offset != session["size"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload is incomplete, {offset} of {session['size']} bytes received",
+            )
+
+        hasher = await _session_hasher(upload_id, session, offset)
+        meta_path, part_path = _session_paths(upload_id)
+        file_name = new_file_name(session["filename"])
+        await anyio.to_thread.run_sync(
+            os.replace, part_path, os.path.join(UPLOAD_DIR, file_name)
+        )
+        await anyio.to_thread.run_sync(_remove, meta_path)
+
+    _session_hashers.pop(upload_id, None)
+    _session_locks.pop(upload_id, None)
+    return session, StoredFile(file_name, offset, hasher.hexdigest(), session.get("data_key"))
+
+
+async def discard_upload_session(upload_id: str) -> None:
+    upload_id = _checked_upload_id(upload_id)
+    async with _session_locks[upload_id]:
+        await get_upload_session(upload_id)
+        meta_path, part_path = _session_paths(upload_id)
+        # .reseal is only left by a crash while resealing, see _open_part
+        for path in (meta_path, part_path, f"{part_path}.reseal"):
+            await anyio.to_thread.run_sync(_remove, path)
+
+    _session_hashers.pop(upload_id, None)
+    _session_locks.pop(upload_id, None)
+
+
+# Record downloads
+
+
+class RecordFileResponse(FileResponse):
+    """
+    FileResponse that hands the file to the server for zero-copy transfer when
+    the ASGI server offers the `http.response.zerocopysend` (sendfile) or
+    `http.response.pathsend` extension, and streams large reads otherwise.
+    """
+
+    chunk_size = 256 * 1024
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.extensions = scope.get("extensions") or {}
+        await super().__call__(scope, receive, send)
+
+    async def _zerocopy(self, send: Send, offset: int, count: int) -> None:
+        f = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": offset,
+                    "count": count,
+                    "more_body": False,
+                }
+            )
+        finally:
+            await anyio.to_thread.run_sync(f.close)
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        if send_header_only:
+            return await super()._handle_simple(send, send_header_only)
+        if "http.response.zerocopysend" in self.extensions:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            return await self._zerocopy(send, 0, int(self.headers["content-length"]))
+        if "http.response.pathsend" in self.extensions:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            return await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+        await super()._handle_simple(send, send_header_only)
+
+    async def _handle_single_range(
+        self, send: Send, start: int, end: int, file_size: int, send_header_only: bool
+    ) -> None:
+        if send_header_only or "http.response.zerocopysend" not in self.extensions:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        await self._zerocopy(send, start, end - start)
+
+
+# plaintext decrypted per thread hop when serving an encrypted record
+DECRYPT_BATCH = 1024 * 1024
+
+
+def _parse_range(value: str, size: int) -> tuple[int, int] | None:
+    """
+    [start, end) of a single byte range. None for anything else, which is
+    then served whole.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) + 1 if last else size
+        else:
+            start, end = size - int(last), size
+    except ValueError:
+        return None
+    start, end = max(start, 0), min(end, size)
+    if start >= end:
+        raise HTTPException(status_code=416, headers={"content-range": f"bytes */{size}"})
+    return start, end
+
+
+async def _decrypted(path: str, key: bytes, start: int, end: int) -> AsyncIterable[bytes]:
+    f = await anyio.to_thread.run_sync(open, path, "rb")
+    try:
+
+        def pieces() -> Any:
+            cipher = SegmentCipher.from_file(f, key)
+            segments = encryption.segment_count(os.fstat(f.fileno()).st_size)
+            return encryption.read_plaintext(f, cipher, start, end, segments, DECRYPT_BATCH)
+
+        reader = await anyio.to_thread.run_sync(pieces)
+        while (piece := await anyio.to_thread.run_sync(next, reader, None)) is not None:
+            yield piece
+    finally:
+        await anyio.to_thread.run_sync(f.close)
+
+
+def _encrypted_file_response(
+    request: Request, record: Any, path: str, stat_result: os.stat_result, headers: dict, filename: str
+) -> Response:
+    # decrypted on the fly, no zero-copy here
+    size = encryption.plaintext_size(stat_result.st_size)
+    start, end = 0, size
+    status_code = 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == headers["etag"]):
+        byte_range = _parse_range(range_header, size)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+
+    quoted = quote(filename)
+    headers |= {
+        "accept-ranges": "bytes",
+        "content-length": str(end - start),
+        "content-disposition": f"inline; filename*=utf-8''{quoted}"
+        if quoted != filename
+        else f'inline; filename="{filename}"',
+    }
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    key = encryption.unwrap_data_key(record.data_key)
+    return StreamingResponse(
+        _decrypted(path, key, start, end), status_code=status_code, headers=headers, media_type=media_type
+    )
+
+
+def record_etag(record: Any, stat_result: os.stat_result) -> str:
+    # files are never rewritten (every upload gets a fresh name), so the
+    # content hash, or failing that the inode/mtime/size triple, is a strong tag
+    if record.checksum:
+        return f'"{record.checksum}"'
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _parse_http_date(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def record_file_response(request: Request, record: Any) -> Response:
+    """
+    Serve the file of a record with Range support and conditional GET,
+    decrypting it if it is encrypted.
+    """
+    path = os.path.join(UPLOAD_DIR, record.file_name)
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Record file not found")
+
+    headers = {
+        "etag": record_etag(record, stat_result),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": "private, no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = _parse_http_date(request.headers.get("if-modified-since"))
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, headers["etag"])
+    else:
+        not_modified = (
+            if_modified_since is not None
+            and int(stat_result.st_mtime) <= if_modified_since.timestamp()
+        )
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+
+    # the stored name is "<uuid>_<original name>"
+    _, _, original_name = record.file_name.partition("_")
+    if record.data_key:
+        return _encrypted_file_response(
+            request, record, path, stat_result, headers, original_name or record.file_name
+        )
+    return RecordFileResponse(
+        path,
+        headers=headers,
+        filename=original_name or record.file_name,
+        stat_result=stat_result,
+        content_disposition_type="inline",
+    )
+
+
+async def record_preview_response(request: Request, record: Any) -> Response:
+    """
+    Serve the preview image of a record, with conditional GET.
+    """
+    path = os.path.join(PREVIEW_DIR, record.preview)
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Record preview not found")
+
+    headers = {
+        "etag": f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"',
+        "cache-control": "private, no-cache",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, headers["etag"]):
+        return Response(status_code=304, headers=headers)
+    if record.data_key:
+        # a preview is a few KiB, decrypted in one go
+        sealed = await anyio.to_thread.run_sync(_read_file, path)
+        key = encryption.unwrap_data_key(record.data_key)
+        try:
+            preview = encryption.open_bytes(sealed, key)
+        except ValueError:
+            # a plaintext preview left by a worker killed before sealing it
+            raise HTTPException(status_code=404, detail="Record preview not found")
+        return Response(preview, headers=headers, media_type="image/webp")
+    return FileResponse(path, headers=headers, media_type="image/webp", stat_result=stat_result)
@@ -0,0 +1,40 @@
+"""
+Benchmark and query plan scripts, run from the backend directory against the
+database in POSTGRES_URL, e.g.
+
+    python -m bench.seed --scale 1
+    python -m bench.explain
+    python -m bench.suite --reset
+    python -m bench.startup
+    python -m bench.patient_search
+    python -m bench.bulk_import
+    python -m bench.check_migrations
+
+Point them at a throwaway database, seed.py only ever adds rows and
+suite.py --reset empties every table.
+"""
+
+import os
+
+from tortoise import Tortoise
+
+from app.database import DB_CONNECTION
+from app.database.migrations import migrate
+from app.database.pool import database_config
+
+
+def cli_description(doc: str | None) -> str | None:
+    """
+    The first paragraph of a script's docstring on one line, for its --help.
+    """
+    paragraph = (doc or "").strip().split("\n\n")[0]
+    return " ".join(paragraph.split()) or None
+
+
+async def init_db() -> None:
+    """
+    Connect like the app does and bring the schema up to date.
+    """
+    config = database_config(os.environ["POSTGRES_URL"], DB_CONNECTION)
+    await Tortoise.init(config=config)
+    await migrate(DB_CONNECTION)
@@ -0,0 +1,102 @@
+"""
+Throughput of the clinic onboarding import and export (app/database/bulk.py).
+
+Streams a generated CSV of --patients patients (200 000 by default), with
+--bad-every'th row invalid, through import_rows() in 64 KiB chunks like an
+upload, with on_error=skip, then exports the patient table as CSV and NDJSON.
+Reports rows per second of each. --dry-run validates and rolls back.
+
+    python -m bench.bulk_import --patients 200000
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from tortoise import Tortoise
+
+from app.database.bulk import BulkEntity, BulkOnError, export_csv, export_ndjson, import_rows
+from bench import cli_description, init_db
+from bench.seed import FIRST_NAMES, LAST_NAMES
+
+CHUNK = 64 * 1024
+HEADER = "name,email,phone,dob,gender,address,emergency_person,emergency_relation,emergency_number\n"
+
+
+def patient_csv(run: str, count: int, bad_every: int, rng: random.Random):
+    """
+    The CSV, in CHUNK sized pieces.
+    """
+    buffer = [HEADER]
+    size = len(HEADER)
+    for n in range(1, count + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        dob = f"{rng.randint(1940, 2020)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+        if bad_every and n % bad_every == 0:
+            dob = "1990-02-30"
+        line = (
+            f'{first} {last},{run}-{first.lower()}.{last.lower()}{n}@import.local,{run}-{n},{dob},'
+            f'{rng.choice(["male", "female", "other"])},"{n} Park Street, Kolkata",{first} {last},parent,+91 {n:010}\n'
+        )
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+async def upload(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def measure_export(format: str) -> tuple[int, float]:
+    started = time.perf_counter()
+    size = 0
+    async for chunk in (export_csv if format == "csv" else export_ndjson)(BulkEntity.PATIENTS):
+        size += len(chunk)
+    return size, time.perf_counter() - started
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    run_id = f"import{int(time.time())}"
+    started = time.perf_counter()
+    result = await import_rows(
+        BulkEntity.PATIENTS,
+        upload(patient_csv(run_id, args.patients, args.bad_every, rng)),
+        "csv",
+        BulkOnError.SKIP,
+        args.dry_run,
+    )
+    elapsed = time.perf_counter() - started
+    report = result.report()
+    print(
+        f"import  {args.patients} rows in {elapsed:.1f}s, {args.patients / elapsed:,.0f} rows/s: "
+        f"{report['valid']} valid, {report['rejected']} rejected, committed {report['committed']}"
+    )
+    for format in ("csv", "ndjson"):
+        size, elapsed = await measure_export(format)
+        print(f"export  {format:<6} {size / 1e6:.1f} MB in {elapsed:.1f}s")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--patients", type=int, default=200_000, help="rows in the imported file")
+    parser.add_argument("--bad-every", type=int, default=1000, help="every n-th row has an invalid date, 0 for none")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--dry-run", action="store_true", help="validate only")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        await run(args)
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+"""
+Checks the cleanup steps of MIGRATIONS against seeded duplicates.
+
+Each case drops the unique index its cleanup runs ahead of, seeds the rows
+the index would have refused, forces a migration and checks what the cleanup
+left. The seeded rows are deleted afterwards. Exits with status 1 when a case
+fails.
+
+    python -m bench.check_migrations
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from datetime import date, timedelta
+
+from tortoise import Tortoise, connections
+
+from app.database import (
+    DB_CONNECTION,
+    SLOT_BOOKING_INDEX,
+    SLOT_UNIQUE_INDEX,
+    Appointment,
+    AppointmentStatusEnum,
+    Doctor,
+    GenderEnum,
+    Patient,
+    Slot,
+)
+from app.database.migrations import migrate
+from bench import cli_description, init_db
+
+
+async def remigrate(dropped_index: str) -> None:
+    """
+    Drop an index and forget the schema version, the next migrate() runs as on
+    a database predating the index.
+    """
+    client = connections.get(DB_CONNECTION)
+    await client.execute_script(f'DROP INDEX IF EXISTS "{dropped_index}"')
+    await client.execute_script('DELETE FROM "schema_version"')
+
+
+async def seed_people(run: str, patients: int) -> tuple[Doctor, list[Patient]]:
+    doctor = await Doctor.create(name="Dr Check", email=f"{run}@check.local", phone=run, specialization="check")
+    return doctor, [
+        await Patient.create(
+            name=f"Patient {n}",
+            email=f"{run}-{n}@check.local",
+            phone=f"{run}-{n}",
+            dob=date(1990, 1, 1),
+            gender=GenderEnum.OTHER,
+            address="check",
+            emergency_person="check",
+            emergency_relation="check",
+            emergency_number="check",
+        )
+        for n in range(patients)
+    ]
+
+
+async def book(patient: Patient, doctor: Doctor, slot: Slot, appointment_date: date) -> Appointment:
+    return await Appointment.create(
+        patient_id=patient,
+        doctor_id=doctor,
+        slot_id=slot,
+        appointment_date=appointment_date,
+        status=AppointmentStatusEnum.BOOKED,
+        reason="check",
+    )
+
+
+async def mismatches(case: str, expected: dict[int, tuple[AppointmentStatusEnum, int]]) -> list[str]:
+    """
+    Appointments (id -> status, slot id) not left as expected.
+    """
+    found = {
+        id: (status, slot_id)
+        for id, status, slot_id in await Appointment.filter(id__in=list(expected)).values_list(
+            "id", "status", "slot_id_id"
+        )
+    }
+    return [
+        f"{case}: appointment {id} is {found.get(id)}, expected {values}"
+        for id, values in expected.items()
+        if found.get(id) != values
+    ]
+
+
+async def double_booking(run: str, day: date) -> list[str]:
+    """
+    Two live bookings of a slot on the same date: the earliest keeps it.
+    """
+    doctor, patients = await seed_people(f"{run}-booking", 3)
+    slot = await Slot.create(doctor_id=doctor, available=True, slot_time="09:00-09:15", day=day.strftime("%a"))
+    try:
+        await remigrate(SLOT_BOOKING_INDEX)
+        kept = await book(patients[0], doctor, slot, day)
+        doubled = await book(patients[1], doctor, slot, day)
+        other_day = await book(patients[2], doctor, slot, day + timedelta(days=7))
+        await migrate(DB_CONNECTION)
+        return await mismatches(
+            "double booking",
+            {
+                kept.id: (AppointmentStatusEnum.BOOKED, slot.id),
+                doubled.id: (AppointmentStatusEnum.REJECTED, slot.id),
+                other_day.id: (AppointmentStatusEnum.BOOKED, slot.id),
+            },
+        )
+    finally:
+        await Patient.filter(id__in=[patient.id for patient in patients]).delete()
+        await doctor.delete()
+
+
+async def duplicate_slots(run: str, day: date) -> list[str]:
+    """
+    Two slots of a doctor at the same day and time: they merge into the first,
+    its booking keeps the date, the other slot's bookings move over.
+    """
+    doctor, patients = await seed_people(f"{run}-slots", 3)
+    try:
+        await remigrate(SLOT_UNIQUE_INDEX)
+        slot, duplicate = [
+            await Slot.create(doctor_id=doctor, available=True, slot_time="09:00-09:15", day=day.strftime("%a"))
+            for _ in range(2)
+        ]
+        collides = await book(patients[0], doctor, duplicate, day)
+        kept = await book(patients[1], doctor, slot, day)
+        moved = await book(patients[2], doctor, duplicate, day + timedelta(days=7))
+        await migrate(DB_CONNECTION)
+        failures = await mismatches(
+            "duplicate slots",
+            {
+                collides.id: (AppointmentStatusEnum.REJECTED, slot.id),
+                kept.id: (AppointmentStatusEnum.BOOKED, slot.id),
+                moved.id: (AppointmentStatusEnum.BOOKED, slot.id),
+            },
+        )
+        if await Slot.exists(id=duplicate.id):
+            failures.append(f"duplicate slots: slot {duplicate.id} was not merged")
+        return failures
+    finally:
+        await Patient.filter(id__in=[patient.id for patient in patients]).delete()
+        await doctor.delete()
+
+
+CASES = [double_booking, duplicate_slots]
+
+
+async def main() -> None:
+    argparse.ArgumentParser(description=cli_description(__doc__)).parse_args()
+
+    await init_db()
+    run = f"check{int(time.time())}"
+    day = date.today() + timedelta(days=30)
+    failures = []
+    try:
+        for case in CASES:
+            failures += await case(run, day)
+    finally:
+        await Tortoise.close_connections()
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    print(f"{len(CASES)} cases, {len(failures)} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
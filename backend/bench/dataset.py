@@ -0,0 +1,189 @@
+"""
+Deterministic synthetic clinic, for the endpoint benchmarks (bench/suite.py).
+
+The same --scale and --seed always give the same rows with the same ids,
+so results of different runs compare. Ids start at 1 like on a fresh
+database, the hardcoded current user of every role (admin 1, patient 1,
+doctor 3, receptionist 1) exists and has data. At --scale 1:
+
+    20 doctors, 1 600 slots (Mon-Fri 09:00-13:00), 2 000 patients,
+    20 000 appointments over 12 weeks of slots, 4 000 records,
+    ~11 000 prescriptions, 5 receptionists, 1 admin
+"""
+
+import hashlib
+import random
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from datetime import date, time as clock, timedelta
+
+from tortoise.models import Model
+
+from app.database import (
+    DB_CONNECTION,
+    Admin,
+    Appointment,
+    AppointmentStatusEnum,
+    Doctor,
+    GenderEnum,
+    Patient,
+    Prescription,
+    Receptionist,
+    Records,
+    Slot,
+    WeekdayEnum,
+    fk_id,
+)
+from app.database.migrations import apply_migrations
+from app.database.slots import slot_times
+
+DOCTORS = 20
+PATIENTS = 2_000
+APPOINTMENTS = 20_000
+RECORDS_PER_PATIENT = 2
+RECEPTIONISTS = 5
+
+DAYS = [day.value for day in WeekdayEnum][:5]
+SLOT_TIMES = slot_times(clock(9), clock(13), 15)
+# a Monday, appointments are laid out in weeks around it instead of around
+# today so the data does not change from day to day
+ANCHOR = date(2025, 1, 6)
+# weeks of appointments after ANCHOR, still PENDING or BOOKED
+FUTURE_WEEKS = 2
+BATCH_SIZE = 1000
+
+SPECIALIZATIONS = ["cardiology", "dermatology", "neurology", "orthopedics", "pediatrics"]
+REASONS = ["routine checkup", "follow-up visit", "chest pain", "skin rash", "headache", "back pain"]
+# (observation, medication, test)
+FINDINGS = [
+    ("mild fever and cough", "paracetamol 500mg", "cbc"),
+    ("elevated blood pressure", "amlodipine 5mg", "lipid profile"),
+    ("skin rash on forearm", "hydrocortisone cream", "none"),
+    ("lower back pain", "ibuprofen 400mg", "x-ray"),
+    ("seasonal allergy", "cetirizine 10mg", "none"),
+]
+
+
+@dataclass
+class Dataset:
+    admins: list[Admin] = field(default_factory=list)
+    receptionists: list[Receptionist] = field(default_factory=list)
+    doctors: list[Doctor] = field(default_factory=list)
+    patients: list[Patient] = field(default_factory=list)
+    slots: list[Slot] = field(default_factory=list)
+    records: list[Records] = field(default_factory=list)
+    appointments: list[Appointment] = field(default_factory=list)
+    prescriptions: list[Prescription] = field(default_factory=list)
+
+    def tables(self) -> list[Sequence[Model]]:
+        # in foreign key order
+        return [
+            self.admins, self.receptionists, self.doctors, self.patients,
+            self.slots, self.records, self.appointments, self.prescriptions,
+        ]
+
+
+def appointment_date(slot: Slot, week: int) -> date:
+    """
+    The date of `slot` in the `week`-th week of the dataset, the first weeks
+    are after ANCHOR and the others go back in time.
+    """
+    return ANCHOR + timedelta(days=DAYS.index(slot.day), weeks=FUTURE_WEEKS - 1 - week)
+
+
+def generate(scale: float = 1.0, seed: int = 1) -> Dataset:
+    rng = random.Random(seed)
+    data = Dataset()
+
+    def count(base: int) -> int:
+        return max(1, int(base * scale))
+
+    data.admins.append(
+        Admin(id=1, username="admin", name="Admin", email="admin@bench.local",
+              password_hash=hashlib.sha256(b"admin").hexdigest())
+    )
+    for n in range(1, RECEPTIONISTS + 1):
+        data.receptionists.append(
+            Receptionist(id=n, name=f"Receptionist {n}", email=f"receptionist{n}@bench.local", phone=f"r{n}")
+        )
+    # doctor 3 is the current doctor
+    for n in range(1, max(3, count(DOCTORS)) + 1):
+        data.doctors.append(
+            Doctor(id=n, name=f"Doctor {n}", email=f"doctor{n}@bench.local", phone=f"d{n}",
+                   specialization=rng.choice(SPECIALIZATIONS))
+        )
+    for n in range(1, count(PATIENTS) + 1):
+        data.patients.append(
+            Patient(
+                id=n, name=f"Patient {n}", email=f"patient{n}@bench.local", phone=f"p{n}",
+                dob=date(1950, 1, 1) + timedelta(days=rng.randrange(25_000)),
+                gender=rng.choice(list(GenderEnum)), address=f"{n} Bench Street",
+                emergency_person=f"Contact {n}", emergency_relation="relative", emergency_number=f"e{n}",
+            )
+        )
+    for doctor in data.doctors:
+        for day in DAYS:
+            for slot_time in SLOT_TIMES:
+                data.slots.append(
+                    Slot(id=len(data.slots) + 1, doctor_id_id=doctor.id, day=day, slot_time=slot_time,
+                         available=rng.random() > 0.25)
+                )
+
+    records_of: dict[int, list[int]] = {}
+    for patient in data.patients:
+        for n in range(1, RECORDS_PER_PATIENT + 1):
+            record_id = len(data.records) + 1
+            file_name = f"bench-{patient.id}-{n}.pdf"
+            data.records.append(
+                Records(
+                    id=record_id, patient_id_id=patient.id, reason=rng.choice(REASONS),
+                    record_data=f"/uploaded_records/{file_name}", file_name=file_name,
+                    size=rng.randrange(20_000, 2_000_000), checksum=rng.randbytes(32).hex(),
+                    mime_type="application/pdf", page_count=rng.randrange(1, 12),
+                )
+            )
+            records_of.setdefault(patient.id, []).append(record_id)
+
+    # every appointment gets its own (slot, week), the slot booking index
+    # never rejects a row
+    for n in range(count(APPOINTMENTS)):
+        slot = data.slots[n % len(data.slots)]
+        week = n // len(data.slots)
+        patient_id = rng.randrange(len(data.patients)) + 1
+        if week < FUTURE_WEEKS:
+            status = rng.choice([AppointmentStatusEnum.PENDING, AppointmentStatusEnum.BOOKED])
+        else:
+            status = rng.choices(
+                [AppointmentStatusEnum.DONE, AppointmentStatusEnum.REJECTED], weights=[4, 1]
+            )[0]
+        records = records_of[patient_id]
+        data.appointments.append(
+            Appointment(
+                id=n + 1, patient_id_id=patient_id, doctor_id_id=fk_id(slot, "doctor_id"), slot_id_id=slot.id,
+                receptionist_id_id=None if status == AppointmentStatusEnum.PENDING
+                else rng.randrange(len(data.receptionists)) + 1,
+                appointment_date=appointment_date(slot, week), status=status,
+                record_ids=rng.sample(records, rng.randrange(len(records) + 1)),
+                reason=rng.choice(REASONS),
+            )
+        )
+        if status == AppointmentStatusEnum.DONE and rng.random() < 0.8:
+            observation, medication, test = rng.choice(FINDINGS)
+            data.prescriptions.append(
+                Prescription(
+                    id=len(data.prescriptions) + 1, appointment_id_id=n + 1, observation=observation,
+                    medication=medication, advise="rest and fluids", test=test,
+                )
+            )
+    return data
+
+
+async def load(data: Dataset) -> None:
+    """
+    Insert `data` into an empty database.
+    """
+    for rows in data.tables():
+        for start in range(0, len(rows), BATCH_SIZE):
+            await type(rows[0]).bulk_create(rows[start:start + BATCH_SIZE])
+    # rows came with their ids, move the id sequences past them
+    await apply_migrations(DB_CONNECTION)
@@ -0,0 +1,101 @@
+"""
+Throughput of record encryption (app/encryption.py) on one core, to size the
+CPU of upload and download workers. Needs no database.
+
+Seals and opens a file of --size MiB the way uploads and downloads do:
+through RecordWriter in CHUNK_SIZE writes with sha256 on the way, and
+read_plaintext in DECRYPT_BATCH pieces. Plaintext writing and hashing alone
+is the baseline, the difference is what encryption costs.
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Callable
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from app import encryption
+from app.encryption import RecordWriter, SegmentCipher
+from app.storage import CHUNK_SIZE, DECRYPT_BATCH
+from bench import cli_description
+
+
+def write_file(path: str, data: bytes, key: bytes | None) -> None:
+    with open(path, "wb") as f:
+        cipher = None
+        if key is not None:
+            header = encryption.new_header()
+            f.write(header)
+            cipher = SegmentCipher(key, header)
+        writer = RecordWriter(f, hashlib.sha256(), cipher)
+        # like _stream_to, whole chunks (copied out of its buffer there as
+        # well) and the rest as the last write
+        end = (len(data) - 1) // CHUNK_SIZE * CHUNK_SIZE
+        for start in range(0, end, CHUNK_SIZE):
+            writer.write(data[start:start + CHUNK_SIZE], False)
+        writer.write(data[end:], True)
+
+
+def read_file(path: str, key: bytes | None) -> int:
+    read = 0
+    with open(path, "rb") as f:
+        if key is None:
+            while piece := f.read(DECRYPT_BATCH):
+                read += len(piece)
+            return read
+        size = os.fstat(f.fileno()).st_size
+        cipher = SegmentCipher.from_file(f, key)
+        for piece in encryption.read_plaintext(
+            f, cipher, 0, encryption.plaintext_size(size), encryption.segment_count(size), DECRYPT_BATCH
+        ):
+            read += len(piece)
+    return read
+
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(size_mib: int, repeat: int) -> list[dict]:
+    data = os.urandom(size_mib * 1024 * 1024)
+    key = AESGCM.generate_key(bit_length=256)
+    results = []
+    print(f"{'operation':<28} {'MiB/s':>9} {'cpu s/GiB':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        plain, sealed = os.path.join(directory, "plain"), os.path.join(directory, "sealed")
+        cases = [
+            ("upload, plaintext + sha256", lambda: write_file(plain, data, None)),
+            ("upload, encrypted + sha256", lambda: write_file(sealed, data, key)),
+            ("download, plaintext", lambda: read_file(plain, None)),
+            ("download, decrypted", lambda: read_file(sealed, key)),
+        ]
+        write_file(plain, data, None)
+        write_file(sealed, data, key)
+        if read_file(sealed, key) != len(data):
+            raise SystemExit("decrypted size differs from the plaintext")
+        for name, func in cases:
+            seconds = best_of(func, repeat)
+            throughput = size_mib / seconds
+            print(f"{name:<28} {throughput:>9.0f} {1024 / throughput:>10.2f}")
+            results.append({"operation": name, "mib_per_s": throughput})
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--size", type=int, default=256, help="file size in MiB")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs, the best is kept")
+    args = parser.parse_args()
+    run(args.size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+EXPLAIN the queries behind the hot list and lookup routes and fail when one
+of them falls back to a sequential scan of a large table.
+
+Run it against a seeded database (`python -m bench.seed`), on small tables the
+planner picks sequential scans whatever the indexes. Exits with status 1 on a
+regression.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from collections.abc import Callable, Iterator
+
+from tortoise import Tortoise, connections
+from tortoise.queryset import AwaitableQuery
+
+from app.database import DB_CONNECTION, Appointment, Prescription, Records, Records_Pydantic, Slot
+from app.database.projections import appointment_query, prescription_query
+from bench import cli_description, init_db
+
+# tables that grow with usage, a sequential scan on these is a regression
+LARGE_TABLES = {"appointment", "patient", "prescription", "records", "slot"}
+PAGE_SIZE = 50
+
+
+def page(queryset, after: int | None = None):
+    # what app.pagination.Page.apply() does for ?limit=PAGE_SIZE&cursor=...
+    queryset = queryset.order_by("id")
+    if after is not None:
+        queryset = queryset.filter(id__gt=after)
+    return queryset.limit(PAGE_SIZE + 1)
+
+
+# route -> query built from the sample ids, the same way the route builds it
+CHECKS: list[tuple[str, Callable[[dict], AwaitableQuery]]] = [
+    (
+        "GET /doctor/appointments",
+        lambda s: appointment_query(
+            page(Appointment.filter(doctor_id=s["doctor"], status__in=["BOOKED", "DONE"])),
+            "slot",
+            "patient",
+        ),
+    ),
+    (
+        "GET /doctor/appointments (next page)",
+        lambda s: appointment_query(
+            page(
+                Appointment.filter(doctor_id=s["doctor"], status__in=["BOOKED", "DONE"]),
+                after=s["appointment"] // 2,
+            ),
+            "slot",
+            "patient",
+        ),
+    ),
+    (
+        "GET /patient/appointment",
+        lambda s: appointment_query(page(Appointment.filter(patient_id=s["patient"])), "slot", "doctor"),
+    ),
+    (
+        "GET /patient/record",
+        lambda s: page(Records.filter(patient_id=s["patient"])).values("id", "reason", "record_data"),
+    ),
+    (
+        "GET /doctor/record/{patient_id}/{appointment_id}",
+        lambda s: Records.filter(id__in=s["records"], patient_id=s["patient"]).values(*Records_Pydantic.model_fields),
+    ),
+    (
+        "GET /receptionist/doctor/slots/{doctor_id}",
+        lambda s: Slot.filter(doctor_id=s["doctor"]).values("id", "available", "day", "slot_time"),
+    ),
+    (
+        "PATCH /receptionist/doctor/slots/{doctor_id}",
+        lambda s: Slot.filter(doctor_id=s["doctor"], day="MON"),
+    ),
+    (
+        "GET /prescription/{appointment_id}",
+        lambda s: Prescription.filter(appointment_id=s["prescribed"]).limit(2),
+    ),
+    (
+        "GET /prescription/all",
+        lambda s: prescription_query(page(Prescription.filter(appointment_id__doctor_id=s["doctor"]))),
+    ),
+]
+
+
+async def sample_ids() -> dict:
+    """
+    Ids of real rows to plug into the queries, taken from the newest data.
+    """
+    appointment = await Appointment.filter(status="DONE").order_by("-id").first().values(
+        "id", "doctor_id_id", "patient_id_id"
+    )
+    prescription = await Prescription.all().order_by("-id").first().values("appointment_id_id")
+    if not appointment or not prescription:
+        sys.exit("no data, run `python -m bench.seed` first")
+    records = await Records.filter(patient_id=appointment["patient_id_id"]).values_list("id", flat=True)
+    return {
+        "appointment": appointment["id"],
+        "doctor": appointment["doctor_id_id"],
+        "patient": appointment["patient_id_id"],
+        "records": records or [0],
+        "prescribed": prescription["appointment_id_id"],
+    }
+
+
+def plan_nodes(node: dict) -> Iterator[dict]:
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+async def explain(query: AwaitableQuery, analyze: bool) -> dict:
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    rows = await connections.get(DB_CONNECTION).execute_query_dict(
+        f"EXPLAIN ({options}) {query.sql(params_inline=True)}"
+    )
+    plan = rows[0]["QUERY PLAN"]
+    # asyncpg returns json columns as text
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]
+
+
+async def run(analyze: bool, verbose: bool) -> int:
+    samples = await sample_ids()
+    failures = 0
+    for route, build in CHECKS:
+        query = build(samples)
+        result = await explain(query, analyze)
+        nodes = list(plan_nodes(result["Plan"]))
+        seq_scans = sorted({
+            node["Relation Name"]
+            for node in nodes
+            if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in LARGE_TABLES
+        })
+        indexes = sorted({node["Index Name"] for node in nodes if "Index Name" in node})
+        timing = f"  {result['Execution Time']:.2f}ms" if analyze else ""
+        status = f"SEQ SCAN on {', '.join(seq_scans)}" if seq_scans else "ok"
+        print(f"{status:<28} cost={result['Plan']['Total Cost']:<10}{timing}  {route}")
+        print(f"{'':<28} indexes: {', '.join(indexes) or '-'}")
+        if verbose or seq_scans:
+            print(query.sql(params_inline=True))
+        failures += bool(seq_scans)
+    return failures
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--analyze", action="store_true", help="run the queries (EXPLAIN ANALYZE)")
+    parser.add_argument("--verbose", action="store_true", help="print every query")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        failures = await run(args.analyze, args.verbose)
+    finally:
+        await Tortoise.close_connections()
+    if failures:
+        sys.exit(f"{failures} hot path(s) fall back to a sequential scan")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
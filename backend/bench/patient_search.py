@@ -0,0 +1,165 @@
+"""
+Latency of the desk patient search on a large patient table.
+
+Adds patients with bench/seed.py's generator until the table holds
+--patients rows (1 000 000 by default), then types the name, email and phone
+number of --samples random patients one keystroke at a time, plus their name
+misspelled, through search_patients() (GET /receptionist/patient/search).
+Reports latency percentiles by kind of query and how often the full email or
+phone number finds its patient. Exits with status 1 when the p99 of all
+queries is over --budget-ms.
+
+    python -m bench.patient_search --explain
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from tortoise import Tortoise, connections
+
+from app.database import DB_CONNECTION
+from app.database.projections import patient_search_sql, search_patients
+from bench import cli_description, init_db
+from bench.seed import SEED_SQL, max_patient_id, patient_params
+
+LIMIT = 10
+
+
+async def fill(target: int) -> None:
+    connection = connections.get(DB_CONNECTION)
+    rows = await connection.execute_query_dict('SELECT COUNT(*) AS "count" FROM "patient"')
+    missing = target - rows[0]["count"]
+    if missing <= 0:
+        return
+    started = time.perf_counter()
+    run = f"bench{int(time.time())}"
+    async with connection.acquire_connection() as conn:
+        await conn.execute(dict(SEED_SQL)["patients"], *patient_params(run, missing, await max_patient_id()))
+    await connection.execute_script('ANALYZE "patient"')
+    print(f"added {missing} patients in {time.perf_counter() - started:.1f}s")
+
+
+async def sample(count: int, rng: random.Random) -> list[dict]:
+    connection = connections.get(DB_CONNECTION)
+    bounds = (await connection.execute_query_dict(
+        'SELECT MIN("id") AS "low", MAX("id") AS "high" FROM "patient"'
+    ))[0]
+    ids = [rng.randint(bounds["low"], bounds["high"]) for _ in range(count * 2)]
+    return await connection.execute_query_dict(
+        'SELECT "id", "name", "email", "phone" FROM "patient" WHERE "id" = ANY($1) LIMIT $2', [ids, count]
+    )
+
+
+def misspell(text: str, rng: random.Random) -> str:
+    # two neighbouring letters swapped
+    i = rng.randrange(len(text) - 1)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def keystrokes(patient: dict, rng: random.Random) -> list[tuple[str, str, int | None]]:
+    """
+    (kind, query, id of the patient it must find or None) as staff would
+    type them.
+    """
+    name, email = patient["name"], patient["email"]
+    digits = "".join(c for c in patient["phone"] if c.isdigit())
+    queries: list[tuple[str, str, int | None]] = []
+    queries += [("name prefix", name[:n], None) for n in (1, 2)]
+    queries += [("name", name[:n], None) for n in range(3, len(name) + 1)]
+    queries += [("email", email[:n], None) for n in range(3, email.index("@"))]
+    queries.append(("full email", email, patient["id"]))
+    queries += [("phone", digits[:n], None) for n in range(3, len(digits))]
+    queries.append(("full phone", patient["phone"], patient["id"]))
+    queries.append(("misspelled name", misspell(name, rng), None))
+    return queries
+
+
+async def explain(queries: list[tuple[str, str, int | None]]) -> None:
+    connection = connections.get(DB_CONNECTION)
+    shown = set()
+    for kind, query, _ in queries:
+        if kind in shown:
+            continue
+        shown.add(kind)
+        sql, argument = patient_search_sql(query)
+        rows = await connection.execute_query_dict(
+            f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", [argument, LIMIT]
+        )
+        plan = rows[0]["QUERY PLAN"]
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+        print(f"\n{kind}: {query!r}, {plan['Execution Time']:.2f} ms")
+        print_plan(plan["Plan"])
+
+
+def print_plan(node: dict, depth: int = 1) -> None:
+    index = f" using {node['Index Name']}" if "Index Name" in node else ""
+    print(f"{'  ' * depth}{node['Node Type']}{index}  rows={node['Actual Rows']}")
+    for child in node.get("Plans", []):
+        print_plan(child, depth + 1)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run(args: argparse.Namespace) -> int:
+    rng = random.Random(args.seed)
+    await fill(args.patients)
+    queries = [query for patient in await sample(args.samples, rng) for query in keystrokes(patient, rng)]
+    if args.explain:
+        await explain(queries)
+
+    # warm up the connection and the index pages
+    for _, query, _ in queries[:50]:
+        await search_patients(query, LIMIT)
+
+    timings: dict[str, list[float]] = {}
+    found: dict[str, list[bool]] = {}
+    for kind, query, expected in queries:
+        started = time.perf_counter()
+        results = await search_patients(query, LIMIT)
+        timings.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+        if expected is not None:
+            found.setdefault(kind, []).append(expected in [row["id"] for row in results])
+
+    every = [elapsed for values in timings.values() for elapsed in values]
+    print(f"{'query':<16} {'count':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7} {'found':>6}")
+    for kind, values in [*timings.items(), ("all", every)]:
+        hits = found.get(kind)
+        rate = f"{sum(hits) / len(hits):.0%}" if hits else ""
+        print(
+            f"{kind:<16} {len(values):>6} {percentile(values, 0.5):>7.2f} {percentile(values, 0.95):>7.2f} "
+            f"{percentile(values, 0.99):>7.2f} {max(values):>7.2f} {rate:>6}"
+        )
+
+    p99 = percentile(every, 0.99)
+    if p99 > args.budget_ms:
+        print(f"\np99 {p99:.2f} ms is over the {args.budget_ms} ms budget")
+        return 1
+    print(f"\np99 {p99:.2f} ms, within the {args.budget_ms} ms budget")
+    return 0
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--patients", type=int, default=1_000_000, help="patients in the table, added if missing")
+    parser.add_argument("--samples", type=int, default=200, help="patients whose details are typed")
+    parser.add_argument("--seed", type=int, default=1, help="sampling random seed")
+    parser.add_argument("--budget-ms", type=float, default=20, help="allowed p99")
+    parser.add_argument("--explain", action="store_true", help="print the plan of a query of each kind")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        return await run(args)
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
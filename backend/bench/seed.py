@@ -0,0 +1,181 @@
+"""
+Seed a large synthetic dataset with set based INSERT ... SELECT statements.
+
+Every run adds a new batch of rows tagged with its own run id, so it can be
+repeated to grow the dataset. At --scale 1:
+
+    200 doctors, 50 000 patients, 16 000 slots (Mon-Fri 09:00-13:00),
+    500 000 appointments, 100 000 records, ~125 000 prescriptions
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import time as clock
+
+from tortoise import Tortoise, connections
+
+from app.database import DB_CONNECTION, WeekdayEnum
+from app.database.slots import slot_times
+from bench import cli_description, init_db
+
+DOCTORS = 200
+PATIENTS = 50_000
+APPOINTMENTS = 500_000
+RECORDS_PER_PATIENT = 2
+
+FIRST_NAMES = [
+    "Aarav", "Aditi", "Ahmed", "Aisha", "Alejandro", "Amelia", "Ananya", "Arjun", "Chen", "Chloe",
+    "Daniel", "Diya", "Elena", "Emma", "Fatima", "Gabriel", "Hannah", "Hiroshi", "Ibrahim", "Isabella",
+    "Ishaan", "James", "Kabir", "Kavya", "Leila", "Liam", "Lucas", "Maria", "Meera", "Mohammed",
+    "Noah", "Olivia", "Omar", "Priya", "Rahul", "Riya", "Rohan", "Saanvi", "Sara", "Sofia",
+    "Suhani", "Tanvi", "Vihaan", "Wei", "Yusuf", "Zara",
+]
+LAST_NAMES = [
+    "Agarwal", "Ahmed", "Banerjee", "Bose", "Chatterjee", "Chen", "Das", "Desai", "Fernandes", "Garcia",
+    "Ghosh", "Gupta", "Iyer", "Jain", "Joshi", "Kapoor", "Khan", "Kumar", "Lee", "Malhotra",
+    "Mehta", "Menon", "Mukherjee", "Nair", "Patel", "Pillai", "Rao", "Reddy", "Roy", "Saxena",
+    "Sen", "Shah", "Sharma", "Singh", "Smith", "Srinivasan", "Thomas", "Verma", "Wang", "Yadav",
+]
+
+DAYS = [day.value for day in WeekdayEnum][:5]
+SLOT_TIMES = slot_times(clock(9), clock(13), 15)
+
+SEED_SQL = [
+    (
+        "doctors",
+        """
+        INSERT INTO "doctor" ("name", "email", "phone", "specialization")
+        SELECT 'Doctor ' || g, $1::text || '-doctor' || g || '@bench.local', $1::text || '-d' || g,
+               (ARRAY['cardiology', 'dermatology', 'neurology', 'orthopedics', 'pediatrics'])[1 + g % 5]
+        FROM generate_series(1, $2::int) g
+        """,
+    ),
+    (
+        "patients",
+        """
+        INSERT INTO "patient" ("name", "email", "phone", "dob", "gender", "address",
+                               "emergency_person", "emergency_relation", "emergency_number")
+        SELECT n.first || ' ' || n.last,
+               $1::text || '-' || lower(n.first) || '.' || lower(n.last) || g || '@bench.local',
+               '+91 ' || lpad(((($3::bigint + g) * 7919) % 10000000000)::text, 10, '0'),
+               DATE '1950-01-01' + (g * 37) % 25000,
+               (ARRAY['male', 'female', 'other'])[1 + g % 3],
+               g || ' Bench Street', 'Contact ' || g, 'relative', $1::text || '-e' || g
+        FROM generate_series(1, $2::int) g,
+        LATERAL (
+            SELECT ($4::text[])[1 + g % cardinality($4::text[])] AS first,
+                   ($5::text[])[1 + (g * 7919) % cardinality($5::text[])] AS last
+        ) n
+        """,
+    ),
+    (
+        "slots",
+        """
+        INSERT INTO "slot" ("doctor_id_id", "available", "day", "slot_time")
+        SELECT d."id", (d."id" + t.n) % 4 <> 0, days.day, t.slot_time
+        FROM "doctor" d
+        CROSS JOIN unnest($2::text[]) AS days(day)
+        CROSS JOIN unnest($3::text[]) WITH ORDINALITY t(slot_time, n)
+        WHERE d."email" LIKE $1::text || '-%'
+        """,
+    ),
+    (
+        "appointments",
+        # each generated row gets its own (slot, date) pair, so the slot
+        # booking index never rejects a PENDING/BOOKED row
+        """
+        WITH s AS (
+            SELECT array_agg("id" ORDER BY "id") AS ids, array_agg("doctor_id_id" ORDER BY "id") AS doctors
+            FROM "slot" WHERE "doctor_id_id" IN (SELECT "id" FROM "doctor" WHERE "email" LIKE $1::text || '-%')
+        ), p AS (
+            SELECT array_agg("id" ORDER BY "id") AS ids
+            FROM "patient" WHERE "email" LIKE $1::text || '-%'
+        )
+        INSERT INTO "appointment" ("patient_id_id", "doctor_id_id", "slot_id_id", "appointment_date",
+                                   "status", "record_ids", "reason")
+        SELECT p.ids[1 + (g * 7919) % cardinality(p.ids)],
+               s.doctors[1 + g % cardinality(s.ids)],
+               s.ids[1 + g % cardinality(s.ids)],
+               CURRENT_DATE + 30 - g / cardinality(s.ids),
+               (ARRAY['PENDING', 'BOOKED', 'DONE', 'DONE', 'REJECTED'])[1 + (g / 3) % 5],
+               '[]'::jsonb, 'bench ' || $1::text
+        FROM generate_series(0, $2::int - 1) g, s, p
+        """,
+    ),
+    (
+        "records",
+        """
+        INSERT INTO "records" ("patient_id_id", "reason", "record_data", "file_name", "size", "checksum")
+        SELECT pt."id", 'bench record', '/uploaded_records/' || $1::text || '-' || pt."id" || '-' || n || '.pdf',
+               $1::text || '-' || pt."id" || '-' || n || '.pdf', 1024 * n, NULL
+        FROM "patient" pt CROSS JOIN generate_series(1, $2::int) n
+        WHERE pt."email" LIKE $1::text || '-%'
+        """,
+    ),
+    (
+        "prescriptions",
+        """
+        INSERT INTO "prescription" ("appointment_id_id", "observation", "medication", "advise", "test")
+        SELECT a."id",
+               (ARRAY['mild fever and cough', 'elevated blood pressure', 'skin rash on forearm',
+                      'lower back pain', 'seasonal allergy'])[1 + a."id" % 5],
+               (ARRAY['paracetamol 500mg', 'amlodipine 5mg', 'hydrocortisone cream',
+                      'ibuprofen 400mg', 'cetirizine 10mg'])[1 + a."id" % 5],
+               'rest and fluids', (ARRAY['cbc', 'lipid profile', 'none', 'x-ray', 'none'])[1 + a."id" % 5]
+        FROM "appointment" a
+        WHERE a."reason" = 'bench ' || $1::text AND a."status" = 'DONE'
+        """,
+    ),
+]
+
+
+async def max_patient_id() -> int:
+    rows = await connections.get(DB_CONNECTION).execute_query_dict(
+        'SELECT COALESCE(MAX("id"), 0) AS "id" FROM "patient"'
+    )
+    return rows[0]["id"]
+
+
+def patient_params(run: str, count: int, after: int) -> list:
+    # phone numbers are a permutation of the ids, unique across runs
+    return [run, count, after, FIRST_NAMES, LAST_NAMES]
+
+
+async def seed(scale: float) -> None:
+    connection = connections.get(DB_CONNECTION)
+    run = f"bench{int(time.time())}"
+    params = {
+        "doctors": [run, max(1, int(DOCTORS * scale))],
+        "patients": patient_params(run, max(1, int(PATIENTS * scale)), await max_patient_id()),
+        "slots": [run, DAYS, SLOT_TIMES],
+        "appointments": [run, max(1, int(APPOINTMENTS * scale))],
+        "records": [run, RECORDS_PER_PATIENT],
+        "prescriptions": [run],
+    }
+    for name, sql in SEED_SQL:
+        started = time.perf_counter()
+        async with connection.acquire_connection() as conn:
+            # command tag "INSERT 0 <rows>"
+            status = await conn.execute(sql, *params[name])
+        rows = int(status.rsplit(" ", 1)[1])
+        print(f"{name:<14} {rows:>9} rows  {time.perf_counter() - started:6.2f}s")
+    # fresh statistics, so plans reflect the new row counts
+    await connection.execute_script("ANALYZE")
+    print(f"seeded run {run}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--scale", type=float, default=1.0, help="dataset size multiplier")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        await seed(args.scale)
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""
+Compare FastAPI's default response serialization with the orjson fast path
+(app/serialization.py) on the payloads of the list endpoints.
+
+The default path is what FastAPI does with a returned value: validate it
+against the response_model if there is one, else run it through
+jsonable_encoder, then json.dumps. The fast path is orjson on the rows as
+they come out of the ORM. Both outputs are checked to decode to the same
+JSON. Rows are read from the database in POSTGRES_URL, see bench/seed.py.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from tortoise import Tortoise
+
+from app.database import Appointment, Doctor, Prescription, Records, Records_Pydantic
+from app.database.projections import (
+    appointment_query,
+    appointment_view,
+    doctor_slot_directory,
+    prescription_query,
+    prescription_view,
+)
+from app.serialization import dumps
+from bench import cli_description, init_db
+
+
+async def appointments(limit: int, *relations: str) -> list[dict]:
+    rows = await appointment_query(Appointment.all().order_by("id").limit(limit), *relations)
+    return [appointment_view(row, *relations) for row in rows]
+
+
+async def records(limit: int) -> list[dict]:
+    return await Records.all().order_by("id").limit(limit).values(*Records_Pydantic.model_fields)
+
+
+async def prescriptions(limit: int) -> list[dict]:
+    rows = await prescription_query(Prescription.all().order_by("id").limit(limit))
+    return [prescription_view(row) for row in rows]
+
+
+async def doctors(limit: int) -> dict:
+    return {"doctors": await Doctor.all().order_by("id").limit(limit).values("id", "name", "specialization")}
+
+
+async def slots(limit: int) -> dict:
+    return {"data": await doctor_slot_directory()}
+
+
+# route -> (payload loader, response_model)
+ENDPOINTS: dict[str, tuple[Callable[[int], Awaitable[Any]], Any]] = {
+    "GET /receptionist/appointment": (
+        lambda limit: appointments(limit, "patient", "doctor", "slot"),
+        None,
+    ),
+    "GET /doctor/appointments": (lambda limit: appointments(limit, "slot", "patient"), None),
+    "GET /patient/appointment": (lambda limit: appointments(limit, "slot", "doctor"), None),
+    "GET /patient/record": (records, list[Records_Pydantic]),
+    "GET /prescription/all": (prescriptions, None),
+    "GET /patient/doctors": (doctors, None),
+    "GET /patient/slots": (slots, None),
+}
+
+
+def default_path(content: Any, response_model: Any) -> bytes:
+    # fastapi.routing.serialize_response followed by JSONResponse.render
+    if response_model is not None:
+        adapter = TypeAdapter(response_model)
+        content = adapter.dump_python(adapter.validate_python(content), mode="json")
+    else:
+        content = jsonable_encoder(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def best_of(func: Callable[[], Any], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def payload_size(content: Any) -> int:
+    if isinstance(content, dict):
+        return sum(len(value) for value in content.values() if isinstance(value, list))
+    return len(content)
+
+
+async def run(limit: int, repeat: int) -> list[dict]:
+    results = []
+    print(f"{'endpoint':<32} {'rows':>6} {'default ms':>11} {'fast ms':>9} {'speedup':>8}")
+    for route, (load, response_model) in ENDPOINTS.items():
+        content = await load(limit)
+        if json.loads(default_path(content, response_model)) != json.loads(dumps(content)):
+            raise SystemExit(f"{route}: fast path output differs from the default path")
+        default = best_of(lambda: default_path(content, response_model), repeat)
+        fast = best_of(lambda: dumps(content), repeat)
+        rows = payload_size(content)
+        print(f"{route:<32} {rows:>6} {default * 1000:>11.2f} {fast * 1000:>9.2f} {default / fast:>7.1f}x")
+        results.append({"endpoint": route, "rows": rows, "default_ms": default * 1000, "fast_ms": fast * 1000})
+    return results
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--rows", type=int, default=1000, help="rows per payload")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs, the best is kept")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        await run(args.rows, args.repeat)
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
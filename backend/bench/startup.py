@@ -0,0 +1,101 @@
+"""
+Cold start of the app, phase by phase, each run in a fresh interpreter.
+
+    import    import app.main: modules, ORM models, Pydantic models, routes
+    orm       Tortoise init and the schema version check (app/database/migrations.py)
+    startup   the whole lifespan: orm, pool warm-up, event broker, job worker
+    first     the first request, served by the booted app
+    warm      the same request again
+
+against the database in POSTGRES_URL, with the app's environment. Pass
+--mode check to boot with DB_SCHEMA_MODE=check. Run it twice when the schema
+just changed: the first boot migrates and is not a cold start, the --runs
+after it are. Medians and worst runs are reported in milliseconds.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import orjson
+
+from bench import cli_description
+
+PHASES = ["import", "orm", "startup", "first", "warm"]
+
+
+async def boot(path: str, imported: float, started: float) -> dict[str, float]:
+    import httpx
+
+    import app.main
+
+    timings = {"import": imported - started}
+    ensure_schema = app.main.ensure_schema
+
+    async def timed_ensure_schema(connection_label: str) -> None:
+        await ensure_schema(connection_label)
+        timings["orm"] = time.perf_counter() - lifespan_started
+
+    app.main.ensure_schema = timed_ensure_schema
+    lifespan_started = time.perf_counter()
+    async with app.main.app.router.lifespan_context(app.main.app):
+        timings["startup"] = time.perf_counter() - lifespan_started
+        transport = httpx.ASGITransport(app=app.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for phase in ("first", "warm"):
+                request_started = time.perf_counter()
+                response = await client.get(path)
+                timings[phase] = time.perf_counter() - request_started
+                if response.status_code >= 500:
+                    raise SystemExit(f"GET {path}: {response.status_code}")
+    return timings
+
+
+def child(path: str) -> None:
+    started = time.perf_counter()
+    import app.main  # noqa: F401
+
+    imported = time.perf_counter()
+    timings = asyncio.run(boot(path, imported, started))
+    # the last line of the output, whatever the app printed before
+    sys.stdout.write("\n" + orjson.dumps(timings).decode() + "\n")
+
+
+def run_child(path: str, mode: str) -> dict[str, float]:
+    result = subprocess.run(
+        [sys.executable, "-m", "bench.startup", "--child", "--path", path],
+        env={**os.environ, "DB_SCHEMA_MODE": mode},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise SystemExit(result.stderr or result.stdout)
+    return orjson.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--runs", type=int, default=5, help="cold starts, each in a new process")
+    parser.add_argument("--path", default="/doctor/appointments", help="first request")
+    parser.add_argument("--mode", choices=["migrate", "check"], default="migrate", help="DB_SCHEMA_MODE")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.path)
+        return
+
+    runs = [run_child(args.path, args.mode) for _ in range(args.runs)]
+    print(f"{args.runs} cold starts, DB_SCHEMA_MODE={args.mode}, first request GET {args.path}")
+    print(f"{'phase':<10} {'median ms':>10} {'max ms':>8}")
+    for phase in PHASES:
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:<10} {statistics.median(values):>10.1f} {max(values):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
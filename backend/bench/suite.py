@@ -0,0 +1,350 @@
+"""
+End-to-end latency, throughput and SQL query count of every router.
+
+Loads the synthetic clinic of bench/dataset.py into the database in
+POSTGRES_URL, which must be empty (--reset truncates every table first),
+then sends requests to each endpoint through the ASGI app in process, with
+no server or network in between. Per endpoint it reports the p50 and p99
+latency, requests per second at --concurrency and SQL queries per request.
+With --n-plus-one the paged lists are first checked for a query per row
+(app/database/instrumentation.py).
+
+The app's lifespan is not run: the suite connects like bench/__init__.py,
+no event listener or job worker is started. Uploads and downloads, which
+need files on disk, are measured by bench/encryption.py, SSE streams never
+end and are left out.
+
+With --save the results become the baseline (bench/baseline.json by
+default). Later runs are compared with it: more queries per request, or a
+p50, p99 or throughput worse than --tolerance allows, is a regression and
+the exit status is 1. A baseline is only meaningful on the machine and
+database it was recorded on.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+import orjson
+from tortoise import Tortoise, connections
+
+# every request comes from one client, rate limiting would only measure itself
+os.environ.setdefault("ADMISSION_RATE", "0")
+
+from app.database import DB_CONNECTION, AppointmentStatusEnum, Doctor, Patient, fk_id  # noqa: E402
+from app.database.instrumentation import assert_constant_queries  # noqa: E402
+from app.main import app  # noqa: E402
+from bench import cli_description, init_db
+from bench.dataset import Dataset, appointment_date, generate, load
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# p99 of a few hundred requests is noisy, it is allowed twice the tolerance
+P99_TOLERANCE_FACTOR = 2
+# latency changes smaller than this are timer and scheduling noise
+NOISE_MS = 0.5
+
+# list endpoints taking ?limit=, checked for a query per row with --n-plus-one
+PAGED = [
+    "/patient/record",
+    "/patient/doctors",
+    "/patient/appointment",
+    "/doctor/appointments",
+    "/receptionist/doctors",
+    "/receptionist/appointment",
+    "/prescription/all",
+]
+
+Request = Callable[[int], dict[str, Any]]
+
+
+@dataclass
+class Endpoint:
+    name: str
+    # the keyword arguments of httpx.AsyncClient.request for the i-th request
+    request: Request
+
+
+class QueryCounter(logging.Handler):
+    """
+    Counts the statements tortoise sends, it logs each one at DEBUG.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # "<sql>: <values>", connection setup messages are worded differently
+        if record.msg == "%s: %s":
+            self.count += 1
+
+
+def get(url: str | Callable[[int], str], **params: Any) -> Request:
+    return lambda i: {"method": "GET", "url": url(i) if callable(url) else url, "params": params}
+
+
+def endpoints(data: Dataset) -> list[Endpoint]:
+    """
+    The requests sent to every router. Writes come last, so every read
+    sees the dataset as generated.
+    """
+    patients = [patient.id for patient in data.patients]
+    doctors = [doctor.id for doctor in data.doctors]
+    done = [a for a in data.appointments if a.status == AppointmentStatusEnum.DONE]
+    prescribed = sorted({fk_id(prescription, "appointment_id") for prescription in data.prescriptions})
+    with_records = [a for a in data.appointments if a.record_ids]
+    pending = [a.id for a in data.appointments if a.status == AppointmentStatusEnum.PENDING]
+
+    def pick(items: list) -> Callable[[int], Any]:
+        return lambda i: items[i % len(items)]
+
+    patient, doctor, appointment, prescription, visit = (
+        pick(patients), pick(doctors), pick(data.appointments), pick(prescribed), pick(with_records)
+    )
+
+    open_slots = [slot for slot in data.slots if slot.available]
+
+    def new_appointment(i: int) -> dict[str, Any]:
+        # a week after the dataset for every round over the open slots, never booked
+        slot = open_slots[i % len(open_slots)]
+        week = -1 - i // len(open_slots)
+        return {
+            "method": "POST",
+            "url": "/patient/appointment",
+            "json": {
+                "doctor_id": fk_id(slot, "doctor_id"),
+                "slot_id": slot.id,
+                "appointment_date": appointment_date(slot, week).isoformat(),
+                "reason": "bench booking",
+                "record_ids": [],
+            },
+        }
+
+    return [
+        Endpoint("GET /", get("/")),
+        Endpoint("GET /health", get("/health")),
+        # admin
+        Endpoint("GET /admin/patient/{id}", get(lambda i: f"/admin/patient/{patient(i)}")),
+        Endpoint("GET /admin/doctor/{id}", get(lambda i: f"/admin/doctor/{doctor(i)}")),
+        Endpoint("GET /admin/receptionist/{id}", get("/admin/receptionist/1")),
+        Endpoint("GET /admin/patient/search", get(lambda i: f"/admin/patient/search?q=patient {patient(i)}")),
+        # patient
+        Endpoint("GET /patient/me", get("/patient/me")),
+        Endpoint("GET /patient/record", get("/patient/record")),
+        Endpoint("GET /patient/doctors", get("/patient/doctors")),
+        Endpoint("GET /patient/appointment", get("/patient/appointment")),
+        Endpoint("GET /patient/slots", get("/patient/slots")),
+        Endpoint("GET /patient/slots/{doctor_id}/free", get(lambda i: f"/patient/slots/{doctor(i)}/free")),
+        # records
+        Endpoint("GET /records/me", get("/records/me")),
+        # doctor
+        Endpoint("GET /doctor/me", get("/doctor/me")),
+        Endpoint("GET /doctor/appointments", get("/doctor/appointments")),
+        Endpoint("GET /doctor/appointments?limit=50", get("/doctor/appointments", limit=50)),
+        Endpoint(
+            "GET /doctor/record/{patient_id}/{appointment_id}",
+            get(lambda i: f"/doctor/record/{visit(i).patient_id_id}/{visit(i).id}"),
+        ),
+        # receptionist
+        Endpoint("GET /receptionist/me", get("/receptionist/me")),
+        Endpoint("GET /receptionist/doctors", get("/receptionist/doctors")),
+        Endpoint("GET /receptionist/doctor/slots/{id}", get(lambda i: f"/receptionist/doctor/slots/{doctor(i)}")),
+        Endpoint("GET /receptionist/appointment?limit=100", get("/receptionist/appointment", limit=100)),
+        Endpoint("GET /receptionist/appointment/{id}", get(lambda i: f"/receptionist/appointment/{appointment(i).id}")),
+        # prescription
+        Endpoint("GET /prescription/all?limit=100", get("/prescription/all", limit=100)),
+        Endpoint("GET /prescription/search", get("/prescription/search", q="blood pressure")),
+        Endpoint("GET /prescription/{appointment_id}", get(lambda i: f"/prescription/{prescription(i)}")),
+        # writes
+        Endpoint(
+            "POST /admin/update/doctor/{id}",
+            lambda i: {"method": "POST", "url": f"/admin/update/doctor/{doctor(i)}",
+                       "json": {"phone": f"d{doctor(i)}-{i}"}},
+        ),
+        Endpoint("POST /patient/appointment", new_appointment),
+        Endpoint(
+            "PATCH /receptionist/appointment/status",
+            lambda i: {"method": "PATCH", "url": "/receptionist/appointment/status",
+                       "json": {"appointment_id": pending[i % len(pending)], "action": "approve"}},
+        ),
+        Endpoint(
+            "POST /prescription/create",
+            lambda i: {"method": "POST", "url": "/prescription/create",
+                       "json": {"appointment_id": done[i % len(done)].id, "observation": "bench",
+                                "medication": "none", "advise": "none", "test": "none"}},
+        ),
+    ]
+
+
+async def measure(
+    client: httpx.AsyncClient, endpoint: Endpoint, counter: QueryCounter,
+    requests: int, warmup: int, concurrency: int,
+) -> dict[str, Any]:
+    for i in range(warmup):
+        await client.request(**endpoint.request(i))
+
+    latencies: list[float] = []
+    errors = 0
+    pending = iter(range(warmup, warmup + requests))
+
+    async def send() -> None:
+        nonlocal errors
+        for i in pending:
+            started = time.perf_counter()
+            response = await client.request(**endpoint.request(i))
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": statistics.quantiles(latencies, n=100, method="inclusive")[98] * 1000,
+        "rps": requests / elapsed,
+        "queries": counter.count / requests,
+        "errors": errors,
+    }
+
+
+def compare(name: str, result: dict, base: dict, tolerance: float) -> list[str]:
+    regressions = []
+    # query counts do not vary between runs, any increase is real
+    if result["queries"] > base["queries"] + 1e-9:
+        regressions.append(f"queries {base['queries']:.1f} -> {result['queries']:.1f}")
+    for key, allowed in (("p50_ms", tolerance), ("p99_ms", tolerance * P99_TOLERANCE_FACTOR)):
+        if result[key] > max(base[key] * (1 + allowed), base[key] + NOISE_MS):
+            regressions.append(f"{key} {base[key]:.2f} -> {result[key]:.2f}")
+    if result["rps"] < base["rps"] / (1 + tolerance):
+        regressions.append(f"rps {base['rps']:.0f} -> {result['rps']:.0f}")
+    if result["errors"] > base["errors"]:
+        regressions.append(f"errors {base['errors']} -> {result['errors']}")
+    return [f"{name}: {regression}" for regression in regressions]
+
+
+async def check_queries(client: httpx.AsyncClient) -> list[str]:
+    """
+    The statement count of every paged list must not depend on the page
+    size. Needs postgres, counts come from the Server-Timing header.
+    """
+    failures = []
+    for url in PAGED:
+        try:
+            count = await assert_constant_queries(client, url)
+        except (AssertionError, httpx.HTTPStatusError) as e:
+            failures.append(str(e))
+            print(f"{url:<50} FAILED")
+        else:
+            print(f"{url:<50} {count:>3} queries per page")
+    return failures
+
+
+async def prepare(reset: bool, scale: float, seed: int) -> Dataset:
+    if reset:
+        tables = ", ".join(f'"{model._meta.db_table}"' for model in Tortoise.apps["models"].values())
+        await connections.get(DB_CONNECTION).execute_script(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+    elif await Patient.exists() or await Doctor.exists():
+        raise SystemExit("the database is not empty, run with --reset to truncate it")
+    started = time.perf_counter()
+    data = generate(scale, seed)
+    await load(data)
+    await connections.get(DB_CONNECTION).execute_script("ANALYZE")
+    print(f"loaded {len(data.appointments)} appointments in {time.perf_counter() - started:.1f}s")
+    return data
+
+
+async def run(args: argparse.Namespace) -> int:
+    settings = {"scale": args.scale, "seed": args.seed, "concurrency": args.concurrency}
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline, "rb") as f:
+            baseline = orjson.loads(f.read())
+        if baseline["settings"] != settings:
+            raise SystemExit(f"{args.baseline} was recorded with {baseline['settings']}, run with the same options")
+    data = await prepare(args.reset, args.scale, args.seed)
+
+    counter = QueryCounter()
+    db_logger = logging.getLogger("tortoise.db_client")
+    db_logger.addHandler(counter)
+    db_logger.setLevel(logging.DEBUG)
+    results: dict[str, dict] = {}
+    regressions: list[str] = []
+    # an unhandled exception is a 500 like behind a server, counted as an error
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        n_plus_one = await check_queries(client) if args.n_plus_one else []
+        print(f"{'endpoint':<50} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8} {'errors':>7} {'p50 vs base':>12}")
+        for endpoint in endpoints(data):
+            if args.only and args.only not in endpoint.name:
+                continue
+            # some handlers print() every request, keep it out of the table
+            with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+                result = await measure(client, endpoint, counter, args.requests, args.warmup, args.concurrency)
+            results[endpoint.name] = result
+            change = ""
+            base = baseline and baseline["endpoints"].get(endpoint.name)
+            if base:
+                change = f"{(result['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%"
+                regressions += compare(endpoint.name, result, base, args.tolerance)
+            print(
+                f"{endpoint.name:<50} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['rps']:>8.0f}"
+                f" {result['queries']:>8.1f} {result['errors']:>7} {change:>12}"
+            )
+
+    if n_plus_one:
+        print(f"\n{len(n_plus_one)} endpoints make a query per row:")
+        for failure in n_plus_one:
+            print(f"  {failure}")
+
+    if args.save:
+        with open(args.baseline, "wb") as f:
+            f.write(orjson.dumps({"settings": settings, "endpoints": results}, option=orjson.OPT_INDENT_2))
+        print(f"saved baseline {args.baseline}")
+    elif baseline is None:
+        print(f"no baseline at {args.baseline}, record one with --save")
+    elif regressions:
+        print(f"\n{len(regressions)} regressions against {args.baseline}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    else:
+        print(f"\nno regressions against {args.baseline}")
+    return 1 if n_plus_one else 0
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=cli_description(__doc__))
+    parser.add_argument("--reset", action="store_true", help="truncate every table before loading the dataset")
+    parser.add_argument("--scale", type=float, default=1.0, help="dataset size multiplier")
+    parser.add_argument("--seed", type=int, default=1, help="dataset random seed")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per endpoint first")
+    parser.add_argument("--concurrency", type=int, default=1, help="requests in flight")
+    parser.add_argument("--only", help="only endpoints whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--n-plus-one", action="store_true", help="first check paged lists for a query per row")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        return await run(args)
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))